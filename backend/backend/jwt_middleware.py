@@ -1,17 +1,41 @@
-from rest_framework_simplejwt.tokens import UntypedToken, AccessToken
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from channels.db import database_sync_to_async
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 from django.contrib.auth import get_user_model
+from common.db import database_sync_to_async
+from users.cache import changed_users, ensure_listener, resolved_users
+from users.tokens import TokenPrincipal
 
 User = get_user_model()
 
+
 @database_sync_to_async
-def get_user(token):
+def resolve_user(user_id):
+    user = User.objects.filter(id=user_id, is_active=True).only('id', 'username').first()
+    return TokenPrincipal(user.id, user.username) if user else None
+
+
+async def get_user(token):
     try:
-        UntypedToken(token)
         access_token = AccessToken(token)
-        user_id = access_token['user_id']
-        return User.objects.get(id=user_id)
-    except (TokenError, InvalidToken, User.DoesNotExist, Exception):
+    except TokenError:
         return None
 
+    user_id = access_token.get(api_settings.USER_ID_CLAIM)
+    if user_id is None:
+        return None
+
+    await ensure_listener()
+    username = access_token.get('username')
+    if username is not None:
+        # Issued before a rename or deactivation this worker has heard of.
+        if changed_users.get(int(user_id), username) != username:
+            return None
+        return TokenPrincipal(user_id, username)
+
+    user = resolved_users.get(int(user_id))
+    if user is None:
+        user = await resolve_user(user_id)
+        if user is not None:
+            resolved_users.set(user.id, user)
+    return user
@@ -1,4 +1,6 @@
+import time
 from urllib.parse import parse_qs
+from common.metrics import get_instrumentation
 from .jwt_middleware import get_user
 
 class JwtAuthMiddleware:
@@ -6,8 +8,11 @@ class JwtAuthMiddleware:
         self.app = app
 
     async def __call__(self, scope, receive, send):
+        started = time.perf_counter()
         query = parse_qs(scope["query_string"].decode())
         token = query.get("token")
         scope["user"] = await get_user(token[0]) if token else None
+        outcome = "anonymous" if not token else "ok" if scope["user"] else "rejected"
+        get_instrumentation().authenticated(outcome, time.perf_counter() - started)
         return await self.app(scope, receive, send)
 
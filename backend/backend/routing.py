@@ -1,7 +1,7 @@
 from django.urls import path
-from chat_messages.consumers import ChatConsumer
+from chat_messages.consumers import ChatConsumer, UserConsumer
 
 websocket_urlpatterns = [
+    path("ws/", UserConsumer.as_asgi()),
     path("ws/chat/<int:chat_id>/", ChatConsumer.as_asgi()),
 ]
-
@@ -73,6 +73,16 @@ TEMPLATES = [
 WSGI_APPLICATION = 'backend.wsgi.application'
 ASGI_APPLICATION = 'backend.asgi.application'
 
+# Thread pools for database calls from async code (common.db); reads and
+# writes are kept apart so slow writes cannot delay membership checks
+DB_READ_THREADS = int(os.getenv("DB_READ_THREADS", "8"))
+DB_WRITE_THREADS = int(os.getenv("DB_WRITE_THREADS", "4"))
+
+# Connections come from a psycopg pool per process (DB_POOL=0 falls back to
+# one connection per thread, kept for DB_CONN_MAX_AGE seconds). The pool
+# must cover both thread pools above plus the HTTP request threads.
+DB_POOL = os.getenv("DB_POOL", "1") == "1"
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -81,9 +91,46 @@ DATABASES = {
         "PASSWORD": os.getenv("DB_PASSWORD", "chat"),
         "HOST": os.getenv("DB_HOST", "db"),
         "PORT": os.getenv("DB_PORT", "5432"),
+        "CONN_MAX_AGE": 0 if DB_POOL else int(os.getenv("DB_CONN_MAX_AGE", "0")),
+        # Checked on checkout from the pool, or on reuse without it
+        "CONN_HEALTH_CHECKS": os.getenv("DB_CONN_HEALTH_CHECKS", "1") == "1",
+        "OPTIONS": {
+            "pool": {
+                "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+                "max_size": int(os.getenv("DB_POOL_MAX_SIZE", str(DB_READ_THREADS + DB_WRITE_THREADS + 4))),
+                # Seconds to wait for a free connection before failing
+                "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+                # Idle connections above min_size and connections older than
+                # max_lifetime are closed and replaced
+                "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+                "max_lifetime": float(os.getenv("DB_POOL_MAX_LIFETIME", "1800")),
+            },
+        } if DB_POOL else {},
     }
 }
 
+# Read replicas ("host:port,host:port"), streaming from the database above.
+# Safe REST actions and websocket reads go to a replica whose replay lag is
+# under DB_REPLICA_MAX_LAG seconds (measured every
+# DB_REPLICA_LAG_CHECK_INTERVAL); users who wrote in the last
+# DB_STICKY_SECONDS read from the primary.
+DB_REPLICA_HOSTS = [host for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host]
+for index, replica in enumerate(DB_REPLICA_HOSTS):
+    replica_host, _, replica_port = replica.partition(":")
+    DATABASES[f"replica_{index}"] = {
+        **DATABASES["default"],
+        "HOST": replica_host,
+        "PORT": replica_port or DATABASES["default"]["PORT"],
+        "OPTIONS": dict(DATABASES["default"]["OPTIONS"]),
+        "TEST": {"MIRROR": "default"},
+    }
+if DB_REPLICA_HOSTS:
+    DATABASE_ROUTERS = ["common.db_routing.ReplicaRouter"]
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "2"))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "5"))
+DB_STICKY_SECONDS = float(os.getenv("DB_STICKY_SECONDS", "5"))
+DB_STICKY_CACHE_SIZE = int(os.getenv("DB_STICKY_CACHE_SIZE", "100000"))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -118,6 +165,19 @@ REST_FRAMEWORK = {
     ],
 }
 
+SIMPLE_JWT = {
+    "TOKEN_OBTAIN_SERIALIZER": "users.serializers.ChatTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "users.serializers.ChatTokenRefreshSerializer",
+}
+
+# Websocket auth: cache of users resolved from the DB for tokens that do not
+# carry a username claim. Set JWT_USER_CACHE_SIZE=0 to disable.
+JWT_USER_CACHE_SIZE = int(os.getenv("JWT_USER_CACHE_SIZE", "10000"))
+JWT_USER_CACHE_TTL = int(os.getenv("JWT_USER_CACHE_TTL", "300"))
+# Renamed/deactivated users remembered for one access token lifetime, so
+# their older tokens are rejected (see users/cache.py).
+JWT_USER_CHANGES_SIZE = int(os.getenv("JWT_USER_CHANGES_SIZE", "100000"))
+
 # CORS
 CORS_ALLOW_ALL_ORIGINS = True
 
@@ -131,6 +191,110 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Several Redis nodes ("host:port,host:port") turn on the sharded channel
+# layer: chat groups are consistently hashed onto the nodes.
+CHANNEL_LAYER_SHARDS = [host for host in os.getenv("CHANNEL_LAYER_SHARDS", "").split(",") if host]
+if len(CHANNEL_LAYER_SHARDS) > 1:
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "common.channel_layers.ShardedChannelLayer",
+        "CONFIG": {
+            "shards": [
+                {
+                    "BACKEND": "channels_redis.core.RedisChannelLayer",
+                    "CONFIG": {"hosts": [(host, int(port))]},
+                }
+                for host, port in (shard.split(":") for shard in CHANNEL_LAYER_SHARDS)
+            ],
+            "health_check_interval": float(os.getenv("CHANNEL_LAYER_HEALTH_CHECK_INTERVAL", "5")),
+        },
+    }
+
+# Per-process cache of (user, chat) memberships used by the websocket layer
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))
+
+# Presence
+PRESENCE_HEARTBEAT_INTERVAL = int(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", "30"))
+PRESENCE_CONNECTION_TTL = int(os.getenv("PRESENCE_CONNECTION_TTL", "90"))
+PRESENCE_OFFLINE_GRACE = float(os.getenv("PRESENCE_OFFLINE_GRACE", "5"))
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "10"))
+# A user's status change that keeps failing to write is dropped after this many flushes
+PRESENCE_FLUSH_MAX_ATTEMPTS = int(os.getenv("PRESENCE_FLUSH_MAX_ATTEMPTS", "5"))
+# One worker per interval takes offline the users of workers that died
+PRESENCE_SWEEP_INTERVAL = int(os.getenv("PRESENCE_SWEEP_INTERVAL", "30"))
+PRESENCE_MAX_SUBSCRIPTIONS = int(os.getenv("PRESENCE_MAX_SUBSCRIPTIONS", "500"))
+# Per-chat sockets auto-subscribe to the presence of chats up to this size
+PRESENCE_AUTO_SUBSCRIBE_LIMIT = int(os.getenv("PRESENCE_AUTO_SUBSCRIBE_LIMIT", "50"))
+
+# Typing indicators
+TYPING_MIN_INTERVAL = float(os.getenv("TYPING_MIN_INTERVAL", "1"))
+TYPING_TTL = float(os.getenv("TYPING_TTL", "6"))
+TYPING_BROADCAST_INTERVAL = float(os.getenv("TYPING_BROADCAST_INTERVAL", "0.5"))
+
+# Read receipts are coalesced per (chat, user) and written in batches
+READ_RECEIPT_FLUSH_INTERVAL = float(os.getenv("READ_RECEIPT_FLUSH_INTERVAL", "1"))
+READ_RECEIPT_MAX_ATTEMPTS = int(os.getenv("READ_RECEIPT_MAX_ATTEMPTS", "5"))
+
+# Messages
+MESSAGE_STATUS_BATCH_SIZE = int(os.getenv("MESSAGE_STATUS_BATCH_SIZE", "500"))
+# Groups bigger than this track delivery through ChatReadState watermarks
+# instead of one MessageStatus row per recipient.
+MESSAGE_STATUS_WATERMARK_THRESHOLD = int(os.getenv("MESSAGE_STATUS_WATERMARK_THRESHOLD", "200"))
+# compact_message_statuses folds the read MessageStatus rows of messages
+# older than this many days into the ChatReadState watermarks; their
+# delivered/read times are dropped, the API synthesizes the statuses.
+MESSAGE_STATUS_RETENTION_DAYS = int(os.getenv("MESSAGE_STATUS_RETENTION_DAYS", "30"))
+
+# Websocket messages are broadcast first and persisted in batches by a
+# background writer, which acks the final id to the sender.
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "0") == "1"
+MESSAGE_WRITE_QUEUE_SIZE = int(os.getenv("MESSAGE_WRITE_QUEUE_SIZE", "10000"))
+MESSAGE_WRITE_BATCH_SIZE = int(os.getenv("MESSAGE_WRITE_BATCH_SIZE", "200"))
+MESSAGE_WRITE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_WRITE_FLUSH_INTERVAL", "0.05"))
+
+# Codecs whose websocket frames are encoded once per event at publish time;
+# connections using another codec (?codec=msgpack) encode their own frames.
+WS_PRECOMPUTED_CODECS = [
+    name for name in os.getenv("WS_PRECOMPUTED_CODECS", "json").split(",") if name
+]
+
+# Send only message envelopes over the channel layer; workers hydrate them
+# from a per-process message cache.
+CHANNEL_SLIM_EVENTS = os.getenv("CHANNEL_SLIM_EVENTS", "0") == "1"
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "10000"))
+MESSAGE_CACHE_TTL = int(os.getenv("MESSAGE_CACHE_TTL", "300"))
+
+# Replay buffer for websocket clients resuming with a sync frame
+SYNC_BUFFER_SIZE = int(os.getenv("SYNC_BUFFER_SIZE", "1000"))
+SYNC_BUFFER_TTL = int(os.getenv("SYNC_BUFFER_TTL", "86400"))
+# Above this many changed messages sync gives up and the client refetches history
+SYNC_MAX_EVENTS = int(os.getenv("SYNC_MAX_EVENTS", "1000"))
+
+# Recently seen client_msg_id keys, checked before the database
+CLIENT_MSG_ID_CACHE_SIZE = int(os.getenv("CLIENT_MSG_ID_CACHE_SIZE", "100000"))
+CLIENT_MSG_ID_CACHE_TTL = int(os.getenv("CLIENT_MSG_ID_CACHE_TTL", "600"))
+
+# Without PostgreSQL, message search falls back to an in-process index that
+# only sees this process's writes; allowed for tests and local runs only
+MESSAGE_SEARCH_IN_MEMORY = os.getenv("MESSAGE_SEARCH_IN_MEMORY", "1" if DEBUG else "0") == "1"
+
+# On PostgreSQL messages and their statuses are range-partitioned by message
+# id; create_message_partitions keeps this many empty partitions ready
+MESSAGE_PARTITION_SIZE = int(os.getenv("MESSAGE_PARTITION_SIZE", "5000000"))
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", "2"))
+# archive_messages compresses messages older than this many months into
+# MessageArchive blocks, which history still pages through
+MESSAGE_ARCHIVE_AFTER_MONTHS = int(os.getenv("MESSAGE_ARCHIVE_AFTER_MONTHS", "12"))
+MESSAGE_ARCHIVE_BLOCK_SIZE = int(os.getenv("MESSAGE_ARCHIVE_BLOCK_SIZE", "1000"))
+
+# Metrics: class receiving the websocket instrumentation hooks
+# (common.metrics.NullInstrumentation turns recording off)
+WS_INSTRUMENTATION = os.getenv("WS_INSTRUMENTATION", "common.metrics.Instrumentation")
+METRICS_HISTOGRAM_SAMPLES = int(os.getenv("METRICS_HISTOGRAM_SAMPLES", "1000"))
+# /metrics/ requires "Authorization: Bearer <METRICS_TOKEN>"; without a
+# token it is only served with DEBUG on
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 # Swagger
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Chat API',
@@ -6,6 +6,7 @@ from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 from chats.views import ChatViewSet
 from chat_messages.views import ChatMessageViewSet, MessageViewSet, PinnedMessageViewSet
 from users.views import UserViewSet
+from common.views import metrics
 
 router = DefaultRouter()
 router.register('chats', ChatViewSet, basename='chat')
@@ -15,6 +16,7 @@ router.register('users', UserViewSet, basename='user')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics/', metrics, name='metrics'),
 
     path('api/auth/', include('users.urls')),
     path('api/auth/login/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
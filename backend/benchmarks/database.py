@@ -0,0 +1,21 @@
+"""
+The database the benchmarks seed.
+
+Seeding starts with a flush, so it only ever runs against the database
+benchmarks/settings.py set aside for them (BENCH_DB_NAME), never the one
+the application is configured with.
+"""
+import os
+from django.conf import settings
+from django.core.management import call_command
+
+
+def reset_database():
+    """Migrate the benchmark database and empty it."""
+    name = str(settings.DATABASES["default"]["NAME"])
+    if getattr(settings, "BENCH_DATABASE", None) != name:
+        raise SystemExit(f"Refusing to flush {name!r}: run the benchmarks with DJANGO_SETTINGS_MODULE=benchmarks.settings")
+    if settings.DATABASES["default"]["ENGINE"].endswith("postgresql") and name == os.getenv("DB_NAME", "chat"):
+        raise SystemExit(f"Refusing to flush {name!r}, the application database: set BENCH_DB_NAME to another one")
+    call_command("migrate", verbosity=0)
+    call_command("flush", interactive=False, verbosity=0)
@@ -0,0 +1,197 @@
+"""
+Query budgets and scaling of the REST endpoints.
+
+Seeds one database with background users and, for every scale factor, a
+user who is in CHATS*scale group chats of MEMBERS people. Each chat holds
+MESSAGES messages (with per-member statuses) and PINS pinned messages,
+except the user's first chat, whose history grows to MESSAGES*scale. So
+everything the user can see grows linearly with the scale. Every
+endpoint is then requested as each of those users. For each request it
+records the latency (median of --repeat runs) and the number of queries.
+
+The run fails, with exit status 1, when an endpoint:
+- goes over its query budget in BUDGETS,
+- issues more queries as the data grows (an N+1), or
+- slows down faster than the data grows.
+
+    DJANGO_SETTINGS_MODULE=benchmarks.settings python -m benchmarks.rest_budget --scales 1,2,4
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import django
+
+# Queries per request, including the JWT user lookup.
+BUDGETS = {
+    "chats.list": 3,
+    "chat_messages.list": 3,
+    "messages.search": 3,
+    "pinned.list": 4,
+    "pinned.chat": 4,
+}
+
+ENDPOINTS = {
+    "chats.list": "/api/chats/",
+    "chat_messages.list": "/api/chats/{chat_id}/messages/",
+    "messages.search": "/api/messages/search/?q=hello",
+    "pinned.list": "/api/pinned/",
+    "pinned.chat": "/api/pinned/?chat={chat_id}",
+}
+
+WORDS = ["hello", "world", "meeting", "lunch", "deploy", "review", "coffee", "weekend", "ticket", "release"]
+
+
+def seed(users, chats, members, messages, pins, scales, seed):
+    from django.core.management import call_command
+    from chats.models import Chat
+    from chat_messages.models import Message, MessageStatus, PinnedMessage
+    from users.models import User
+    from .database import reset_database
+
+    reset_database()
+    rng = random.Random(seed)
+
+    User.objects.bulk_create(User(username=f"user{index}") for index in range(users))
+    background = list(User.objects.values_list("id", flat=True))
+    Membership = Chat.members.through
+
+    targets = {}
+    for scale in scales:
+        target = User.objects.create(username=f"target{scale}")
+        chat_ids = []
+        for index in range(chats * scale):
+            chat = Chat.objects.create(type=Chat.GROUP, name=f"scale{scale}-{index}")
+            member_ids = [target.id] + rng.sample(background, members - 1)
+            Membership.objects.bulk_create(Membership(chat=chat, user_id=user_id) for user_id in member_ids)
+
+            Message.objects.bulk_create(
+                Message(
+                    chat=chat,
+                    sender_id=rng.choice(member_ids),
+                    text=" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))),
+                )
+                for _ in range(messages * scale if index == 0 else messages)
+            )
+            message_ids = list(Message.objects.filter(chat=chat).values_list("id", flat=True))
+            MessageStatus.objects.bulk_create(
+                (
+                    MessageStatus(message_id=message_id, user_id=user_id, delivered=True)
+                    for message_id in message_ids for user_id in member_ids
+                ),
+                batch_size=5000,
+            )
+            PinnedMessage.objects.bulk_create(
+                PinnedMessage(chat=chat, message_id=message_id, pinned_by=target)
+                for message_id in rng.sample(message_ids, min(pins, len(message_ids)))
+            )
+            chat_ids.append(chat.id)
+        targets[scale] = (target, chat_ids[0])
+
+    call_command("rebuild_chat_summaries", verbosity=0)
+    return targets
+
+
+def measure(client, url, repeat):
+    from django.db import connection
+
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET {url} returned {response.status_code}")
+
+    # Counted with an execute wrapper: connection.queries keeps only the
+    # last 9000 queries, which a bad N+1 easily exceeds.
+    queries = []
+
+    def count(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    timings = []
+    for _ in range(repeat):
+        queries.clear()
+        with connection.execute_wrapper(count):
+            started = time.perf_counter()
+            client.get(url)
+            timings.append(time.perf_counter() - started)
+    return statistics.median(timings), len(queries)
+
+
+def run(targets, repeat, tolerance, latency_floor):
+    from rest_framework.test import APIClient
+    from users.tokens import ChatRefreshToken
+
+    results = {}
+    failures = []
+    for name, template in ENDPOINTS.items():
+        rows = []
+        for scale, (user, chat_id) in sorted(targets.items()):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f"Bearer {ChatRefreshToken.for_user(user).access_token}")
+            seconds, queries = measure(client, template.format(chat_id=chat_id), repeat)
+            rows.append({"scale": scale, "ms": round(seconds * 1000, 2), "queries": queries})
+        results[name] = {"budget": BUDGETS[name], "runs": rows}
+
+        first, last = rows[0], rows[-1]
+        worst = max(row["queries"] for row in rows)
+        if worst > BUDGETS[name]:
+            failures.append(f"{name}: {worst} queries, budget is {BUDGETS[name]}")
+        if last["queries"] > first["queries"]:
+            failures.append(
+                f"{name}: queries grow with data, {first['queries']} at scale {first['scale']} "
+                f"-> {last['queries']} at scale {last['scale']}"
+            )
+        growth = last["scale"] / first["scale"]
+        if last["ms"] > latency_floor and last["ms"] > first["ms"] * growth * tolerance:
+            failures.append(
+                f"{name}: latency grows super-linearly, {first['ms']}ms -> {last['ms']}ms "
+                f"for {growth:g}x data"
+            )
+    return results, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000, help="Background users")
+    parser.add_argument("--chats", type=int, default=20, help="Chats of the target user at scale 1")
+    parser.add_argument("--members", type=int, default=10, help="Members per chat")
+    parser.add_argument("--messages", type=int, default=50, help="Messages per chat")
+    parser.add_argument("--pins", type=int, default=2, help="Pinned messages per chat")
+    parser.add_argument("--scales", default="1,2,4")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Allowed latency growth relative to data growth")
+    parser.add_argument("--latency-floor", type=float, default=5,
+                        help="Latencies below this many ms are not checked for scaling")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    django.setup()
+
+    scales = sorted(int(scale) for scale in args.scales.split(","))
+    started = time.perf_counter()
+    targets = seed(args.users, args.chats, args.members, args.messages, args.pins, scales, args.seed)
+    seed_seconds = time.perf_counter() - started
+
+    results, failures = run(targets, args.repeat, args.tolerance, args.latency_floor)
+    output = json.dumps({
+        "seed_seconds": round(seed_seconds, 1),
+        "endpoints": results,
+        "failures": failures,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output)
+    sys.stdout.write(output + "\n")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Per-recipient CPU cost of delivering one event to websocket sockets.
+
+Each case goes through what a real delivery costs: publishing the event,
+channels_redis serializing it once per worker (the recipients are spread
+over --workers processes) and deserializing it there, then the consumer's
+send_event() for every recipient socket, whose transport is stubbed out.
+The cases are the event built and encoded by every consumer, encoded
+frames attached to the full event, and encoded frames shipped with only
+the routing fields (what publish() sends), for connections using each
+available codec.
+
+    python -m benchmarks.serialization --recipients 1000 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import django
+
+
+def sample_event(text_length):
+    return {
+        "type": "chat_message",
+        "chat_id": 42,
+        "seq": 1234,
+        "message_id": 987654,
+        "client_msg_id": "6f1c2e9a-4b1d-4a55-9a43-6a1f0d3c2b10",
+        "text": "x" * text_length,
+        "sender": "alice",
+        "sender_id": 7,
+        "created_at": "2024-01-01T12:00:00.000000+00:00",
+    }
+
+
+async def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def no_send(message):
+    pass
+
+
+def consumer_for(codec):
+    from chat_messages.consumers import BaseChatConsumer
+
+    consumer = BaseChatConsumer()
+    consumer.codec = codec
+    consumer.consumer_name = "benchmark"
+    consumer.base_send = no_send
+    return consumer
+
+
+async def measure(publish, codec, recipients, workers, repeat):
+    from channels_redis.core import RedisChannelLayer
+
+    # Only serialize()/deserialize() are used, no connection is opened.
+    layer = RedisChannelLayer()
+    consumer = consumer_for(codec)
+    per_worker = recipients // workers
+    sizes = []
+
+    async def deliver():
+        sizes.clear()
+        published = publish()
+        for worker in range(workers):
+            data = layer.serialize({**published, "__asgi_channel__": [f"specific.{worker}!"]})
+            sizes.append(len(data))
+            received = layer.deserialize(data)
+            for _ in range(per_worker):
+                await consumer.send_event(received)
+
+    elapsed = await timed(deliver, repeat)
+    return {
+        "per_recipient_us": round(elapsed / (per_worker * workers) * 1e6, 3),
+        "layer_bytes_per_worker": sizes[0],
+    }
+
+
+async def run(recipients, workers, text_length, repeat):
+    from common.codecs import CODECS
+    from chat_messages.frames import attach_frames, build_frame
+    from django.conf import settings
+
+    event = sample_event(text_length)
+
+    def full_event_with_frames():
+        frame = build_frame(event)
+        return {**event, "frames": {name: CODECS[name].encode(frame) for name in settings.WS_PRECOMPUTED_CODECS}}
+
+    cases = {
+        "consumer_encodes": lambda: dict(event),
+        "frames_with_full_event": full_event_with_frames,
+        "frames_only": lambda: attach_frames(dict(event)),
+    }
+    results = {
+        "recipients": recipients,
+        "workers": workers,
+        "text_length": text_length,
+        "precomputed_codecs": settings.WS_PRECOMPUTED_CODECS,
+        "codecs": {},
+    }
+    for name, codec in CODECS.items():
+        measured = {case: await measure(publish, codec, recipients, workers, repeat) for case, publish in cases.items()}
+        baseline = measured["consumer_encodes"]["per_recipient_us"]
+        for result in measured.values():
+            result["speedup"] = round(baseline / max(result["per_recipient_us"], 1e-9), 1)
+        results["codecs"][name] = {"library": codec.library, **measured}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--text-length", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    django.setup()
+
+    result = asyncio.run(run(args.recipients, args.workers, args.text_length, args.repeat))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output)
+    sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Settings for running the benchmarks without external services.
+
+SQLite is used unless BENCH_DB_ENGINE=postgres, and the channel layer is
+the in-memory one. Either way the benchmarks get a database of their own,
+BENCH_DB_NAME (benchmark.sqlite3 / chat_bench), since they flush it:
+
+    cd backend
+    DJANGO_SETTINGS_MODULE=benchmarks.settings python -m benchmarks.<name>
+"""
+import os
+from backend.settings import *  # noqa: F401,F403
+
+DEBUG = False
+
+if os.getenv("BENCH_DB_ENGINE", "sqlite") == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.getenv("BENCH_DB_NAME", str(BASE_DIR / "benchmark.sqlite3")),
+        }
+    }
+    # SQLite has a single writer; parallel write transactions fail as locked.
+    DB_WRITE_THREADS = 1
+    MESSAGE_SEARCH_IN_MEMORY = True
+else:
+    # Same server as the application, never its database; no replicas.
+    DATABASES = {
+        "default": {**DATABASES["default"], "NAME": os.getenv("BENCH_DB_NAME", "chat_bench")},
+    }
+    DATABASE_ROUTERS = []
+
+# The only database benchmarks.database.reset_database() will flush.
+BENCH_DATABASE = str(DATABASES["default"]["NAME"])
+
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 100000},
+    },
+}
+
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
@@ -0,0 +1,143 @@
+"""
+Fan-out load across channel layer shards.
+
+Builds a ShardedChannelLayer over SHARDS in-memory layers, subscribes
+MEMBERS channels to each of CHATS chat groups and group_sends MESSAGES
+per chat, reporting how groups and sends spread over the shards and the
+delivery rate. With --fail-shard the given shard starts failing halfway
+through and a health check runs, to check that groups fail over without
+losing deliveries.
+
+    python -m benchmarks.shard_load --shards 4 --chats 100 --members 10 --fail-shard 1
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import django
+from channels.layers import InMemoryChannelLayer
+
+
+class FlakyChannelLayer(InMemoryChannelLayer):
+    """In-memory shard stand-in that can be switched off."""
+
+    down = False
+
+    def _check(self):
+        if self.down:
+            raise ConnectionError("shard is down")
+
+    async def send(self, channel, message):
+        self._check()
+        await super().send(channel, message)
+
+    async def group_add(self, group, channel):
+        self._check()
+        await super().group_add(group, channel)
+
+    async def group_send(self, group, message):
+        self._check()
+        await super().group_send(group, message)
+
+
+async def simulate(shards, chats, members, messages, fail_shard):
+    from common.channel_layers import ShardedChannelLayer
+
+    layer = ShardedChannelLayer(
+        shards=[
+            {"BACKEND": "benchmarks.shard_load.FlakyChannelLayer", "CONFIG": {"capacity": 100000}}
+            for _ in range(shards)
+        ],
+        health_check_interval=3600,
+    )
+    sends = Counter()
+    for index, shard in enumerate(layer.shards):
+        group_send = shard.group_send
+
+        async def counting_group_send(group, message, index=index, group_send=group_send):
+            await group_send(group, message)
+            sends[index] += 1
+
+        shard.group_send = counting_group_send
+
+    received = Counter()
+    channels = []
+    for chat_id in range(chats):
+        for _ in range(members):
+            channel = await layer.new_channel()
+            await layer.group_add(f"chat_{chat_id}", channel)
+            channels.append(channel)
+
+    async def drain(channel):
+        while True:
+            message = await layer.receive(channel)
+            received[message["round"]] += 1
+
+    drainers = [asyncio.ensure_future(drain(channel)) for channel in channels]
+    placement = Counter(layer.shard_index(f"chat_{chat_id}") for chat_id in range(chats))
+
+    started = time.perf_counter()
+    for round_ in range(messages):
+        if fail_shard is not None and round_ == messages // 2:
+            layer.shards[fail_shard].down = True
+            await layer.check_health()
+        await asyncio.gather(*(
+            layer.group_send(f"chat_{chat_id}", {"type": "chat.message", "round": round_})
+            for chat_id in range(chats)
+        ))
+    while sum(received.values()) < chats * members * messages and time.perf_counter() - started < 30:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    for drainer in drainers:
+        drainer.cancel()
+
+    expected = chats * members * messages
+    delivered = sum(received.values())
+    return {
+        "shards": shards,
+        "chats": chats,
+        "members": members,
+        "messages_per_chat": messages,
+        "groups_per_shard": [placement[index] for index in range(shards)],
+        "group_sends_per_shard": [sends[index] for index in range(shards)],
+        "imbalance": round(max(placement.values()) / (chats / shards), 2),
+        "failed_shard": fail_shard,
+        "healthy_shards": sorted(layer.healthy),
+        "expected_deliveries": expected,
+        "delivered": delivered,
+        "lost": expected - delivered,
+        "seconds": round(elapsed, 3),
+        "deliveries_per_second": round(delivered / elapsed),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--fail-shard", type=int)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    django.setup()
+
+    result = asyncio.run(simulate(
+        args.shards, args.chats, args.members, args.messages, args.fail_shard
+    ))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output)
+    sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Channel-layer traffic generated by typing indicators.
+
+Simulates USERS people typing in one chat, each sending a typing frame
+per keystroke, and compares the number and size of group_send calls of
+the old one-event-per-frame behaviour with the coalesced pipeline.
+
+    DJANGO_SETTINGS_MODULE=benchmarks.settings python -m benchmarks.typing_traffic --users 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+
+import django
+
+
+async def simulate(users, keystrokes_per_second, seconds, seed):
+    from channels.layers import get_channel_layer
+    from chat_messages.typing import typing_coalescer
+
+    layer = get_channel_layer()
+    published = {"events": 0, "bytes": 0}
+    group_send = layer.group_send
+
+    async def counting_group_send(group, message):
+        published["events"] += 1
+        published["bytes"] += len(json.dumps(message))
+        await group_send(group, message)
+
+    layer.group_send = counting_group_send
+    rng = random.Random(seed)
+    frames = {"events": 0, "bytes": 0}
+    chat_id = 1
+
+    async def typist(user_id):
+        loop = asyncio.get_running_loop()
+        end = loop.time() + seconds
+        await asyncio.sleep(rng.uniform(0, 1))
+        while loop.time() < end:
+            is_typing = rng.random() > 0.05
+            await typing_coalescer.update(chat_id, user_id, f"user{user_id}", is_typing)
+            frames["events"] += 1
+            frames["bytes"] += len(json.dumps({
+                "type": "typing_event",
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "username": f"user{user_id}",
+                "is_typing": is_typing,
+            }))
+            await asyncio.sleep(rng.expovariate(keystrokes_per_second))
+
+    try:
+        await asyncio.gather(*(typist(user_id) for user_id in range(1, users + 1)))
+        await typing_coalescer.flush()
+    finally:
+        layer.group_send = group_send
+
+    return {
+        "users": users,
+        "keystrokes_per_second": keystrokes_per_second,
+        "seconds": seconds,
+        "naive_group_sends": frames["events"],
+        "naive_bytes": frames["bytes"],
+        "coalesced_group_sends": published["events"],
+        "coalesced_bytes": published["bytes"],
+        "reduction": round(frames["events"] / max(published["events"], 1), 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--keystrokes-per-second", type=float, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    django.setup()
+
+    result = asyncio.run(simulate(args.users, args.keystrokes_per_second, args.seconds, args.seed))
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output)
+    sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
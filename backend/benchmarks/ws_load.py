@@ -0,0 +1,219 @@
+"""
+End-to-end websocket load: latency, throughput and queries per event.
+
+Connects USERS clients to ChatConsumer sockets spread over CHATS group
+chats (through the JWT middleware, as daphne would) and has every user
+send MESSAGES messages, with typing frames and read receipts in between.
+Reports send-to-receive latency percentiles over all deliveries,
+messages and deliveries per second, the database queries per client
+frame, and the consumer's own handler and database time per frame type
+(from common.metrics).
+
+    DJANGO_SETTINGS_MODULE=benchmarks.settings python -m benchmarks.ws_load --users 50 --chats 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+import django
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def seed_chats(users, chats):
+    from chats.models import Chat
+    from users.models import User
+    from users.tokens import ChatRefreshToken
+    from .database import reset_database
+
+    reset_database()
+
+    chat_list = [Chat.objects.create(type="group", name=f"bench-{index}") for index in range(chats)]
+    clients = []
+    for index in range(users):
+        user = User.objects.create(username=f"bench{index}")
+        chat = chat_list[index % chats]
+        chat.members.add(user)
+        clients.append({
+            "user_id": user.id,
+            "chat_id": chat.id,
+            "token": str(ChatRefreshToken.for_user(user).access_token),
+        })
+    return clients
+
+
+async def simulate(clients, messages, rate, typing, codec_name, seed):
+    from channels.routing import URLRouter
+    from channels.testing import WebsocketCommunicator
+    from backend.middleware import JwtAuthMiddleware
+    from backend.routing import websocket_urlpatterns
+    from chat_messages.receipts import read_receipts
+    from chat_messages.typing import typing_coalescer
+    from common.codecs import get_codec
+    from common.metrics import registry
+
+    app = JwtAuthMiddleware(URLRouter(websocket_urlpatterns))
+    codec = get_codec(codec_name)
+    rng = random.Random(seed)
+    members = Counter(client["chat_id"] for client in clients)
+
+    started = time.perf_counter()
+    for client in clients:
+        client["socket"] = WebsocketCommunicator(
+            app, f"/ws/chat/{client['chat_id']}/?token={client['token']}&codec={codec.name}"
+        )
+        connected, _ = await client["socket"].connect()
+        if not connected:
+            raise RuntimeError(f"User {client['user_id']} could not connect")
+        client["last_seen"] = None
+    connect_seconds = time.perf_counter() - started
+
+    sent_at = {}
+    latencies = []
+    frames = Counter()
+
+    async def send(client, data):
+        frames[data["type"]] += 1
+        if codec.binary:
+            await client["socket"].send_to(bytes_data=codec.encode(data))
+        else:
+            await client["socket"].send_to(text_data=codec.encode(data))
+
+    async def listen(client):
+        # receive_output() would cancel the consumer on timeout, so read the
+        # communicator's queue directly and cancel the listener at the end.
+        while True:
+            output = await client["socket"].output_queue.get()
+            if output["type"] != "websocket.send":
+                continue
+            event = codec.decode(output.get("bytes") or output.get("text"))
+            if event.get("type") == "message" and event.get("client_msg_id") in sent_at:
+                latencies.append(time.perf_counter() - sent_at[event["client_msg_id"]])
+                if event.get("message_id"):
+                    client["last_seen"] = event["message_id"]
+
+    async def talk(client):
+        for index in range(messages):
+            await asyncio.sleep(rng.expovariate(rate))
+            if client["last_seen"]:
+                await send(client, {"type": "read", "last_read_message_id": client["last_seen"]})
+            if rng.random() < typing:
+                await send(client, {"type": "typing", "is_typing": True})
+            client_msg_id = f"{client['user_id']}-{index}"
+            sent_at[client_msg_id] = time.perf_counter()
+            await send(client, {"type": "message", "text": f"message {index}", "client_msg_id": client_msg_id})
+
+    listeners = [asyncio.ensure_future(listen(client)) for client in clients]
+    started = time.perf_counter()
+    await asyncio.gather(*(talk(client) for client in clients))
+    send_seconds = time.perf_counter() - started
+
+    expected = sum(members[client["chat_id"]] for client in clients) * messages
+    while len(latencies) < expected and time.perf_counter() - started < send_seconds + 30:
+        await asyncio.sleep(0.05)
+    total_seconds = time.perf_counter() - started
+
+    for listener in listeners:
+        listener.cancel()
+    await typing_coalescer.flush()
+    await read_receipts.flush()
+    for client in clients:
+        await client["socket"].disconnect()
+
+    handler = registry.get("ws_event_seconds")
+    db = registry.get("ws_event_db_seconds")
+    return {
+        "codec": codec.name,
+        "connect_seconds": round(connect_seconds, 3),
+        "frames": dict(frames),
+        "messages": frames["message"],
+        "expected_deliveries": expected,
+        "deliveries": len(latencies),
+        "send_seconds": round(send_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "messages_per_second": round(frames["message"] / send_seconds, 1),
+        "deliveries_per_second": round(len(latencies) / total_seconds, 1),
+        "latency_ms": {
+            name: round(percentile(latencies, pct) * 1000, 2) if latencies else None
+            for name, pct in (("p50", 50), ("p95", 95), ("p99", 99))
+        },
+        "handler_ms": {
+            event: {
+                "p50": round(handler.percentile(50, consumer="chat", event=event) * 1000, 2),
+                "p95": round(handler.percentile(95, consumer="chat", event=event) * 1000, 2),
+                "db_mean": round(db.sum(consumer="chat", event=event) / db.count(consumer="chat", event=event) * 1000, 2),
+            }
+            for event in frames if handler.count(consumer="chat", event=event)
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=10, help="Messages sent by each user")
+    parser.add_argument("--rate", type=float, default=2, help="Messages per second per user")
+    parser.add_argument("--typing", type=float, default=0.5, help="Share of messages preceded by a typing frame")
+    parser.add_argument("--codec", default="json")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    django.setup()
+
+    from django.conf import settings
+    from django.db.backends.signals import connection_created
+
+    settings.MESSAGE_WRITE_BEHIND = args.write_behind
+    clients = seed_chats(args.users, args.chats)
+
+    queries = QueryCounter()
+    connection_created.connect(queries.install)
+    from django.db import connections
+    for connection in connections.all():
+        queries.install(None, connection)
+
+    result = asyncio.run(simulate(clients, args.messages, args.rate, args.typing, args.codec, args.seed))
+    result.update({
+        "users": args.users,
+        "chats": args.chats,
+        "write_behind": args.write_behind,
+        "queries": queries.count,
+        "queries_per_frame": round(queries.count / max(sum(result["frames"].values()), 1), 2),
+        "queries_per_message": round(queries.count / max(result["messages"], 1), 2),
+    })
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output)
+    sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Cold storage for old messages.
+
+archive_range() copies the messages of an id range into MessageArchive
+rows: per chat, blocks of MESSAGE_ARCHIVE_BLOCK_SIZE to_dict() payloads as
+zlib-compressed JSON. The archive_messages command then drops the range
+from the live tables, a whole partition at a time on PostgreSQL.
+
+Archived messages keep their text, sender and dates. Their statuses are
+dropped with them, read state living on in the ChatReadState watermarks.
+Pins of archived messages are deleted, and forwards of them stay but lose
+their forwarded_from link. The inbox preview of a chat whose last message
+gets archived is kept: ChatSummary holds a copy and no constraint on it.
+History pages continue into the archive once a chat's live messages run
+out (ArchivedHistory).
+"""
+import json
+import zlib
+from django.conf import settings
+from django.db import transaction
+from chats.models import Chat
+from .models import Message, MessageArchive, PinnedMessage
+
+# Finished blocks written per INSERT.
+ARCHIVE_BATCH_SIZE = 100
+
+
+def compress(payloads):
+    return zlib.compress(json.dumps(payloads, separators=(",", ":")).encode(), 9)
+
+
+def decompress(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def archive_block(block):
+    return MessageArchive(
+        chat_id=block[0].chat_id,
+        first_message_id=block[0].id,
+        last_message_id=block[-1].id,
+        message_count=len(block),
+        first_created_at=block[0].created_at,
+        last_created_at=block[-1].created_at,
+        data=compress([message.to_dict() for message in block]),
+    )
+
+
+def archive_range(start, end, created_before=None):
+    """
+    Archive the messages with start <= id < end (and created before
+    `created_before` when given), delete their pins and clear forwarded_from
+    on the forwards of any message in the range. Returns the number of
+    archived messages; the caller deletes them.
+
+    Messages are streamed in (chat, id) order, so only the block being
+    filled and one batch of finished blocks are held in memory.
+    """
+    messages = Message.objects.filter(id__gte=start, id__lt=end, is_deleted=False)
+    if created_before is not None:
+        messages = messages.filter(created_at__lt=created_before)
+
+    size = settings.MESSAGE_ARCHIVE_BLOCK_SIZE
+    archived_ids = {}
+    block, blocks, count = [], [], 0
+    with transaction.atomic():
+        for message in messages.select_related('sender').order_by('chat_id', 'id').iterator(chunk_size=2000):
+            if block and (block[0].chat_id != message.chat_id or len(block) == size):
+                blocks.append(archive_block(block))
+                block = []
+                if len(blocks) == ARCHIVE_BATCH_SIZE:
+                    MessageArchive.objects.bulk_create(blocks)
+                    blocks = []
+            block.append(message)
+            archived_ids[message.chat_id] = message.id
+            count += 1
+        if block:
+            blocks.append(archive_block(block))
+        MessageArchive.objects.bulk_create(blocks)
+
+        Chat.objects.bulk_update(
+            [Chat(id=chat_id, archived_message_id=last_id) for chat_id, last_id in archived_ids.items()],
+            ['archived_message_id'],
+            batch_size=1000,
+        )
+        Message.objects.filter(forwarded_from_id__gte=start, forwarded_from_id__lt=end).update(forwarded_from=None)
+        PinnedMessage.objects.filter(message_id__gte=start, message_id__lt=end).delete()
+    return count
+
+
+class ArchivedMessage:
+    """An archived message in a history page, next to live Message objects."""
+
+    def __init__(self, data):
+        self.data = data
+        self.id = data["id"]
+
+    def to_dict(self):
+        return self.data
+
+
+class ArchivedHistory:
+    """Older end of a chat's history for paginate_history()."""
+
+    def __init__(self, chat):
+        self.archived_message_id = chat.archived_message_id
+        self.blocks = MessageArchive.objects.filter(chat_id=chat.id)
+
+    def older(self, before_id, count):
+        """Up to `count` archived messages below before_id, newest first."""
+        items = []
+        if not self.archived_message_id:
+            return items
+        blocks = self.blocks
+        while len(items) < count:
+            if before_id is not None:
+                blocks = self.blocks.filter(first_message_id__lt=before_id)
+            block = blocks.order_by('-last_message_id').only('data').first()
+            if block is None:
+                break
+            entries = [
+                entry for entry in reversed(decompress(block.data))
+                if before_id is None or entry["id"] < before_id
+            ]
+            items.extend(ArchivedMessage(entry) for entry in entries[:count - len(items)])
+            before_id = entries[-1]["id"] if entries else before_id
+        return items
+
+    def newer(self, after_id, count, inclusive=False):
+        """Up to `count` archived messages above after_id (or from it), oldest first."""
+        items = []
+        if after_id + (0 if inclusive else 1) > self.archived_message_id:
+            return items
+        while len(items) < count:
+            blocks = self.blocks.filter(last_message_id__gte=after_id if inclusive else after_id + 1)
+            block = blocks.order_by('last_message_id').only('data').first()
+            if block is None:
+                break
+            entries = [
+                entry for entry in decompress(block.data)
+                if entry["id"] > after_id or (inclusive and entry["id"] == after_id)
+            ]
+            items.extend(ArchivedMessage(entry) for entry in entries[:count - len(items)])
+            after_id, inclusive = entries[-1]["id"], False
+        return items
@@ -0,0 +1,89 @@
+"""
+Compaction of MessageStatus rows into ChatReadState watermarks.
+
+A recipient's status row says nothing the watermark does not once the
+message is at or below their last_read_message_id, apart from the
+delivered/read times. compact_statuses() deletes those rows for messages
+older than MESSAGE_STATUS_RETENTION_DAYS and records the compacted range
+on Chat.statuses_compacted_message_id. Serializers then synthesize the
+missing rows (statuses.synthesized_statuses) as delivered and read,
+without times.
+Rows of recipients who have not read a message are kept.
+
+Only chats within MESSAGE_STATUS_WATERMARK_THRESHOLD are compacted, the
+bigger ones never get per-recipient rows. Synthesis depends on the
+compacted range alone, so a chat that grows past the threshold later keeps
+its old statuses.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, F, Min, OuterRef
+from django.utils import timezone
+from chats.models import Chat, ChatReadState
+from .models import Message, MessageStatus
+
+
+def last_id_before(moment):
+    """
+    Highest message id created before `moment`, or 0. Ids grow with
+    created_at, so this bisects over the primary key instead of scanning
+    the unindexed created_at column.
+    """
+    first = Message.objects.order_by('id').values_list('id', 'created_at').first()
+    if first is None or first[1] >= moment:
+        return 0
+    last = Message.objects.order_by('-id').values_list('id', 'created_at').first()
+    if last[1] < moment:
+        return last[0]
+
+    # Invariant: low was created before moment, no id >= high was.
+    low, high = first[0], last[0]
+    while high - low > 1:
+        middle = (low + high) // 2
+        probe = (
+            Message.objects.filter(id__gte=middle, id__lt=high)
+            .order_by('id').values_list('id', 'created_at').first()
+        )
+        if probe is not None and probe[1] < moment:
+            low = probe[0]
+        else:
+            high = middle
+    return low
+
+
+def compact_statuses(retention_days=None, batch_size=100000):
+    """Delete the read status rows of messages past retention. Returns (bound, deleted)."""
+    if retention_days is None:
+        retention_days = settings.MESSAGE_STATUS_RETENTION_DAYS
+    bound = last_id_before(timezone.now() - timedelta(days=retention_days))
+    if not bound:
+        return 0, 0
+
+    # Readers synthesize statuses from here on, so mark before deleting.
+    small = Chat.objects.annotate(member_count=Count('members')).filter(
+        member_count__lte=settings.MESSAGE_STATUS_WATERMARK_THRESHOLD + 1
+    )
+    Chat.objects.filter(
+        id__in=small.values('id'),
+        statuses_compacted_message_id__lt=bound,
+    ).update(statuses_compacted_message_id=bound)
+
+    read = ChatReadState.objects.filter(
+        chat_id=OuterRef('message__chat_id'),
+        user_id=OuterRef('user_id'),
+        last_read_message_id__gte=OuterRef('message_id'),
+    )
+    start = MessageStatus.objects.filter(message_id__lte=bound).aggregate(start=Min('message_id'))["start"]
+    deleted = 0
+    while start is not None and start <= bound:
+        end = min(start + batch_size, bound + 1)
+        with transaction.atomic():
+            count, _ = MessageStatus.objects.filter(
+                message_id__gte=start,
+                message_id__lt=end,
+                message_id__lte=F('message__chat__statuses_compacted_message_id'),
+            ).filter(Exists(read)).delete()
+        deleted += count
+        start = end
+    return bound, deleted
@@ -1,83 +1,104 @@
-import json
+import asyncio
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.utils import timezone
-
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
-        self.user = self.scope["user"]
-
-        if not self.user:
-            await self.close()
-            return
-
-        is_member = await self.check_membership()
-        if not is_member:
-            await self.close()
-            return
-
-        self.room_group_name = f"chat_{self.chat_id}"
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
-
-        await self.set_online()
-        await self.notify_status(True)
-
-    async def disconnect(self, code):
-        await self.set_offline()
-        await self.notify_status(False)
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-
+from chats.membership import is_member, members_of_any, user_group
+from common.codecs import DEFAULT_CODEC, get_codec
+from common import db_routing
+from common.db import database_sync_to_async, database_write_to_async
+from common.metrics import get_instrumentation
+from users.presence import presence, presence_group
+from . import idempotency
+from .events import chat_group, publish
+from .frames import reencode
+from .hydration import encode_frame, hydrate
+from .models import CLIENT_MSG_ID_MAX_LENGTH
+from .receipts import read_receipts
+from .sync import replay
+from .typing import typing_coalescer
+from .writer import message_writer, provisional_id
+
+# Close code sent when the user is (or becomes) not a member of the chat.
+CLOSE_NOT_MEMBER = 4403
+
+# Inbound frame types the consumers handle. Metrics label anything else as
+# "unknown" so clients cannot mint new label sets.
+FRAME_TYPES = (
+    "message", "typing", "read", "forward", "edit", "delete", "sync",
+    "presence_subscribe", "presence_unsubscribe",
+)
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """
+    Frame handling shared by the per-chat and the multiplexed consumer.
+
+    Every inbound frame is handled for an explicit chat_id and every
+    outbound event carries the chat_id it belongs to.
+    """
+    joined = False
+    counted = False
+    codec = DEFAULT_CODEC
+    consumer_name = None
+
+    async def handle_frame(self, chat_id, data):
         if data["type"] == "message":
-            msg = await self.save_message(data.get("text", ""))
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message_id": msg.id,
-                    "text": msg.text,
-                    "sender": self.user.username,
-                    "sender_id": self.user.id,
-                    "created_at": msg.created_at.isoformat(),
-                }
-            )
+            client_msg_id = data.get("client_msg_id") or None
+            if client_msg_id is not None and (
+                not isinstance(client_msg_id, str) or len(client_msg_id) > CLIENT_MSG_ID_MAX_LENGTH
+            ):
+                return
+
+            if settings.MESSAGE_WRITE_BEHIND:
+                await self.queue_message(chat_id, data.get("text", ""), client_msg_id)
+                return
+
+            if client_msg_id is not None:
+                sent_id = await idempotency.lookup(chat_id, self.user.id, client_msg_id)
+                if sent_id:
+                    await self.resend_message(sent_id, client_msg_id)
+                    return
+
+            msg, created = await self.save_message(chat_id, data.get("text", ""), client_msg_id)
+            if client_msg_id is not None:
+                await idempotency.remember(chat_id, self.user.id, client_msg_id, msg.id)
+            if created:
+                await publish(self.channel_layer, chat_id, self.message_event(msg, client_msg_id))
+            else:
+                await self.chat_message(self.message_event(msg, client_msg_id))
 
         elif data["type"] == "typing":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "typing_event",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_typing": data.get("is_typing", True),
-                }
+            await typing_coalescer.update(
+                chat_id,
+                self.user.id,
+                self.user.username,
+                data.get("is_typing", True)
             )
 
         elif data["type"] == "read":
-            await self.update_read_state(data.get("last_read_message_id", 0))
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "read_update",
-                    "user_id": self.user.id,
-                    "last_read_message_id": data.get("last_read_message_id", 0),
-                }
-            )
+            try:
+                last_id = int(data.get("last_read_message_id"))
+            except (TypeError, ValueError):
+                last_id = 0
+            if last_id <= 0:
+                await self.send_error(chat_id, "last_read_message_id must be a positive integer")
+                return
+            read_receipts.submit(chat_id, self.user.id, last_id)
 
         elif data["type"] == "forward":
+            if not await is_member(self.user.id, data.get("target_chat_id")):
+                return
             msg = await self.forward_message(
                 data.get("message_id"),
                 data.get("target_chat_id")
             )
             if msg:
-                await self.channel_layer.group_send(
-                    f"chat_{data['target_chat_id']}",
+                await publish(
+                    self.channel_layer,
+                    msg.chat_id,
                     {
                         "type": "chat_message",
+                        "seq": msg.seq,
                         "message_id": msg.id,
                         "text": msg.text,
                         "sender": self.user.username,
@@ -89,192 +110,452 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 )
 
         elif data["type"] == "edit":
-            await self.edit_message(data.get("message_id"), data.get("text"))
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "message_edit",
-                    "message_id": data.get("message_id"),
-                    "text": data.get("text"),
-                }
-            )
+            msg = await self.edit_message(chat_id, data.get("message_id"), data.get("text"))
+            if msg:
+                await publish(
+                    self.channel_layer,
+                    chat_id,
+                    {
+                        "type": "message_edit",
+                        "seq": msg.event_seq,
+                        "message_id": msg.id,
+                        "text": msg.text,
+                    }
+                )
 
         elif data["type"] == "delete":
-            await self.delete_message(data.get("message_id"))
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "message_delete",
-                    "message_id": data.get("message_id"),
-                }
-            )
-
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "message",
-            "message_id": event["message_id"],
-            "text": event["text"],
-            "sender": event["sender"],
-            "sender_id": event["sender_id"],
-            "forwarded": event.get("forwarded", False),
-            "forwarded_from": event.get("forwarded_from"),
-            "created_at": event["created_at"],
-        }))
-
-    async def typing_event(self, event):
-        if event["user_id"] != self.user.id:
-            await self.send(text_data=json.dumps({
-                "type": "typing",
-                "user_id": event["user_id"],
-                "username": event["username"],
-                "is_typing": event["is_typing"],
-            }))
-
-    async def read_update(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "read",
-            "user_id": event["user_id"],
-            "last_read_message_id": event["last_read_message_id"],
-        }))
-
-    async def message_edit(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "message_edit",
-            "message_id": event["message_id"],
-            "text": event["text"],
-        }))
-
-    async def message_delete(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "message_delete",
-            "message_id": event["message_id"],
-        }))
-
-    async def user_status(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "user_status",
-            "user_id": event["user_id"],
-            "is_online": event["is_online"],
-        }))
-
-    @database_sync_to_async
-    def check_membership(self):
-        from chats.models import Chat
-        return Chat.objects.filter(id=self.chat_id, members=self.user).exists()
+            msg = await self.delete_message(chat_id, data.get("message_id"))
+            if msg:
+                await publish(
+                    self.channel_layer,
+                    chat_id,
+                    {
+                        "type": "message_delete",
+                        "seq": msg.event_seq,
+                        "message_id": msg.id,
+                    }
+                )
 
-    @database_sync_to_async
-    def save_message(self, text):
-        from .models import Message, MessageStatus
-        message = Message.objects.create(
-            chat_id=self.chat_id,
-            sender=self.user,
-            text=text
+        elif data["type"] == "sync":
+            try:
+                since_seq = int(data.get("since_seq", 0))
+            except (TypeError, ValueError):
+                return
+            events, complete = await replay(chat_id, since_seq)
+            for event in events:
+                await getattr(self, event["type"])(event)
+            await self.send_frame({
+                "type": "sync_done",
+                "chat_id": chat_id,
+                "seq": max([event["seq"] for event in events], default=since_seq),
+                "complete": complete,
+            })
+
+    def message_event(self, msg, client_msg_id=None):
+        return {
+            "type": "chat_message",
+            "chat_id": msg.chat_id,
+            "seq": msg.seq,
+            "message_id": msg.id,
+            "client_msg_id": client_msg_id,
+            "text": msg.text,
+            "sender": self.user.username,
+            "sender_id": self.user.id,
+            "created_at": msg.created_at.isoformat(),
+        }
+
+    async def resend_message(self, sent_id, client_msg_id):
+        """Answer a retried send with the message stored by the first attempt."""
+        if sent_id.startswith("tmp-"):
+            # Still queued; message_commit for it will reach this socket.
+            return
+        msg = await self.get_own_message(sent_id)
+        if msg:
+            await self.chat_message(self.message_event(msg, client_msg_id))
+
+    async def queue_message(self, chat_id, text, client_msg_id=None):
+        pending_id = provisional_id()
+        if client_msg_id is not None:
+            sent_id = await idempotency.claim(chat_id, self.user.id, client_msg_id, pending_id)
+            if sent_id:
+                await self.resend_message(sent_id, client_msg_id)
+                return
+
+        # Enqueue before broadcasting: a full queue holds this socket back
+        # instead of announcing messages that are not going to be written.
+        await message_writer.submit(
+            chat_id,
+            self.user.id,
+            text,
+            sender_name=self.user.username,
+            reply_channel=self.channel_name,
+            provisional_id=pending_id,
+            client_msg_id=client_msg_id,
+        )
+        await publish(
+            self.channel_layer,
+            chat_id,
+            {
+                "type": "chat_message",
+                "message_id": None,
+                "provisional_id": pending_id,
+                "client_msg_id": client_msg_id,
+                "text": text,
+                "sender": self.user.username,
+                "sender_id": self.user.id,
+                "created_at": timezone.now().isoformat(),
+            }
         )
 
-        members = message.chat.members.exclude(id=self.user.id)
-        for user in members:
-            MessageStatus.objects.create(
-                message=message,
-                user=user,
-                delivered=True,
-                delivered_at=timezone.now()
-            )
+    def select_codec(self):
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.codec = get_codec(query.get("codec", [None])[0])
 
-        return message
+    def decode_frame(self, text_data, bytes_data):
+        """The frame as a dict with a type, or None if it is not one."""
+        # Text frames are always JSON, binary ones use the connection codec.
+        try:
+            if text_data is not None:
+                data = DEFAULT_CODEC.decode(text_data)
+            else:
+                data = self.codec.decode(bytes_data)
+        except Exception:
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get("type"), str):
+            data = None
+        event_type = data["type"] if data else None
+        get_instrumentation().event_type(event_type if event_type in FRAME_TYPES else "unknown")
+        return data
+
+    async def send_error(self, chat_id, error):
+        await self.send_frame({"type": "error", "chat_id": chat_id, "error": error})
+
+    def reader_id(self):
+        user = self.scope.get("user")
+        return user.id if user else None
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        self.counted = True
+        get_instrumentation().connection_opened(self.consumer_name)
+        await db_routing.ensure_listener()
+
+    async def websocket_connect(self, message):
+        # Replica reads of this socket stay on the primary while its user is sticky.
+        with db_routing.reading_as(self.reader_id()):
+            await super().websocket_connect(message)
+
+    async def websocket_receive(self, message):
+        instrumentation = get_instrumentation()
+        size = len(message.get("text") or message.get("bytes") or "")
+        timing, token = instrumentation.event_started(self.consumer_name, size)
+        try:
+            with db_routing.reading_as(self.reader_id()):
+                await super().websocket_receive(message)
+        finally:
+            instrumentation.event_finished(timing, token)
+
+    async def websocket_disconnect(self, message):
+        if self.counted:
+            self.counted = False
+            get_instrumentation().connection_closed(self.consumer_name)
+        if self.joined:
+            await read_receipts.flush(self.user.id)
+        await super().websocket_disconnect(message)
+
+    async def send_frame(self, data):
+        frame = self.codec.encode(data)
+        get_instrumentation().frame_sent(self.consumer_name, data.get("type"), len(frame))
+        await self.send_encoded(frame)
+
+    async def send_encoded(self, frame):
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def send_event(self, event):
+        frames = event.get("frames")
+        if frames:
+            frame = frames.get(self.codec.name)
+            if frame is None:
+                # The local sockets share the deserialized event, so this
+                # codec is encoded once per worker.
+                frame = frames[self.codec.name] = reencode(frames, self.codec)
+        else:
+            if event.get("slim") and not await is_member(self.user.id, event["chat_id"]):
+                # Envelopes still in flight when the user left the chat.
+                return
+            event = await hydrate(event)
+            if event is None:
+                return
+            frame = encode_frame(event, self.codec)
+        get_instrumentation().frame_sent(self.consumer_name, event["type"], len(frame))
+        await self.send_encoded(frame)
+
+    chat_message = send_event
+    message_ack = send_event
+    message_commit = send_event
+    message_failed = send_event
+    read_update = send_event
+    message_edit = send_event
+    message_delete = send_event
+    user_status = send_event
+
+    async def typing_update(self, event):
+        # One frame goes to the whole chat; the typer is left out of their own.
+        users = [user for user in event["users"] if user["user_id"] != self.user.id]
+        if len(users) < len(event["users"]):
+            event = {"type": "typing_update", "chat_id": event["chat_id"], "users": users}
+        await self.send_event(event)
+
+    @database_write_to_async
+    def save_message(self, chat_id, text, client_msg_id=None):
+        from .services import send_message_once
+        return send_message_once(chat_id, self.user, text, client_msg_id)
 
     @database_sync_to_async
-    def update_read_state(self, last_id):
-        from chats.models import ChatReadState
-        from .models import MessageStatus
-        if last_id <= 0:
-            return
-
-        state, _ = ChatReadState.objects.get_or_create(
-            chat_id=self.chat_id,
-            user=self.user
-        )
-
-        if last_id > state.last_read_message_id:
-            state.last_read_message_id = last_id
-            state.save(update_fields=['last_read_message_id'])
-
-            MessageStatus.objects.filter(
-                message__chat_id=self.chat_id,
-                message_id__lte=last_id,
-                user=self.user,
-                read=False
-            ).update(
-                read=True,
-                read_at=timezone.now()
-            )
+    def get_own_message(self, message_id):
+        from .models import Message
+        return Message.objects.filter(id=message_id, sender_id=self.user.id).first()
 
-    @database_sync_to_async
+    @database_write_to_async
     def forward_message(self, message_id, target_chat_id):
+        from chats.membership import is_member_sync
         from .models import Message
+        from .services import send_message
         try:
-            original = Message.objects.get(id=message_id)
-            return Message.objects.create(
-                chat_id=target_chat_id,
-                sender=self.user,
-                text=original.text,
-                forwarded_from=original,
-                forwarded_by=self.user
-            )
-        except Message.DoesNotExist:
+            original = Message.objects.select_related('sender').get(id=message_id)
+        except (Message.DoesNotExist, ValueError, TypeError):
+            return None
+        if not is_member_sync(self.user.id, original.chat_id):
             return None
+        return send_message(
+            target_chat_id,
+            self.user,
+            original.text,
+            forwarded_from=original
+        )
 
-    @database_sync_to_async
-    def edit_message(self, message_id, text):
+    @database_write_to_async
+    def edit_message(self, chat_id, message_id, text):
         from .models import Message
-        Message.objects.filter(
+        from .services import edit_message
+        message = Message.objects.filter(
             id=message_id,
-            sender=self.user
-        ).update(
-            text=text,
-            is_edited=True,
-            edited_at=timezone.now()
-        )
-
-    @database_sync_to_async
-    def delete_message(self, message_id):
+            chat_id=chat_id,
+            sender_id=self.user.id,
+            is_deleted=False
+        ).first()
+        if message and text:
+            return edit_message(message, text)
+        return None
+
+    @database_write_to_async
+    def delete_message(self, chat_id, message_id):
         from .models import Message
-        Message.objects.filter(
+        from .services import delete_message
+        message = Message.objects.filter(
             id=message_id,
-            sender=self.user
-        ).update(
-            is_deleted=True,
-            text='Message deleted'
-        )
+            chat_id=chat_id,
+            sender_id=self.user.id
+        ).first()
+        if message:
+            return delete_message(message)
+        return None
 
     @database_sync_to_async
-    def set_online(self):
-        from users.models import UserStatus
-        status, _ = UserStatus.objects.get_or_create(user=self.user)
-        status.go_online()
-
-    @database_sync_to_async
-    def set_offline(self):
-        from users.models import UserStatus
-        status, _ = UserStatus.objects.get_or_create(user=self.user)
-        status.go_offline()
+    def get_user_chat_ids(self):
+        from chats.models import Chat
+        return list(
+            Chat.objects.filter(members=self.user.id).values_list('id', flat=True)
+        )
 
     @database_sync_to_async
-    def get_user_chat_ids(self):
+    def get_chat_member_ids(self, chat_id):
         from chats.models import Chat
         return list(
-            Chat.objects.filter(members=self.user).values_list('id', flat=True)
+            Chat.members.through.objects.filter(chat_id=chat_id)
+            .values_list('user_id', flat=True)[:settings.PRESENCE_AUTO_SUBSCRIBE_LIMIT + 1]
         )
 
-    async def notify_status(self, is_online):
-        chat_ids = await self.get_user_chat_ids()
-
-        for chat_id in chat_ids:
-            await self.channel_layer.group_send(
-                f"chat_{chat_id}",
-                {
-                    "type": "user_status",
-                    "user_id": self.user.id,
-                    "is_online": is_online
-                }
-            )
+    async def start_presence(self):
+        self.presence_subscriptions = set()
+        await presence.connect(self.user.id, self.channel_name)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+
+    async def stop_presence(self):
+        self.heartbeat_task.cancel()
+        for user_id in self.presence_subscriptions:
+            await self.channel_layer.group_discard(presence_group(user_id), self.channel_name)
+        await presence.disconnect(self.user.id, self.channel_name)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+            await presence.heartbeat(self.user.id, self.channel_name)
+
+    async def subscribe_presence(self, user_ids):
+        room = settings.PRESENCE_MAX_SUBSCRIPTIONS - len(self.presence_subscriptions)
+        user_ids = [user_id for user_id in user_ids if user_id not in self.presence_subscriptions][:max(room, 0)]
+        for user_id in user_ids:
+            await self.channel_layer.group_add(presence_group(user_id), self.channel_name)
+        self.presence_subscriptions.update(user_ids)
+
+        await self.send_frame({
+            "type": "presence",
+            "users": await presence.snapshot(user_ids),
+        })
+
+    def presence_chat_ids(self):
+        """Chats whose members this socket may subscribe to the presence of."""
+        return []
+
+    async def handle_presence_frame(self, data):
+        if data.get("type") not in ("presence_subscribe", "presence_unsubscribe"):
+            return False
+
+        try:
+            user_ids = [int(user_id) for user_id in data.get("user_ids", [])]
+        except (TypeError, ValueError):
+            return True
+
+        if data["type"] == "presence_subscribe":
+            # Only the presence of users sharing a chat with this one is visible.
+            contacts = await members_of_any(self.presence_chat_ids(), user_ids)
+            await self.subscribe_presence([user_id for user_id in user_ids if user_id in contacts])
+        else:
+            for user_id in set(user_ids) & self.presence_subscriptions:
+                await self.channel_layer.group_discard(presence_group(user_id), self.channel_name)
+                self.presence_subscriptions.discard(user_id)
+        return True
+
+class ChatConsumer(BaseChatConsumer):
+    """Socket bound to a single chat: ws/chat/<chat_id>/."""
+
+    consumer_name = "chat"
+
+    async def connect(self):
+        self.select_codec()
+        self.chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
+        self.user = self.scope["user"]
+        self.room_group_name = chat_group(self.chat_id)
+
+        if not self.user:
+            await self.close()
+            return
+
+        if not await is_member(self.user.id, self.chat_id):
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_add(user_group(self.user.id), self.channel_name)
+        self.joined = True
+        await self.accept()
+
+        await self.start_presence()
+        member_ids = await self.get_chat_member_ids(self.chat_id)
+        if len(member_ids) <= settings.PRESENCE_AUTO_SUBSCRIBE_LIMIT:
+            await self.subscribe_presence(member_ids)
+
+    def presence_chat_ids(self):
+        return [self.chat_id]
+
+    async def disconnect(self, code):
+        if not self.joined:
+            return
+        await self.stop_presence()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_discard(user_group(self.user.id), self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode_frame(text_data, bytes_data)
+        if data is None:
+            await self.send_error(self.chat_id, "Invalid frame")
+            return
+
+        if await self.handle_presence_frame(data):
+            return
+
+        if not await is_member(self.user.id, self.chat_id):
+            await self.close(code=CLOSE_NOT_MEMBER)
+            return
+
+        await self.handle_frame(self.chat_id, data)
+
+    async def membership_changed(self, event):
+        if event["chat_id"] == self.chat_id and not event["is_member"]:
+            await self.close(code=CLOSE_NOT_MEMBER)
+
+
+class UserConsumer(BaseChatConsumer):
+    """
+    One socket per user for all of their chats: ws/.
+
+    Subscribes to every chat group of the user plus the personal
+    user_<id> group; inbound frames must name their chat_id.
+    """
+
+    consumer_name = "user"
+
+    async def connect(self):
+        self.select_codec()
+        self.user = self.scope["user"]
+
+        if not self.user:
+            await self.close()
+            return
+
+        self.chat_ids = set(await self.get_user_chat_ids())
+        for chat_id in self.chat_ids:
+            await self.channel_layer.group_add(chat_group(chat_id), self.channel_name)
+        await self.channel_layer.group_add(user_group(self.user.id), self.channel_name)
+        self.joined = True
+        await self.accept()
+
+        await self.start_presence()
+
+    def presence_chat_ids(self):
+        return self.chat_ids
+
+    async def disconnect(self, code):
+        if not self.joined:
+            return
+        await self.stop_presence()
+        for chat_id in self.chat_ids:
+            await self.channel_layer.group_discard(chat_group(chat_id), self.channel_name)
+        await self.channel_layer.group_discard(user_group(self.user.id), self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode_frame(text_data, bytes_data)
+        if data is None:
+            await self.send_error(None, "Invalid frame")
+            return
+        if await self.handle_presence_frame(data):
+            return
+
+        chat_id = data.get("chat_id")
+
+        if not await is_member(self.user.id, chat_id):
+            await self.send_error(chat_id, "Chat not found")
+            return
+
+        await self.handle_frame(int(chat_id), data)
+
+    async def membership_changed(self, event):
+        chat_id = event["chat_id"]
+        if event["is_member"] and chat_id not in self.chat_ids:
+            self.chat_ids.add(chat_id)
+            await self.channel_layer.group_add(chat_group(chat_id), self.channel_name)
+        elif not event["is_member"] and chat_id in self.chat_ids:
+            self.chat_ids.discard(chat_id)
+            await self.channel_layer.group_discard(chat_group(chat_id), self.channel_name)
+        else:
+            return
 
+        await self.send_frame({
+            "type": "membership",
+            "chat_id": chat_id,
+            "is_member": event["is_member"],
+        })
@@ -0,0 +1,42 @@
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from common.metrics import get_instrumentation
+from .frames import attach_frames
+from .hydration import is_slimmable, slim
+from .sync import record_event
+
+
+def chat_group(chat_id):
+    return f"chat_{chat_id}"
+
+
+async def publish(channel_layer, chat_id, event, buffered=True):
+    """
+    Send `event` to everyone subscribed to the chat, tagged with its chat_id.
+
+    Events carrying a seq are also kept in the chat's replay buffer for
+    clients that resume with a sync frame, unless `buffered` is False.
+    The outbound frame is encoded here once instead of once per recipient,
+    or, with CHANNEL_SLIM_EVENTS, only an envelope is sent and receiving
+    workers hydrate it (see hydration.py). The time taken is reported per
+    event type to the instrumentation.
+    """
+    started = time.perf_counter()
+    event_type = event["type"]
+    event["chat_id"] = int(chat_id)
+    if buffered and event.get("seq") is not None:
+        await record_event(chat_id, event)
+    if settings.CHANNEL_SLIM_EVENTS and is_slimmable(event):
+        event = slim(event)
+    else:
+        event = attach_frames(event)
+    await channel_layer.group_send(chat_group(chat_id), event)
+    get_instrumentation().published(event_type, time.perf_counter() - started)
+
+
+def publish_on_commit(chat_id, event):
+    """publish() from sync code (REST views) once the current transaction commits."""
+    transaction.on_commit(lambda: async_to_sync(publish)(get_channel_layer(), chat_id, event), robust=True)
@@ -0,0 +1,150 @@
+"""
+Outbound websocket frames built from channel layer events.
+
+publish() encodes the frame of an event once, for every codec listed in
+WS_PRECOMPUTED_CODECS, and ships only the encoded frames and the few
+fields consumers route on, so the payload crosses the channel layer once.
+Consumers forward the bytes to their socket; a connection using another
+codec re-encodes a precomputed frame. Events without frames (replayed
+events, direct sends) are built and encoded by the consumer.
+"""
+from django.conf import settings
+from common.codecs import get_codec
+
+
+def message_frame(event):
+    return {
+        "type": "message",
+        "chat_id": event["chat_id"],
+        "seq": event.get("seq"),
+        "message_id": event["message_id"],
+        "provisional_id": event.get("provisional_id"),
+        "client_msg_id": event.get("client_msg_id"),
+        "text": event["text"],
+        "sender": event["sender"],
+        "sender_id": event["sender_id"],
+        "forwarded": event.get("forwarded", False),
+        "forwarded_from": event.get("forwarded_from"),
+        "created_at": event["created_at"],
+    }
+
+
+def message_ack_frame(event):
+    return {
+        "type": "message_ack",
+        "chat_id": event["chat_id"],
+        "provisional_id": event["provisional_id"],
+        "client_msg_id": event.get("client_msg_id"),
+        "message_id": event["message_id"],
+        "created_at": event["created_at"],
+    }
+
+
+def message_commit_frame(event):
+    return {
+        "type": "message_commit",
+        "chat_id": event["chat_id"],
+        "seq": event.get("seq"),
+        "provisional_id": event["provisional_id"],
+        "client_msg_id": event.get("client_msg_id"),
+        "message_id": event["message_id"],
+        "created_at": event["created_at"],
+    }
+
+
+def message_failed_frame(event):
+    return {
+        "type": "message_failed",
+        "chat_id": event["chat_id"],
+        "provisional_id": event["provisional_id"],
+    }
+
+
+def typing_frame(event):
+    return {
+        "type": "typing",
+        "chat_id": event["chat_id"],
+        "users": event["users"],
+    }
+
+
+def read_frame(event):
+    return {
+        "type": "read",
+        "chat_id": event["chat_id"],
+        "seq": event.get("seq"),
+        "reads": event["reads"],
+    }
+
+
+def message_edit_frame(event):
+    return {
+        "type": "message_edit",
+        "chat_id": event["chat_id"],
+        "seq": event.get("seq"),
+        "message_id": event["message_id"],
+        "text": event["text"],
+    }
+
+
+def message_delete_frame(event):
+    return {
+        "type": "message_delete",
+        "chat_id": event["chat_id"],
+        "seq": event.get("seq"),
+        "message_id": event["message_id"],
+    }
+
+
+def user_status_frame(event):
+    return {
+        "type": "user_status",
+        "user_id": event["user_id"],
+        "is_online": event["is_online"],
+    }
+
+
+FRAME_BUILDERS = {
+    "chat_message": message_frame,
+    "message_ack": message_ack_frame,
+    "message_commit": message_commit_frame,
+    "message_failed": message_failed_frame,
+    "typing_update": typing_frame,
+    "read_update": read_frame,
+    "message_edit": message_edit_frame,
+    "message_delete": message_delete_frame,
+    "user_status": user_status_frame,
+}
+
+
+def build_frame(event):
+    return FRAME_BUILDERS[event["type"]](event)
+
+
+# Event fields consumers read besides type and chat_id.
+ROUTING_FIELDS = {
+    "typing_update": ("users",),
+}
+
+
+def attach_frames(event):
+    """
+    Return the routing fields of `event` with its encoded frame for each
+    precomputed codec; `event` is returned whole when there are none.
+    """
+    if not settings.WS_PRECOMPUTED_CODECS:
+        return event
+    frame = build_frame(event)
+    fields = ("type", "chat_id", *ROUTING_FIELDS.get(event["type"], ()))
+    routed = {field: event[field] for field in fields if field in event}
+    routed["frames"] = {
+        name: get_codec(name).encode(frame)
+        for name in settings.WS_PRECOMPUTED_CODECS
+    }
+    return routed
+
+
+def reencode(frames, codec):
+    """Encode a frame for `codec` from one precomputed for another codec."""
+    name, data = next(iter(frames.items()))
+    return codec.encode(get_codec(name).decode(data))
@@ -0,0 +1,83 @@
+"""
+Slim channel layer events.
+
+With CHANNEL_SLIM_EVENTS enabled, message and edit events cross the
+channel layer as a small envelope (type, chat id, message id, seq) and
+each worker hydrates them from a per-process LRU of message events. The
+publishing worker fills the cache when it sends. Any other worker loads a
+message from the database once, with concurrent lookups for the same
+message sharing one query. Layer traffic then no longer depends on
+message size. Encoded frames are cached per codec as well, so a worker
+encodes each message once no matter how many of its sockets receive it.
+"""
+import asyncio
+from django.conf import settings
+from common.db import database_primary_to_async
+from common.cache import TTLCache
+from .frames import build_frame
+
+SLIM_TYPES = ("chat_message", "message_edit")
+ENVELOPE_FIELDS = ("type", "chat_id", "message_id", "seq", "provisional_id", "client_msg_id")
+
+message_events = TTLCache(
+    maxsize=settings.MESSAGE_CACHE_SIZE,
+    ttl=settings.MESSAGE_CACHE_TTL,
+)
+encoded_frames = TTLCache(
+    maxsize=settings.MESSAGE_CACHE_SIZE,
+    ttl=settings.MESSAGE_CACHE_TTL,
+)
+
+_loading = {}
+
+
+def is_slimmable(event):
+    return event["type"] in SLIM_TYPES and event.get("message_id") is not None
+
+
+def slim(event):
+    message_events.set((event["message_id"], event.get("seq")), event)
+    envelope = {field: event[field] for field in ENVELOPE_FIELDS if field in event}
+    envelope["slim"] = True
+    return envelope
+
+
+def load_message_event(message_id):
+    from .models import Message
+    from .sync import message_fields
+
+    message = Message.objects.select_related('sender', 'forwarded_from__sender').filter(id=message_id).first()
+    return message_fields(message) if message else None
+
+
+async def hydrate(event):
+    """Return the full event for a slim envelope, or None if the message is gone."""
+    if not event.get("slim"):
+        return event
+
+    key = (event["message_id"], event.get("seq"))
+    cached = message_events.get(key)
+    if cached is None:
+        loading = _loading.get(key)
+        if loading is None:
+            loading = asyncio.ensure_future(database_primary_to_async(load_message_event)(event["message_id"]))
+            _loading[key] = loading
+            loading.add_done_callback(lambda _: _loading.pop(key, None))
+        cached = await asyncio.shield(loading)
+        if cached is None:
+            return None
+        message_events.set(key, cached)
+
+    return {**cached, **event}
+
+
+def encode_frame(event, codec):
+    if not event.get("slim"):
+        return codec.encode(build_frame(event))
+
+    key = (event["type"], event["message_id"], event.get("seq"), codec.name)
+    frame = encoded_frames.get(key)
+    if frame is None:
+        frame = codec.encode(build_frame(event))
+        encoded_frames.set(key, frame)
+    return frame
@@ -0,0 +1,71 @@
+"""
+Recently used client_msg_id keys.
+
+A retried send is answered from here without touching the database: the
+process-local cache is checked first, then (for websocket sends) the
+shared store so retries landing on another worker are caught as well.
+Once a key has expired from both, the database is the source of truth:
+send_message_once() looks the key up under services.lock_client_keys().
+"""
+from django.conf import settings
+from common.cache import TTLCache
+from common.store import get_store
+
+recent_messages = TTLCache(
+    maxsize=settings.CLIENT_MSG_ID_CACHE_SIZE,
+    ttl=settings.CLIENT_MSG_ID_CACHE_TTL,
+)
+
+
+def client_key(chat_id, sender_id, client_msg_id):
+    return f"msgkey:{chat_id}:{sender_id}:{client_msg_id}"
+
+
+def lookup_sync(chat_id, sender_id, client_msg_id):
+    return recent_messages.get(client_key(chat_id, sender_id, client_msg_id))
+
+
+def remember_sync(chat_id, sender_id, client_msg_id, value):
+    recent_messages.set(client_key(chat_id, sender_id, client_msg_id), str(value))
+
+
+async def lookup(chat_id, sender_id, client_msg_id):
+    key = client_key(chat_id, sender_id, client_msg_id)
+    cached = recent_messages.get(key)
+    if cached is None:
+        cached = await get_store().get(key)
+        if cached is not None:
+            recent_messages.set(key, cached)
+    return cached
+
+
+async def claim(chat_id, sender_id, client_msg_id, value):
+    """
+    Reserve the key for `value`.
+
+    Returns None when the key was free, otherwise whatever the first send
+    stored under it: a message id or, while that message is still being
+    written, its provisional id.
+    """
+    key = client_key(chat_id, sender_id, client_msg_id)
+    cached = recent_messages.get(key)
+    if cached is not None:
+        return cached
+
+    store = get_store()
+    if await store.set_if_absent(key, value, settings.CLIENT_MSG_ID_CACHE_TTL):
+        recent_messages.set(key, str(value))
+        return None
+    return await store.get(key)
+
+
+async def remember(chat_id, sender_id, client_msg_id, value):
+    key = client_key(chat_id, sender_id, client_msg_id)
+    recent_messages.set(key, str(value))
+    await get_store().set(key, value, settings.CLIENT_MSG_ID_CACHE_TTL)
+
+
+async def release(chat_id, sender_id, client_msg_id):
+    key = client_key(chat_id, sender_id, client_msg_id)
+    recent_messages.delete(key)
+    await get_store().delete(key)
@@ -0,0 +1,84 @@
+import calendar
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from chat_messages.archive import archive_range
+from chat_messages.models import Message
+from chat_messages.partitions import MESSAGE_TABLE, drop_partition, is_partitioned, last_message_id, list_partitions
+
+
+def months_ago(moment, months):
+    year, month = divmod(moment.year * 12 + moment.month - 1 - months, 12)
+    day = min(moment.day, calendar.monthrange(year, month + 1)[1])
+    return moment.replace(year=year, month=month + 1, day=day)
+
+
+class Command(BaseCommand):
+    help = "Move messages older than MESSAGE_ARCHIVE_AFTER_MONTHS into compressed MessageArchive blocks"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months",
+            type=int,
+            default=settings.MESSAGE_ARCHIVE_AFTER_MONTHS,
+            help="Archive messages older than this many months",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="Messages archived per transaction without partitioning",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be archived")
+
+    def handle(self, *args, **options):
+        cutoff = months_ago(timezone.now(), options["months"])
+        if is_partitioned():
+            archived, dropped = self.archive_partitions(cutoff, options["dry_run"])
+        else:
+            archived, dropped = self.archive_rows(cutoff, options["batch_size"], options["dry_run"]), 0
+
+        verb = "Would archive" if options["dry_run"] else "Archived"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {archived} messages older than {cutoff:%Y-%m-%d} ({dropped} partitions dropped)"
+        ))
+
+    def archive_partitions(self, cutoff, dry_run):
+        """Archive and drop whole partitions whose newest message is older than cutoff."""
+        archived = dropped = 0
+        next_id = last_message_id() + 1
+        for name, first, end in list_partitions(MESSAGE_TABLE):
+            start = first or 0
+            if end > next_id:
+                break
+            messages = Message.objects.filter(id__gte=start, id__lt=end)
+            # Ids grow with time: the last row of the range is its newest,
+            # found through the primary key instead of a scan.
+            newest = messages.order_by('-id').values_list('created_at', flat=True).first()
+            if newest is not None and newest >= cutoff:
+                break
+
+            if dry_run:
+                archived += messages.filter(is_deleted=False).count()
+            else:
+                with transaction.atomic():
+                    archived += archive_range(start, end)
+                    drop_partition(first)
+            dropped += 1
+            self.stdout.write(f"{name}: messages {start}-{end - 1}, newest {newest or '-'}")
+        return archived, dropped
+
+    def archive_rows(self, cutoff, batch_size, dry_run):
+        old = Message.objects.filter(created_at__lt=cutoff)
+        if dry_run:
+            return old.filter(is_deleted=False).count()
+
+        archived = 0
+        while True:
+            ids = list(old.order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return archived
+            with transaction.atomic():
+                archived += archive_range(ids[0], ids[-1] + 1, created_before=cutoff)
+                old.filter(id__gte=ids[0], id__lte=ids[-1]).delete()
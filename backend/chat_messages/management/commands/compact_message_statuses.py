@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat_messages.compaction import compact_statuses
+
+
+class Command(BaseCommand):
+    help = "Fold read MessageStatus rows past retention into the ChatReadState watermarks (run it regularly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention-days",
+            type=int,
+            default=settings.MESSAGE_STATUS_RETENTION_DAYS,
+            help="Keep per-recipient rows of messages newer than this many days",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100000,
+            help="Message ids whose statuses are deleted per transaction",
+        )
+
+    def handle(self, *args, **options):
+        bound, deleted = compact_statuses(options["retention_days"], options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Compacted {deleted} status rows of messages up to id {bound}"))
@@ -0,0 +1,55 @@
+import logging
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat_messages.partitions import create_partitions, headroom, is_partitioned
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the next message partitions on PostgreSQL; fails when less than one partition "
+        "of ids was left (run it regularly, or keep it running with --every)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ahead",
+            type=int,
+            help="Empty partitions to keep after the last message id (default MESSAGE_PARTITIONS_AHEAD)",
+        )
+        parser.add_argument(
+            "--every",
+            type=float,
+            help="Keep running and create partitions every this many seconds",
+        )
+
+    def handle(self, *args, **options):
+        if options["every"] is None:
+            self.create(options["ahead"])
+            return
+        while True:
+            try:
+                self.create(options["ahead"])
+            except Exception:
+                logger.exception("Could not keep message partitions ahead of the sends")
+            time.sleep(options["every"])
+
+    def create(self, ahead):
+        if not is_partitioned():
+            self.stdout.write("Messages are not partitioned on this database, nothing to do")
+            return
+
+        # Measured before topping up: what the sends since the last run left over.
+        left = headroom()
+        created = create_partitions(ahead)
+        for start, end in created:
+            self.stdout.write(f"Created partition for message ids {start}-{end - 1}")
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions"))
+
+        if left < settings.MESSAGE_PARTITION_SIZE:
+            raise CommandError(
+                f"Only {left} message ids were left before the last partition, sends fail past it: "
+                f"keep more partitions ahead (MESSAGE_PARTITIONS_AHEAD) or run this more often"
+            )
@@ -0,0 +1,68 @@
+# Generated by Django 5.2 on 2026-10-18 16:09
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Frozen here rather than read from settings: the trigger and the stored
+# vectors must not change with the environment the migration runs in.
+# Must match chat_messages.search.SEARCH_CONFIG.
+SEARCH_CONFIG = 'simple'
+
+
+def create_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute(f"""
+        CREATE OR REPLACE FUNCTION chat_messages_message_search_vector() RETURNS trigger AS $$
+        BEGIN
+            IF NEW.is_deleted THEN
+                NEW.search_vector := NULL;
+            ELSE
+                NEW.search_vector := to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.text, ''));
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+    """)
+    schema_editor.execute("""
+        CREATE TRIGGER chat_messages_message_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF text, is_deleted ON chat_messages_message
+        FOR EACH ROW EXECUTE FUNCTION chat_messages_message_search_vector();
+    """)
+    schema_editor.execute("""
+        UPDATE chat_messages_message
+        SET search_vector = to_tsvector(%s::regconfig, coalesce(text, ''))
+        WHERE NOT is_deleted;
+    """, [SEARCH_CONFIG])
+    schema_editor.execute("""
+        CREATE INDEX message_search_vector_idx
+        ON chat_messages_message USING gin (search_vector);
+    """)
+
+
+def drop_search_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute("DROP INDEX IF EXISTS message_search_vector_idx;")
+    schema_editor.execute(
+        "DROP TRIGGER IF EXISTS chat_messages_message_search_vector_trigger ON chat_messages_message;"
+    )
+    schema_editor.execute("DROP FUNCTION IF EXISTS chat_messages_message_search_vector();")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_messages', '0004_message_chat_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_trigger, drop_search_trigger),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def partition_messages(apps, schema_editor):
+    from chat_messages.partitions import create_partitions, is_partitioned, partition_tables
+
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql' or is_partitioned(connection):
+        return
+    partition_tables(connection)
+    create_partitions(using=connection)
+
+
+class Migration(migrations.Migration):
+    # Rewrites both tables; run it in a maintenance window on big databases.
+
+    dependencies = [
+        ('chat_messages', '0008_message_archive'),
+        ('chats', '0005_chat_last_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+from django.db import migrations, models
+
+
+def replace_unique_index(apps, schema_editor):
+    from chat_messages.partitions import MESSAGE_TABLE, is_partitioned
+
+    connection = schema_editor.connection
+    Message = apps.get_model('chat_messages', 'Message')
+    if is_partitioned(connection):
+        # 0009 left the unique index on each partition only, where it does
+        # not see duplicates in the other partitions.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE indexname = 'message_client_msg_id_uniq_legacy' "
+                "OR indexname LIKE %s",
+                [f"{MESSAGE_TABLE}_p%_client_msg_id_uniq"],
+            )
+            for (name,) in cursor.fetchall():
+                cursor.execute(f'DROP INDEX "{name}"')
+    else:
+        schema_editor.remove_constraint(Message, models.UniqueConstraint(
+            condition=models.Q(('client_msg_id__isnull', False)),
+            fields=['chat', 'sender', 'client_msg_id'],
+            name='message_client_msg_id_uniq',
+        ))
+    # On a partitioned table the index is created on every partition,
+    # including those added later.
+    schema_editor.add_index(Message, CLIENT_MSG_ID_INDEX)
+
+
+CLIENT_MSG_ID_INDEX = models.Index(
+    condition=models.Q(('client_msg_id__isnull', False)),
+    fields=['chat', 'sender', 'client_msg_id'],
+    name='message_client_msg_id_idx',
+)
+
+
+class Migration(migrations.Migration):
+    # Unique indexes on a partitioned table must contain the partition key,
+    # which would make this one useless. Keys are kept unique by
+    # services.lock_client_keys() instead; this index serves the lookups.
+
+    dependencies = [
+        ('chat_messages', '0009_message_partitions'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(replace_unique_index, migrations.RunPython.noop),
+            ],
+            state_operations=[
+                migrations.RemoveConstraint(
+                    model_name='message',
+                    name='message_client_msg_id_uniq',
+                ),
+                migrations.AddIndex(
+                    model_name='message',
+                    index=CLIENT_MSG_ID_INDEX,
+                ),
+            ],
+        ),
+    ]
@@ -1,8 +1,15 @@
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils import timezone
 from users.models import User
 from chats.models import Chat
 
+CLIENT_MSG_ID_MAX_LENGTH = 64
+
+class MessageManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().defer("search_vector")
+
 class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="messages")
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -21,6 +28,33 @@ class Message(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Idempotency key chosen by the client; a retried send with the same key
+    # returns the original message instead of creating a new one.
+    client_msg_id = models.CharField(max_length=CLIENT_MSG_ID_MAX_LENGTH, null=True, blank=True)
+
+    # Position in the chat's event sequence when the message was created
+    # and when it was last edited or deleted.
+    seq = models.BigIntegerField(null=True, blank=True, editable=False)
+    event_seq = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    # Maintained by a database trigger on PostgreSQL, see migration 0005.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "id"], name="message_chat_id_idx"),
+            models.Index(fields=["chat", "event_seq"], name="message_chat_event_seq_idx"),
+            # Not unique: on the partitioned table a unique index would need
+            # the id in it. services.lock_client_keys() keeps keys unique.
+            models.Index(
+                fields=["chat", "sender", "client_msg_id"],
+                condition=models.Q(client_msg_id__isnull=False),
+                name="message_client_msg_id_idx",
+            ),
+        ]
+
     def __str__(self):
         return f"{self.sender.username}: {self.text[:50]}"
 
@@ -60,3 +94,26 @@ class PinnedMessage(models.Model):
 
     def __str__(self):
         return f"Pinned: {self.message}"
+
+class MessageArchive(models.Model):
+    """
+    Messages moved out of the live tables by archive_messages: one row per
+    chat and block of up to MESSAGE_ARCHIVE_BLOCK_SIZE messages, stored as
+    zlib-compressed JSON of their to_dict(), oldest first.
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="message_archives")
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    data = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "last_message_id"], name="message_archive_chat_idx"),
+        ]
+
+    def __str__(self):
+        return f"Archive of chat {self.chat_id}: messages {self.first_message_id}-{self.last_message_id}"
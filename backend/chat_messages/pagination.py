@@ -0,0 +1,82 @@
+from rest_framework.exceptions import ValidationError
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def int_param(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValidationError({name: "Must be an integer"})
+    if value <= 0:
+        raise ValidationError({name: "Must be positive"})
+    return value
+
+
+def get_limit(params):
+    limit = int_param(params, 'limit') or DEFAULT_LIMIT
+    return min(limit, MAX_LIMIT)
+
+
+def paginate_history(queryset, params, archived=None):
+    """
+    Keyset pagination over message ids.
+
+    Supports ?before_id=, ?after_id= and ?around= cursors, all of which
+    resolve to a range scan on the (chat_id, id) index. Results are always
+    returned oldest first; pass prev_cursor back as before_id and
+    next_cursor as after_id to keep scrolling. `archived` (an
+    archive.ArchivedHistory) continues the history below the oldest row of
+    the queryset.
+    """
+    limit = get_limit(params)
+    before_id = int_param(params, 'before_id')
+    after_id = int_param(params, 'after_id')
+    around = int_param(params, 'around')
+
+    def older(before_id, count):
+        rows = queryset if before_id is None else queryset.filter(id__lt=before_id)
+        items = list(rows.order_by('-id')[:count])
+        if archived is not None and len(items) < count:
+            items += archived.older(items[-1].id if items else before_id, count - len(items))
+        return items
+
+    def newer(after_id, count, inclusive=False):
+        items = archived.newer(after_id, count, inclusive) if archived is not None else []
+        if len(items) < count:
+            rows = queryset.filter(id__gte=after_id) if inclusive else queryset.filter(id__gt=after_id)
+            if items:
+                rows = rows.filter(id__gt=items[-1].id)
+            items += list(rows.order_by('id')[:count - len(items)])
+        return items
+
+    if around is not None:
+        half = limit // 2
+        older_items = older(around, half + 1)
+        has_older = len(older_items) > half
+        older_items = older_items[:half]
+
+        newer_limit = limit - len(older_items)
+        newer_items = newer(around, newer_limit + 1, inclusive=True)
+        has_newer = len(newer_items) > newer_limit
+        items = older_items[::-1] + newer_items[:newer_limit]
+    elif after_id is not None:
+        items = newer(after_id, limit + 1)
+        has_newer = len(items) > limit
+        items = items[:limit]
+        has_older = bool(items) and bool(older(items[0].id, 1))
+    else:
+        items = older(before_id, limit + 1)
+        has_older = len(items) > limit
+        items = items[:limit][::-1]
+        has_newer = before_id is not None and bool(items) and bool(newer(items[-1].id, 1))
+
+    return {
+        "results": items,
+        "prev_cursor": items[0].id if items and has_older else None,
+        "next_cursor": items[-1].id if items and has_newer else None,
+    }
@@ -0,0 +1,226 @@
+"""
+Range partitions of the message tables on PostgreSQL.
+
+Message is partitioned by id and MessageStatus by message_id, with the
+same bounds, so the statuses of a block of messages live and go together.
+Partitioning on created_at would need (id, created_at) primary keys,
+which the foreign keys to Message cannot reference. Ids grow with time,
+so a partition still covers one stretch of history.
+
+Migration 0009 turns the existing tables into partitioned ones, the rows
+they already hold becoming the first partition. create_partitions() keeps
+MESSAGE_PARTITIONS_AHEAD empty partitions of MESSAGE_PARTITION_SIZE ids
+ready after the last allocated id. It runs in the migration and in the
+create_message_partitions command (on container start and every hour in the
+partitions service), never on the send path: the DDL locks the parent
+tables. There is no DEFAULT partition, since creating a partition would
+then have to move its rows out of it under that lock; an insert past the
+last partition fails instead. The command therefore fails loudly when it
+finds less than one partition of headroom() left.
+archive_messages detaches and drops partitions once their messages are
+archived.
+
+Unique indexes must contain the partition key, so client_msg_id has a
+plain index (migration 0010) and send_message_once() serializes each key
+with an advisory lock instead.
+"""
+import re
+from django.conf import settings
+from django.db import connection, transaction
+
+MESSAGE_TABLE = "chat_messages_message"
+STATUS_TABLE = "chat_messages_messagestatus"
+PARTITIONED_TABLES = ((MESSAGE_TABLE, "id"), (STATUS_TABLE, "message_id"))
+
+# pg_advisory_xact_lock key serializing partition creation across processes
+CREATE_LOCK_ID = 7340101
+
+_BOUND_RE = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+_COLUMNS_RE = re.compile(r"\(([^)]*)\)")
+
+
+def _bound(value):
+    value = value.strip("'")
+    return None if value in ("MINVALUE", "MAXVALUE") else int(value)
+
+
+def _covers(definition, key):
+    return key in _COLUMNS_RE.search(definition).group(1).split(", ")
+
+
+def is_partitioned(using=connection):
+    if using.vendor != "postgresql":
+        return False
+    with using.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [MESSAGE_TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def list_partitions(table, using=connection):
+    """Return [(name, start, end)] ordered by start; None stands for an open bound."""
+    with using.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = to_regclass(%s)
+            """,
+            [table],
+        )
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        start, end = _BOUND_RE.search(bound).groups()
+        partitions.append((name, _bound(start), _bound(end)))
+    return sorted(partitions, key=lambda partition: -1 if partition[1] is None else partition[1])
+
+
+def last_message_id(using=connection):
+    """The last id handed out by the Message sequence (0 before the first)."""
+    with using.cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(pg_sequence_last_value(pg_get_serial_sequence(%s, 'id')), 0)",
+            [MESSAGE_TABLE],
+        )
+        return cursor.fetchone()[0]
+
+
+def headroom(using=connection):
+    """How many more message ids fit before the last partition ends."""
+    return list_partitions(MESSAGE_TABLE, using)[-1][2] - last_message_id(using) - 1
+
+
+def create_partition(start, end, using=connection):
+    """Create the message and status partitions for ids in [start, end)."""
+    with using.cursor() as cursor:
+        for table, _ in PARTITIONED_TABLES:
+            cursor.execute(
+                f'CREATE TABLE "{table}_p{start}" PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+                [start, end],
+            )
+
+
+def create_partitions(ahead=None, using=connection):
+    """Add partitions until `ahead` of them lie past the last message id. Returns their bounds."""
+    if ahead is None:
+        ahead = settings.MESSAGE_PARTITIONS_AHEAD
+    size = settings.MESSAGE_PARTITION_SIZE
+
+    with transaction.atomic(using=using.alias):
+        with using.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CREATE_LOCK_ID])
+        start = list_partitions(MESSAGE_TABLE, using)[-1][2]
+        last_id = last_message_id(using)
+
+        created = []
+        while start <= last_id + ahead * size:
+            create_partition(start, start + size, using)
+            created.append((start, start + size))
+            start += size
+    return created
+
+
+def drop_partition(start, using=connection):
+    """Detach and drop the status and message partitions starting at `start`."""
+    with using.cursor() as cursor:
+        for table, _ in reversed(PARTITIONED_TABLES):
+            name = next(name for name, first, _ in list_partitions(table, using) if first == start)
+            cursor.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"')
+            cursor.execute(f'DROP TABLE "{name}"')
+
+
+def _foreign_keys(cursor, tables):
+    cursor.execute(
+        """
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f' AND (conrelid = ANY(%s::regclass[]) OR confrelid = ANY(%s::regclass[]))
+        """,
+        [list(tables), list(tables)],
+    )
+    return cursor.fetchall()
+
+
+def _partition_table(cursor, table, key, boundary):
+    legacy = f"{table}_legacy"
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+    old_sequence = cursor.fetchone()[0]
+    cursor.execute(f"SELECT last_value, is_called FROM {old_sequence}")
+    last_value, is_called = cursor.fetchone()
+
+    # Indexes keep their names on the new parent; the copies on the old
+    # table get attached to them below instead of being rebuilt.
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [table])
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        """
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype IN ('p', 'u')
+        """,
+        [table],
+    )
+    constraints = cursor.fetchall()
+    cursor.execute(
+        """
+        SELECT pg_get_indexdef(indexrelid) FROM pg_index
+        WHERE indrelid = %s::regclass AND NOT indisprimary
+        AND indexrelid NOT IN (SELECT conindid FROM pg_constraint WHERE conrelid = %s::regclass)
+        """,
+        [table, table],
+    )
+    index_defs = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{legacy}"')
+    for name, _ in constraints:
+        cursor.execute(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT "{name}" TO "{name[:56]}_legacy"')
+    for index in indexes:
+        if index not in {name for name, _ in constraints}:
+            cursor.execute(f'ALTER INDEX "{index}" RENAME TO "{index[:56]}_legacy"')
+    cursor.execute(f'ALTER TABLE "{legacy}" ALTER COLUMN id DROP IDENTITY')
+
+    cursor.execute(f'CREATE TABLE "{table}" (LIKE "{legacy}" INCLUDING DEFAULTS) PARTITION BY RANGE ({key})')
+    cursor.execute(f'CREATE SEQUENCE "{table}_id_seq" OWNED BY "{table}".id')
+    cursor.execute(f"SELECT setval('\"{table}_id_seq\"', %s, %s)", [last_value, is_called])
+    cursor.execute(f"ALTER TABLE \"{table}\" ALTER COLUMN id SET DEFAULT nextval('\"{table}_id_seq\"')")
+    cursor.execute(
+        f'ALTER TABLE "{table}" ATTACH PARTITION "{legacy}" FOR VALUES FROM (MINVALUE) TO (%s)',
+        [boundary],
+    )
+
+    for name, definition in constraints:
+        if not _covers(definition, key):
+            if not definition.startswith("PRIMARY KEY"):
+                # Dropped with the old table, see the module docstring.
+                continue
+            cursor.execute(f'ALTER TABLE "{legacy}" DROP CONSTRAINT "{name[:56]}_legacy"')
+            definition = f"PRIMARY KEY (id, {key})"
+        cursor.execute(f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" {definition}')
+    for definition in index_defs:
+        if definition.startswith("CREATE UNIQUE") and not _covers(definition, key):
+            continue
+        cursor.execute(definition)
+
+
+def partition_tables(using=connection):
+    """Turn the message tables into partitioned ones holding their current rows."""
+    tables = [table for table, _ in PARTITIONED_TABLES]
+    with using.cursor() as cursor:
+        foreign_keys = _foreign_keys(cursor, tables)
+        for relation, name, _ in foreign_keys:
+            cursor.execute(f'ALTER TABLE {relation} DROP CONSTRAINT "{name}"')
+        cursor.execute("DROP TRIGGER IF EXISTS chat_messages_message_search_vector_trigger ON chat_messages_message")
+
+        boundary = last_message_id(using) + 1
+        for table, key in PARTITIONED_TABLES:
+            _partition_table(cursor, table, key, boundary)
+
+        cursor.execute("""
+            CREATE TRIGGER chat_messages_message_search_vector_trigger
+            BEFORE INSERT OR UPDATE OF text, is_deleted ON chat_messages_message
+            FOR EACH ROW EXECUTE FUNCTION chat_messages_message_search_vector()
+        """)
+        for relation, name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {relation} ADD CONSTRAINT "{name}" {definition}')
@@ -0,0 +1,154 @@
+"""
+Read receipt aggregation.
+
+Clients send read frames on every scroll. Frames are folded into the
+highest watermark per (chat, user) and written every
+READ_RECEIPT_FLUSH_INTERVAL seconds with one upsert, followed by a single
+consolidated read_update per chat.
+
+The flushing task runs until nothing is pending, so reads that arrive
+while a batch is being written go out with the next one. A batch that
+fails to write is retried one (chat, user) at a time, so a single bad key
+(a deleted chat, say) cannot hold back the others; a key that keeps
+failing is dropped after READ_RECEIPT_MAX_ATTEMPTS flushes. Sockets flush
+their user's reads when they close, and whatever is left when the process
+exits is written synchronously.
+"""
+import asyncio
+import atexit
+import logging
+from collections import defaultdict
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from common.db import database_write_to_async
+from .events import publish, publish_on_commit
+
+logger = logging.getLogger(__name__)
+
+
+class ReadReceiptAggregator:
+    def __init__(self):
+        self._pending = {}
+        self._attempts = {}
+        self._task = None
+
+    def submit(self, chat_id, user_id, last_id):
+        key = (chat_id, user_id)
+        if last_id > self._pending.get(key, 0):
+            self._pending[key] = last_id
+            self._ensure_task()
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        try:
+            # No await between the check and returning: a submit() either
+            # lands before it or finds the task done and starts a new one.
+            while self._pending:
+                await asyncio.sleep(settings.READ_RECEIPT_FLUSH_INTERVAL)
+                await self.flush()
+        except asyncio.CancelledError:
+            await database_write_to_async(self.drain)()
+            raise
+
+    def _merge(self, pending):
+        for key, last_id in pending.items():
+            if last_id > self._pending.get(key, 0):
+                self._pending[key] = last_id
+
+    async def flush(self, user_id=None):
+        """Write the pending reads, only those of `user_id` when given."""
+        if user_id is None:
+            pending, self._pending = self._pending, {}
+        else:
+            pending = {key: self._pending.pop(key) for key in list(self._pending) if key[1] == user_id}
+        if not pending:
+            return
+
+        try:
+            advanced, seqs = await self._write(pending)
+        except asyncio.CancelledError:
+            self._merge(pending)
+            raise
+
+        reads = defaultdict(list)
+        for (chat_id, user_id), last_id in advanced.items():
+            reads[chat_id].append({"user_id": user_id, "last_read_message_id": last_id})
+
+        layer = get_channel_layer()
+        for chat_id, chat_reads in reads.items():
+            await publish(layer, chat_id, {"type": "read_update", "seq": seqs[chat_id], "reads": chat_reads})
+
+    async def _write(self, pending):
+        """Write a batch, falling back to one key at a time when it fails."""
+        if len(pending) > 1:
+            try:
+                advanced, seqs = await database_write_to_async(apply_reads)(pending)
+            except Exception:
+                logger.warning("Failed to write %s read receipts, retrying one by one", len(pending), exc_info=True)
+            else:
+                for key in pending:
+                    self._attempts.pop(key, None)
+                return advanced, seqs
+
+        advanced, seqs = {}, {}
+        for key, last_id in pending.items():
+            try:
+                key_advanced, key_seqs = await database_write_to_async(apply_reads)({key: last_id})
+            except Exception:
+                self._failed(key, last_id)
+                continue
+            self._attempts.pop(key, None)
+            advanced.update(key_advanced)
+            seqs.update(key_seqs)
+        return advanced, seqs
+
+    def _failed(self, key, last_id):
+        attempts = self._attempts.pop(key, 0) + 1
+        if attempts >= settings.READ_RECEIPT_MAX_ATTEMPTS:
+            logger.exception("Dropping read receipt of user %s in chat %s after %s attempts", key[1], key[0], attempts)
+            return
+        logger.exception("Failed to write read receipt of user %s in chat %s, retrying", key[1], key[0])
+        self._attempts[key] = attempts
+        self._merge({key: last_id})
+        self._ensure_task()
+
+    def drain(self):
+        """Synchronously write the pending reads, without broadcasting them."""
+        pending, self._pending = self._pending, {}
+        if pending:
+            apply_reads(pending)
+        return len(pending)
+
+
+def apply_reads(pending):
+    from .services import allocate_seq, mark_read_many
+
+    with transaction.atomic():
+        advanced = mark_read_many(pending)
+        seqs = {chat_id: allocate_seq(chat_id) for chat_id in {chat_id for chat_id, _ in advanced}}
+    return advanced, seqs
+
+
+def read_now(chat_id, user_id, last_id):
+    """
+    Apply one read right away (REST reads), bypassing the aggregator but not
+    its path: locked and monotonic, with the read_update published on commit.
+    Returns whether the watermark moved.
+    """
+    advanced, seqs = apply_reads({(chat_id, user_id): last_id})
+    if advanced:
+        publish_on_commit(chat_id, {
+            "type": "read_update",
+            "seq": seqs[chat_id],
+            "reads": [{"user_id": user_id, "last_read_message_id": advanced[(chat_id, user_id)]}],
+        })
+    return bool(advanced)
+
+
+read_receipts = ReadReceiptAggregator()
+atexit.register(read_receipts.drain)
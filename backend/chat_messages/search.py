@@ -0,0 +1,248 @@
+"""
+Message search.
+
+On PostgreSQL messages are matched against the trigger-maintained
+`search_vector` column (GIN indexed) and ranked with ts_rank. Other
+databases, SQLite in tests in particular, can use an in-process inverted
+index with the same tokenization and prefix semantics. It is built from the
+database on the first search, but afterwards only sees writes made by its
+own process, so it is only enabled by MESSAGE_SEARCH_IN_MEMORY (tests and
+single-process local runs).
+"""
+import bisect
+import re
+import threading
+from collections import Counter
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast
+from rest_framework.exceptions import ValidationError
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Text search configuration of the search_vector trigger (migration 0005).
+# Changing it needs a migration that recreates the trigger and the vectors.
+SEARCH_CONFIG = "simple"
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or "").lower())
+
+
+def encode_cursor(rank, message_id):
+    return f"{rank!r}:{message_id}"
+
+
+def decode_cursor(cursor):
+    try:
+        rank, message_id = cursor.split(":")
+        return float(rank), int(message_id)
+    except (AttributeError, ValueError):
+        raise ValidationError({"cursor": "Invalid cursor"})
+
+
+def _page(ranked, limit):
+    """`ranked` is a list of (rank, message) ordered by rank desc, id desc."""
+    next_cursor = None
+    if len(ranked) > limit:
+        ranked = ranked[:limit]
+        rank, message = ranked[-1]
+        next_cursor = encode_cursor(rank, message.id)
+    return {
+        "results": [message for _, message in ranked],
+        "next_cursor": next_cursor,
+    }
+
+
+class PostgresSearchBackend:
+    def search(self, user, query, chat_id=None, sender_id=None, cursor=None, limit=50):
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+        from .models import Message
+
+        terms = tokenize(query)
+        if not terms:
+            return {"results": [], "next_cursor": None}
+
+        tsquery = SearchQuery(
+            " & ".join(f"{term}:*" for term in terms),
+            config=SEARCH_CONFIG,
+            search_type="raw",
+        )
+        qs = Message.objects.filter(
+            chat__members=user,
+            is_deleted=False,
+            search_vector=tsquery,
+        ).annotate(
+            # ts_rank is a real; as double precision it survives the trip
+            # through the cursor exactly, so ties compare equal.
+            rank=Cast(SearchRank(F("search_vector"), tsquery), FloatField())
+        ).select_related("sender", "chat")
+
+        if chat_id:
+            qs = qs.filter(chat_id=chat_id)
+        if sender_id:
+            qs = qs.filter(sender_id=sender_id)
+        if cursor:
+            rank, message_id = decode_cursor(cursor)
+            qs = qs.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=message_id))
+
+        messages = qs.order_by("-rank", "-id")[:limit + 1]
+        return _page([(m.rank, m) for m in messages], limit)
+
+    def index_message(self, message):
+        pass
+
+    def remove_message(self, message_id):
+        pass
+
+
+class InMemorySearchBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built = False
+        self._postings = {}
+        self._terms = []
+        self._docs = {}
+
+    def _add(self, message_id, chat_id, sender_id, text):
+        counts = Counter(tokenize(text))
+        self._docs[message_id] = (chat_id, sender_id, counts)
+        for term in counts:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = set()
+                bisect.insort(self._terms, term)
+            postings.add(message_id)
+
+    def _remove(self, message_id):
+        doc = self._docs.pop(message_id, None)
+        if doc is None:
+            return
+        for term in doc[2]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.discard(message_id)
+
+    def _build(self):
+        from .models import Message
+
+        rows = Message.objects.filter(is_deleted=False).values_list(
+            "id", "chat_id", "sender_id", "text"
+        )
+        for message_id, chat_id, sender_id, text in rows.iterator():
+            self._add(message_id, chat_id, sender_id, text)
+        self._built = True
+
+    def _match_prefix(self, prefix):
+        matched = set()
+        start = bisect.bisect_left(self._terms, prefix)
+        for term in self._terms[start:]:
+            if not term.startswith(prefix):
+                break
+            matched |= self._postings[term]
+        return matched
+
+    def _rank(self, message_id, terms):
+        counts = self._docs[message_id][2]
+        hits = sum(
+            count for term, count in counts.items()
+            if any(term.startswith(prefix) for prefix in terms)
+        )
+        return hits / (1 + sum(counts.values()))
+
+    def search(self, user, query, chat_id=None, sender_id=None, cursor=None, limit=50):
+        from chats.models import Chat
+        from .models import Message
+
+        terms = tokenize(query)
+        if not terms:
+            return {"results": [], "next_cursor": None}
+
+        chat_ids = set(Chat.objects.filter(members=user).values_list("id", flat=True))
+        if chat_id:
+            chat_ids &= {int(chat_id)}
+
+        with self._lock:
+            if not self._built:
+                self._build()
+
+            candidates = None
+            for term in terms:
+                matched = self._match_prefix(term)
+                candidates = matched if candidates is None else candidates & matched
+
+            ranked = []
+            for message_id in candidates:
+                doc_chat_id, doc_sender_id, _ = self._docs[message_id]
+                if doc_chat_id not in chat_ids:
+                    continue
+                if sender_id and doc_sender_id != int(sender_id):
+                    continue
+                ranked.append((self._rank(message_id, terms), message_id))
+
+        ranked.sort(key=lambda item: (-item[0], -item[1]))
+        if cursor:
+            rank, last_id = decode_cursor(cursor)
+            ranked = [
+                item for item in ranked
+                if item[0] < rank or (item[0] == rank and item[1] < last_id)
+            ]
+        ranked = ranked[:limit + 1]
+
+        messages = Message.objects.select_related("sender", "chat").in_bulk(
+            [message_id for _, message_id in ranked]
+        )
+        return _page(
+            [(rank, messages[message_id]) for rank, message_id in ranked if message_id in messages],
+            limit,
+        )
+
+    def index_message(self, message):
+        with self._lock:
+            if not self._built:
+                return
+            self._remove(message.id)
+            if not message.is_deleted:
+                self._add(message.id, message.chat_id, message.sender_id, message.text)
+
+    def remove_message(self, message_id):
+        with self._lock:
+            self._remove(message_id)
+
+
+_postgres_backend = PostgresSearchBackend()
+_memory_backend = InMemorySearchBackend()
+
+
+def get_backend():
+    if connection.vendor == "postgresql":
+        return _postgres_backend
+    if settings.MESSAGE_SEARCH_IN_MEMORY:
+        return _memory_backend
+    raise ImproperlyConfigured(
+        "Message search needs PostgreSQL; set MESSAGE_SEARCH_IN_MEMORY for tests and local runs"
+    )
+
+
+def _memory_index():
+    if connection.vendor != "postgresql" and settings.MESSAGE_SEARCH_IN_MEMORY:
+        return _memory_backend
+    return None
+
+
+def search_messages(user, query, **kwargs):
+    return get_backend().search(user, query, **kwargs)
+
+
+def index_message(message):
+    backend = _memory_index()
+    if backend is not None:
+        transaction.on_commit(lambda: backend.index_message(message))
+
+
+def remove_message(message_id):
+    backend = _memory_index()
+    if backend is not None:
+        transaction.on_commit(lambda: backend.remove_message(message_id))
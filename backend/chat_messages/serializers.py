@@ -1,5 +1,7 @@
+from drf_spectacular.utils import extend_schema_field
 from rest_framework import serializers
 from .models import Message, MessageStatus, PinnedMessage
+from .statuses import synthesized_statuses
 
 class MessageStatusSerializer(serializers.ModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
@@ -10,7 +12,7 @@ class MessageStatusSerializer(serializers.ModelSerializer):
 
 class MessageSerializer(serializers.ModelSerializer):
     sender_username = serializers.CharField(source='sender.username', read_only=True)
-    statuses = MessageStatusSerializer(many=True, read_only=True)
+    statuses = serializers.SerializerMethodField()
     forwarded_from_username = serializers.CharField(
         source='forwarded_from.sender.username',
         read_only=True
@@ -34,6 +36,13 @@ class MessageSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['sender', 'is_edited', 'edited_at', 'is_deleted']
 
+    @extend_schema_field(MessageStatusSerializer(many=True))
+    def get_statuses(self, message):
+        statuses = MessageStatusSerializer(message.statuses.all(), many=True).data
+        # Recipients without a row (large chats, compacted reads) come from the watermarks.
+        cache = self.context.setdefault("read_watermarks", {})
+        return statuses + synthesized_statuses(message, {status["user"] for status in statuses}, cache)
+
 class PinnedMessageSerializer(serializers.ModelSerializer):
     message = MessageSerializer(read_only=True)
     pinned_by_username = serializers.CharField(source='pinned_by.username', read_only=True)
@@ -0,0 +1,318 @@
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from chats import summaries
+from chats.models import Chat, ChatReadState
+from common.db_routing import mark_written
+from common.metrics import get_instrumentation
+from users.models import User
+from . import search
+from .models import Message, MessageStatus
+
+
+def get_member_ids(chat_id):
+    return list(
+        Chat.members.through.objects.filter(chat_id=chat_id)
+        .values_list('user_id', flat=True)
+    )
+
+
+def allocate_seq(chat_id, count=1):
+    """
+    Reserve `count` consecutive event sequence numbers of a chat and
+    return the first one. Must run inside a transaction: the row lock
+    taken by the UPDATE keeps the sequence gap-free and ordered.
+    """
+    Chat.objects.filter(id=chat_id).update(last_seq=F('last_seq') + count)
+    last_seq = Chat.objects.filter(id=chat_id).values_list('last_seq', flat=True).get()
+    return last_seq - count + 1
+
+
+def fan_out(messages):
+    """
+    Write delivery state for freshly inserted messages.
+
+    Small chats get one MessageStatus row per recipient, written with
+    bulk_create. Chats above MESSAGE_STATUS_WATERMARK_THRESHOLD only move
+    the chat-wide delivered watermark on the Chat row, already locked by
+    allocate_seq(), so a send writes the same rows whatever the chat size.
+    """
+    by_chat = defaultdict(list)
+    for message in messages:
+        by_chat[message.chat_id].append(message)
+
+    now = timezone.now()
+    statuses = []
+    members = {}
+    instrumentation = get_instrumentation()
+    for chat_id, chat_messages in by_chat.items():
+        member_ids = members[chat_id] = get_member_ids(chat_id)
+        for _ in chat_messages:
+            instrumentation.fan_out("chat_message", len(member_ids) - 1)
+        if len(member_ids) - 1 > settings.MESSAGE_STATUS_WATERMARK_THRESHOLD:
+            last_id = max(message.id for message in chat_messages)
+            Chat.objects.filter(
+                id=chat_id,
+                delivered_message_id__lt=last_id
+            ).update(
+                delivered_message_id=last_id
+            )
+            continue
+
+        statuses.extend(
+            MessageStatus(
+                message=message,
+                user_id=user_id,
+                delivered=True,
+                delivered_at=now,
+            )
+            for message in chat_messages
+            for user_id in member_ids
+            if user_id != message.sender_id
+        )
+
+    MessageStatus.objects.bulk_create(statuses, batch_size=settings.MESSAGE_STATUS_BATCH_SIZE)
+    summaries.record_messages(messages, members)
+    for message in messages:
+        search.index_message(message)
+
+
+def send_message(chat_id, sender, text, forwarded_from=None, client_msg_id=None):
+    """Persist a message and its delivery state in a single transaction."""
+    with transaction.atomic():
+        seq = allocate_seq(chat_id)
+        message = Message.objects.create(
+            chat_id=chat_id,
+            seq=seq,
+            event_seq=seq,
+            sender_id=sender.id,
+            text=text,
+            forwarded_from=forwarded_from,
+            forwarded_by_id=sender.id if forwarded_from else None,
+            client_msg_id=client_msg_id,
+        )
+        if isinstance(sender, User):
+            message.sender = sender
+        fan_out([message])
+        mark_written(sender.id)
+
+    return message
+
+
+def find_sent(chat_id, sender_id, client_msg_id):
+    return Message.objects.select_related('sender').filter(
+        chat_id=chat_id,
+        sender_id=sender_id,
+        client_msg_id=client_msg_id
+    ).first()
+
+
+def lock_client_keys(keys):
+    """
+    Hold (chat_id, sender_id, client_msg_id) keys until the transaction
+    ends, so concurrent sends of one key check and insert in turn.
+
+    This lock is the only thing keeping keys unique: the client_msg_id
+    index is not unique, see partitions.py. Other databases (SQLite in
+    tests and benchmarks) serialize write transactions by themselves.
+    """
+    if not keys or connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(key) FROM ("
+            "SELECT DISTINCT hashtextextended(name, 0) AS key FROM unnest(%s::text[]) AS name ORDER BY key"
+            ") AS keys",
+            [[f"{chat_id}:{sender_id}:{client_msg_id}" for chat_id, sender_id, client_msg_id in keys]],
+        )
+
+
+def send_message_once(chat_id, sender, text, client_msg_id=None):
+    """
+    send_message() deduplicated on the client's idempotency key.
+
+    Returns (message, created); a retry gets back the message stored by
+    the first attempt.
+    """
+    if client_msg_id is None:
+        return send_message(chat_id, sender, text), True
+
+    message = find_sent(chat_id, sender.id, client_msg_id)
+    if message:
+        return message, False
+    with transaction.atomic():
+        lock_client_keys([(chat_id, sender.id, client_msg_id)])
+        message = find_sent(chat_id, sender.id, client_msg_id)
+        if message:
+            return message, False
+        return send_message(chat_id, sender, text, client_msg_id=client_msg_id), True
+
+
+def _client_key(message):
+    if message.client_msg_id is None:
+        return None
+    return (message.chat_id, message.sender_id, message.client_msg_id)
+
+
+def send_messages_bulk(messages):
+    """
+    Insert unsaved Message instances with one bulk_create and fan them out.
+
+    Messages whose client_msg_id was already stored (or repeats within the
+    batch) are not inserted again; the stored message takes their place in
+    the returned list.
+    """
+    keys = {_client_key(message) for message in messages} - {None}
+    with transaction.atomic():
+        lock_client_keys(keys)
+        existing = {}
+        if keys:
+            existing = {
+                _client_key(message): message
+                for message in Message.objects.filter(
+                    sender_id__in={key[1] for key in keys},
+                    client_msg_id__in={key[2] for key in keys},
+                )
+                if _client_key(message) in keys
+            }
+
+        fresh = []
+        for message in messages:
+            key = _client_key(message)
+            if key is None:
+                fresh.append(message)
+            elif key not in existing:
+                existing[key] = message
+                fresh.append(message)
+
+        by_chat = defaultdict(list)
+        for message in fresh:
+            by_chat[message.chat_id].append(message)
+        for chat_id, chat_messages in by_chat.items():
+            seq = allocate_seq(chat_id, len(chat_messages))
+            for offset, message in enumerate(chat_messages):
+                message.seq = message.event_seq = seq + offset
+
+        Message.objects.bulk_create(fresh)
+        fan_out(fresh)
+        mark_written(*{message.sender_id for message in fresh})
+
+    return [existing.get(_client_key(message), message) for message in messages]
+
+
+def edit_message(message, text):
+    with transaction.atomic():
+        message.text = text
+        message.is_edited = True
+        message.edited_at = timezone.now()
+        message.event_seq = allocate_seq(message.chat_id)
+        message.save(update_fields=['text', 'is_edited', 'edited_at', 'event_seq'])
+        summaries.record_edit(message)
+        search.index_message(message)
+        mark_written(message.sender_id)
+    return message
+
+
+def delete_message(message):
+    with transaction.atomic():
+        message.is_deleted = True
+        message.text = "Message deleted"
+        message.event_seq = allocate_seq(message.chat_id)
+        message.save(update_fields=['is_deleted', 'text', 'event_seq'])
+        summaries.record_edit(message)
+        search.remove_message(message.id)
+        mark_written(message.sender_id)
+    return message
+
+
+def locked_read_states(keys):
+    """{(chat_id, user_id): (last_read, last_delivered)} of the given keys, locked for update."""
+    return {
+        (chat_id, user_id): (last_read, last_delivered)
+        for chat_id, user_id, last_read, last_delivered in ChatReadState.objects.select_for_update().filter(
+            chat_id__in={chat_id for chat_id, _ in keys},
+            user_id__in={user_id for _, user_id in keys},
+        ).order_by('chat_id', 'user_id').values_list(
+            'chat_id', 'user_id', 'last_read_message_id', 'last_delivered_message_id'
+        )
+    }
+
+
+def mark_read_many(watermarks):
+    """
+    Apply {(chat_id, user_id): last_read_message_id} in one go.
+
+    Read states are upserted with a single statement and MessageStatus rows
+    are only touched for the id range each watermark actually advanced
+    over. Watermarks past the newest message of their chat (websocket
+    clients send them unchecked) are lowered to it. Returns the watermarks
+    that moved forward.
+    """
+    watermarks = {key: last_id for key, last_id in watermarks.items() if last_id > 0}
+    if not watermarks:
+        return {}
+
+    newest = dict(
+        Message.objects.filter(chat_id__in={chat_id for chat_id, _ in watermarks})
+        .values('chat_id').annotate(newest=Max('id')).values_list('chat_id', 'newest')
+    )
+    watermarks = {
+        (chat_id, user_id): min(last_id, newest.get(chat_id, 0))
+        for (chat_id, user_id), last_id in watermarks.items()
+        if newest.get(chat_id)
+    }
+    if not watermarks:
+        return {}
+
+    with transaction.atomic():
+        # The rows are locked before the watermarks are compared, so two
+        # concurrent batches cannot move a watermark backwards.
+        current = locked_read_states(watermarks)
+        missing = [key for key in watermarks if key not in current]
+        if missing:
+            ChatReadState.objects.bulk_create(
+                [ChatReadState(chat_id=chat_id, user_id=user_id) for chat_id, user_id in missing],
+                ignore_conflicts=True,
+            )
+            current.update(locked_read_states(missing))
+
+        advanced = {
+            key: last_id for key, last_id in watermarks.items()
+            if last_id > current.get(key, (0, 0))[0]
+        }
+        if not advanced:
+            return {}
+
+        ChatReadState.objects.bulk_create(
+            [
+                ChatReadState(
+                    chat_id=chat_id,
+                    user_id=user_id,
+                    last_read_message_id=last_id,
+                    last_delivered_message_id=max(last_id, current.get((chat_id, user_id), (0, 0))[1]),
+                )
+                for (chat_id, user_id), last_id in advanced.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['chat', 'user'],
+            update_fields=['last_read_message_id', 'last_delivered_message_id'],
+        )
+
+        now = timezone.now()
+        for (chat_id, user_id), last_id in advanced.items():
+            MessageStatus.objects.filter(
+                message__chat_id=chat_id,
+                message_id__gt=current.get((chat_id, user_id), (0, 0))[0],
+                message_id__lte=last_id,
+                user_id=user_id,
+                read=False
+            ).update(
+                read=True,
+                read_at=now
+            )
+            summaries.record_read(chat_id, user_id, last_id)
+        mark_written(*{user_id for _, user_id in advanced})
+
+    return advanced
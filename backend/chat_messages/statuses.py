@@ -0,0 +1,44 @@
+"""
+Statuses synthesized from the ChatReadState watermarks.
+
+Two kinds of messages lack MessageStatus rows: those of chats above
+MESSAGE_STATUS_WATERMARK_THRESHOLD, whose sends only move
+Chat.delivered_message_id, and the read ones folded into the watermarks
+by compact_statuses(). Serializers fill the missing recipients in from
+the chat's read states, without delivered/read times.
+"""
+from chats.models import ChatReadState
+
+
+def read_watermarks(chat_id, cache):
+    """[(user_id, username, last_read_message_id)] of a chat, once per `cache`."""
+    if chat_id not in cache:
+        cache[chat_id] = list(
+            ChatReadState.objects.filter(chat_id=chat_id)
+            .values_list('user_id', 'user__username', 'last_read_message_id')
+        )
+    return cache[chat_id]
+
+
+def synthesized_statuses(message, present_user_ids, cache):
+    """Status dicts for the recipients of a message that have no MessageStatus row."""
+    chat = message.chat
+    # Sent while the chat was large: no recipient got a row.
+    large = not present_user_ids and message.id <= chat.delivered_message_id
+    if not large and message.id > chat.statuses_compacted_message_id:
+        return []
+
+    statuses = []
+    for user_id, username, last_read in read_watermarks(message.chat_id, cache):
+        read = last_read >= message.id
+        if user_id == message.sender_id or user_id in present_user_ids or not (read or large):
+            continue
+        statuses.append({
+            "user": user_id,
+            "username": username,
+            "delivered": True,
+            "read": read,
+            "delivered_at": None,
+            "read_at": None,
+        })
+    return statuses
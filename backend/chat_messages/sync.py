@@ -0,0 +1,103 @@
+"""
+Replay of missed chat events for reconnecting clients.
+
+Messages, edits, deletes and read updates each take the next number of
+their chat's sequence (Chat.last_seq). Published events are also kept in
+a bounded per-chat buffer in the shared store: the last SYNC_BUFFER_SIZE
+events, for SYNC_BUFFER_TTL seconds. A client resuming with since_seq
+gets the buffered events after it if the buffer covers since_seq + 1 up to
+the chat's last_seq without holes. Otherwise the changes are rebuilt from the (chat, event_seq) index
+on Message plus the chat's current read watermarks.
+"""
+import json
+from django.conf import settings
+from common.db import database_primary_to_async
+from common.store import get_store
+
+
+def events_key(chat_id):
+    return f"events:{chat_id}"
+
+
+async def record_event(chat_id, event):
+    store = get_store()
+    key = events_key(chat_id)
+    await store.zadd(key, event["seq"], json.dumps(event))
+    await store.ztrim(key, settings.SYNC_BUFFER_SIZE)
+    await store.expire(key, settings.SYNC_BUFFER_TTL)
+
+
+async def replay(chat_id, since_seq):
+    """Return (events, complete) for the events of a chat after since_seq."""
+    last_seq = await database_primary_to_async(chat_last_seq)(chat_id)
+    if last_seq <= since_seq:
+        return [], True
+
+    events = {}
+    for entry in await get_store().zrangebyscore(events_key(chat_id), since_seq + 1):
+        event = json.loads(entry)
+        events.setdefault(event["seq"], event)
+
+    seqs = sorted(events)
+    if seqs == list(range(since_seq + 1, since_seq + 1 + len(seqs))) and seqs and seqs[-1] >= last_seq:
+        return [events[seq] for seq in seqs], True
+    return await database_primary_to_async(events_from_db)(chat_id, since_seq)
+
+
+def chat_last_seq(chat_id):
+    from chats.models import Chat
+    return Chat.objects.filter(id=chat_id).values_list('last_seq', flat=True).first() or 0
+
+
+def message_fields(message):
+    """Event fields of a chat_message for a message loaded with its senders."""
+    return {
+        "chat_id": message.chat_id,
+        "message_id": message.id,
+        "client_msg_id": message.client_msg_id,
+        "text": message.text,
+        "sender": message.sender.username,
+        "sender_id": message.sender_id,
+        "forwarded": message.forwarded_from_id is not None,
+        "forwarded_from": message.forwarded_from.sender.username if message.forwarded_from else None,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def message_change_event(message, since_seq):
+    event = {"chat_id": message.chat_id, "seq": message.event_seq, "message_id": message.id}
+
+    if message.is_deleted:
+        event["type"] = "message_delete"
+    elif message.seq is not None and message.seq > since_seq:
+        event.update(message_fields(message), type="chat_message")
+    else:
+        event.update({"type": "message_edit", "text": message.text})
+    return event
+
+
+def events_from_db(chat_id, since_seq):
+    from chats.models import ChatReadState
+    from .models import Message
+
+    last_seq = chat_last_seq(chat_id)
+    if last_seq <= since_seq:
+        return [], True
+
+    messages = list(
+        Message.objects.filter(chat_id=chat_id, event_seq__gt=since_seq)
+        .select_related('sender', 'forwarded_from__sender')
+        .order_by('event_seq')[:settings.SYNC_MAX_EVENTS + 1]
+    )
+    complete = len(messages) <= settings.SYNC_MAX_EVENTS
+    events = [message_change_event(message, since_seq) for message in messages[:settings.SYNC_MAX_EVENTS]]
+
+    if complete:
+        reads = [
+            {"user_id": user_id, "last_read_message_id": last_id}
+            for user_id, last_id in ChatReadState.objects.filter(chat_id=chat_id, last_read_message_id__gt=0)
+            .values_list('user_id', 'last_read_message_id')
+        ]
+        if reads:
+            events.append({"type": "read_update", "chat_id": chat_id, "seq": last_seq, "reads": reads})
+    return events, complete
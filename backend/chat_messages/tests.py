@@ -0,0 +1,857 @@
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from chats import membership, summaries
+from chats.models import Chat, ChatReadState
+from common.codecs import CODECS
+from common.db import database_sync_to_async
+from common.store import get_store
+from common.testing import api_client, create_group, create_user, create_users
+from users.models import User
+from users.tokens import TokenPrincipal
+from . import hydration, idempotency, partitions, receipts, search, typing, writer
+from .archive import ArchivedHistory, archive_range
+from .compaction import compact_statuses, last_id_before
+from .consumers import CLOSE_NOT_MEMBER, BaseChatConsumer, ChatConsumer, UserConsumer
+from .events import chat_group
+from .frames import attach_frames, build_frame
+from .models import CLIENT_MSG_ID_MAX_LENGTH, Message, MessageArchive, MessageStatus, PinnedMessage
+from .pagination import paginate_history
+from .receipts import ReadReceiptAggregator
+from .serializers import MessageSerializer
+from .services import mark_read_many, send_message
+from .sync import events_key, message_fields, record_event, replay
+from .writer import MessageWriter
+
+
+class SearchCursorTests(TestCase):
+    def setUp(self):
+        self.user = create_user("reader")
+        self.chat = create_group(self.user)
+        patcher = mock.patch.object(search, "_memory_backend", search.InMemorySearchBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pages_through_messages_tied_on_rank(self):
+        # Same text, same rank: only the id orders them across pages.
+        expected = [send_message(self.chat.id, self.user, "quarterly report").id for _ in range(7)]
+        send_message(self.chat.id, self.user, "quarterly report draft, see the report below")
+
+        seen, cursor = [], None
+        for _ in range(10):
+            page = search.search_messages(self.user, "report", cursor=cursor, limit=3)
+            seen += [message.id for message in page["results"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(seen), 8)
+        self.assertEqual([message_id for message_id in seen if message_id in expected], sorted(expected, reverse=True))
+
+    @override_settings(MESSAGE_SEARCH_IN_MEMORY=False)
+    def test_in_memory_index_only_when_enabled(self):
+        send_message(self.chat.id, self.user, "not indexed")
+        self.assertFalse(search._memory_backend._built)
+        with self.assertRaises(ImproperlyConfigured):
+            search.search_messages(self.user, "indexed")
+
+
+async def no_publish(layer, chat_id, event, buffered=True):
+    pass
+
+
+@override_settings(READ_RECEIPT_FLUSH_INTERVAL=0.01)
+@mock.patch.object(receipts, "publish", no_publish)
+class ReadReceiptTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        self.writing = threading.Event()
+
+    def slow_apply(self, pending):
+        self.writing.set()
+        time.sleep(0.2)
+        self.batches.append(dict(pending))
+        return dict(pending), {chat_id: 1 for chat_id, _ in pending}
+
+    async def wait_idle(self, aggregator):
+        for _ in range(100):
+            if aggregator._task.done():
+                return
+            await asyncio.sleep(0.05)
+        self.fail("read receipts were not flushed")
+
+    async def test_submit_during_flush_is_written_by_the_next_batch(self):
+        aggregator = ReadReceiptAggregator()
+        with mock.patch.object(receipts, "apply_reads", self.slow_apply):
+            aggregator.submit(1, 1, 10)
+            while not self.writing.is_set():
+                await asyncio.sleep(0.01)
+            aggregator.submit(1, 1, 20)
+            aggregator.submit(2, 1, 5)
+            await self.wait_idle(aggregator)
+
+        self.assertEqual(self.batches, [{(1, 1): 10}, {(1, 1): 20, (2, 1): 5}])
+        self.assertEqual(aggregator._pending, {})
+
+    async def test_failed_batch_is_retried_key_by_key(self):
+        aggregator = ReadReceiptAggregator()
+        attempts = []
+
+        def failing_once(pending):
+            attempts.append(dict(pending))
+            if len(attempts) == 1:
+                aggregator._pending[(1, 1)] = 15
+                raise RuntimeError("database went away")
+            return dict(pending), {1: 1}
+
+        with mock.patch.object(receipts, "apply_reads", failing_once), self.assertLogs(receipts.logger):
+            aggregator.submit(1, 1, 10)
+            aggregator.submit(1, 2, 7)
+            await self.wait_idle(aggregator)
+
+        self.assertEqual(attempts, [{(1, 1): 10, (1, 2): 7}, {(1, 1): 10}, {(1, 2): 7}, {(1, 1): 15}])
+
+    @override_settings(READ_RECEIPT_MAX_ATTEMPTS=3)
+    async def test_key_that_keeps_failing_is_dropped_without_holding_back_the_others(self):
+        aggregator = ReadReceiptAggregator()
+        written = []
+
+        def chat_deleted(pending):
+            if (1, 1) in pending:
+                raise Chat.DoesNotExist()
+            written.append(dict(pending))
+            return dict(pending), {chat_id: 1 for chat_id, _ in pending}
+
+        with mock.patch.object(receipts, "apply_reads", chat_deleted), self.assertLogs(receipts.logger) as logs:
+            aggregator.submit(1, 1, 10)
+            aggregator.submit(2, 1, 7)
+            await self.wait_idle(aggregator)
+
+        self.assertEqual(written, [{(2, 1): 7}])
+        self.assertEqual(aggregator._pending, {})
+        self.assertEqual(aggregator._attempts, {})
+        self.assertIn("Dropping read receipt of user 1 in chat 1 after 3 attempts", logs.output[-1])
+
+    async def test_flush_of_one_user_leaves_the_others_pending(self):
+        aggregator = ReadReceiptAggregator()
+        with mock.patch.object(receipts, "apply_reads", self.slow_apply):
+            aggregator._pending = {(1, 1): 10, (1, 2): 4}
+            await aggregator.flush(user_id=1)
+
+        self.assertEqual(self.batches, [{(1, 1): 10}])
+        self.assertEqual(aggregator._pending, {(1, 2): 4})
+
+
+@override_settings(READ_RECEIPT_FLUSH_INTERVAL=0.01)
+@mock.patch.object(receipts, "publish", no_publish)
+class WebsocketReadTests(TransactionTestCase):
+    def setUp(self):
+        self.user, self.sender = create_users("reader", "sender")
+        self.chat = create_group(self.user, self.sender)
+        self.messages = [send_message(self.chat.id, self.sender, f"message {i}") for i in range(3)]
+
+    def watermark(self):
+        state = ChatReadState.objects.filter(chat=self.chat, user=self.user).first()
+        return state.last_read_message_id if state else 0
+
+    def test_watermarks_past_the_newest_message_are_lowered(self):
+        empty = create_group(name="empty")
+        advanced = mark_read_many({
+            (self.chat.id, self.user.id): self.messages[-1].id + 1000,
+            (empty.id, self.user.id): 5,
+        })
+        self.assertEqual(advanced, {(self.chat.id, self.user.id): self.messages[-1].id})
+        self.assertEqual(self.watermark(), self.messages[-1].id)
+
+    async def test_read_frames_are_validated(self):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = TokenPrincipal(self.user.id, self.user.username)
+        await communicator.connect()
+        for value in ("abc", [1], 0, None):
+            await communicator.send_json_to({"type": "read", "chat_id": self.chat.id, "last_read_message_id": value})
+            self.assertEqual(await communicator.receive_json_from(), {
+                "type": "error",
+                "chat_id": self.chat.id,
+                "error": "last_read_message_id must be a positive integer",
+            })
+
+        await communicator.send_json_to({"type": "read", "chat_id": self.chat.id, "last_read_message_id": 10 ** 9})
+        for _ in range(100):
+            if await database_sync_to_async(self.watermark)():
+                break
+            await asyncio.sleep(0.02)
+        await communicator.disconnect()
+
+        self.assertEqual(await database_sync_to_async(self.watermark)(), self.messages[-1].id)
+
+
+@override_settings(TYPING_BROADCAST_INTERVAL=0.05, TYPING_MIN_INTERVAL=0)
+class TypingFlushTests(SimpleTestCase):
+    chat_id = 9001
+
+    def setUp(self):
+        self.published = []
+        patcher = mock.patch.object(typing, "publish", self.record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for key in (typing.typing_key, typing.sent_key, typing.flush_key):
+            async_to_sync(get_store().delete)(key(self.chat_id))
+
+    async def record(self, layer, chat_id, event, buffered=True):
+        self.published.append([user["user_id"] for user in event["users"]])
+
+    async def test_one_worker_publishes_per_window(self):
+        # Two coalescers stand in for two workers sharing the store.
+        workers = [typing.TypingCoalescer(), typing.TypingCoalescer()]
+        await workers[0].update(self.chat_id, 1, "alice", True)
+        await workers[1].update(self.chat_id, 2, "bob", True)
+        for worker in workers:
+            await worker.flush()
+        self.assertEqual(self.published, [[1, 2]])
+
+        await asyncio.sleep(0.06)
+        for worker in workers:
+            await worker.flush()
+        self.assertEqual(self.published, [[1, 2]])
+
+        await workers[1].update(self.chat_id, 2, "bob", False)
+        await workers[0].flush()
+        await asyncio.sleep(0.06)
+        await workers[1].flush()
+        await workers[0].flush()
+        self.assertEqual(self.published, [[1, 2], [1]])
+
+        for worker in workers:
+            worker._task.cancel()
+
+
+class SyncReplayTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user("writer")
+        self.chat = create_group(self.user)
+        async_to_sync(get_store().delete)(events_key(self.chat.id))
+        self.client = api_client(self.user)
+
+    def send_over_websocket(self, text):
+        message = send_message(self.chat.id, self.user, text)
+        async_to_sync(record_event)(self.chat.id, {"type": "chat_message", "seq": message.seq, "text": text})
+        return message
+
+    def test_rest_writes_are_replayed_from_the_buffer(self):
+        first = self.send_over_websocket("from the socket")
+        response = self.client.post(f"/api/chats/{self.chat.id}/messages/", {"text": "from rest"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.client.patch(f"/api/messages/{first.id}/", {"text": "edited"}, format="json")
+
+        events, complete = async_to_sync(replay)(self.chat.id, 0)
+
+        self.assertTrue(complete)
+        self.assertEqual([event["seq"] for event in events], [1, 2, 3])
+        self.assertEqual([event["type"] for event in events], ["chat_message", "chat_message", "message_edit"])
+
+    def test_buffer_behind_last_seq_falls_back_to_the_database(self):
+        self.send_over_websocket("buffered")
+        # A write that allocated a seq without reaching the buffer.
+        unbuffered = send_message(self.chat.id, self.user, "not buffered")
+
+        events, complete = async_to_sync(replay)(self.chat.id, 0)
+
+        self.assertTrue(complete)
+        self.assertIn(unbuffered.id, [event.get("message_id") for event in events])
+
+    def test_up_to_date_client_gets_nothing(self):
+        self.send_over_websocket("seen")
+        self.assertEqual(async_to_sync(replay)(self.chat.id, 1), ([], True))
+
+
+@override_settings(MESSAGE_STATUS_WATERMARK_THRESHOLD=2, MESSAGE_STATUS_RETENTION_DAYS=30)
+class StatusCompactionTests(TestCase):
+    def make_chat(self, size):
+        users = [create_user(f"user{User.objects.count()}") for _ in range(size)]
+        chat = create_group(*users)
+        return chat, users
+
+    def grow(self, chat, count):
+        for _ in range(count):
+            user = create_user(f"user{User.objects.count()}")
+            chat.members.add(user)
+            ChatReadState.objects.create(chat=chat, user=user)
+
+    def read_old_message(self, chat, users):
+        message = send_message(chat.id, users[0], "old")
+        Message.objects.filter(id=message.id).update(created_at=timezone.now() - timedelta(days=60))
+        mark_read_many({(chat.id, user.id): message.id for user in users[1:]})
+        return Message.objects.select_related("sender", "chat").get(id=message.id)
+
+    def statuses(self, message):
+        message = Message.objects.select_related("sender", "chat").get(id=message.id)
+        return sorted((status["user"], status["read"]) for status in MessageSerializer(message).data["statuses"])
+
+    def test_compacted_statuses_survive_the_chat_growing_past_the_threshold(self):
+        chat, users = self.make_chat(3)
+        message = self.read_old_message(chat, users)
+        before = self.statuses(message)
+
+        compact_statuses()
+        self.assertFalse(MessageStatus.objects.filter(message=message).exists())
+        self.grow(chat, 3)
+
+        self.assertEqual(self.statuses(message), before)
+        self.assertEqual(before, [(users[1].id, True), (users[2].id, True)])
+
+    def test_chats_above_the_threshold_are_not_compacted(self):
+        chat, users = self.make_chat(3)
+        message = self.read_old_message(chat, users)
+        self.grow(chat, 3)
+
+        compact_statuses()
+
+        chat.refresh_from_db()
+        self.assertEqual(chat.statuses_compacted_message_id, 0)
+        self.assertEqual(MessageStatus.objects.filter(message=message).count(), 2)
+        self.assertEqual(self.statuses(message), [(users[1].id, True), (users[2].id, True)])
+
+
+@override_settings(MESSAGE_STATUS_WATERMARK_THRESHOLD=2)
+class LargeChatStatusTests(TestCase):
+    def setUp(self):
+        self.users = [create_user(f"member{i}") for i in range(4)]
+        self.chat = create_group(*self.users)
+        for user in self.users:
+            ChatReadState.objects.create(chat=self.chat, user=user)
+        self.client = api_client(self.users[0])
+
+    def test_statuses_come_from_the_watermarks(self):
+        message = send_message(self.chat.id, self.users[0], "hello everyone")
+        mark_read_many({(self.chat.id, self.users[1].id): message.id})
+        self.assertFalse(MessageStatus.objects.filter(message=message).exists())
+
+        response = self.client.get(f"/api/messages/{message.id}/")
+
+        self.assertEqual(response.status_code, 200)
+        statuses = sorted((status["user"], status["delivered"], status["read"]) for status in response.json()["statuses"])
+        self.assertEqual(statuses, [
+            (self.users[1].id, True, True),
+            (self.users[2].id, True, False),
+            (self.users[3].id, True, False),
+        ])
+
+
+class PresenceSubscriptionTests(TransactionTestCase):
+    def setUp(self):
+        self.user, self.contact, self.stranger = create_users("viewer", "contact", "stranger")
+        create_group(self.user, self.contact)
+        create_group(self.stranger, name="other")
+
+    async def test_users_without_a_shared_chat_are_ignored(self):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = TokenPrincipal(self.user.id, self.user.username)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({
+            "type": "presence_subscribe",
+            "user_ids": [self.contact.id, self.stranger.id],
+        })
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(frame["type"], "presence")
+        self.assertEqual([user["user_id"] for user in frame["users"]], [self.contact.id])
+
+
+
+
+class UserSocketTests(TransactionTestCase):
+    def setUp(self):
+        membership.memberships.clear()
+        self.user = create_user("multi")
+        self.chats = [create_group(name=f"group {i}") for i in range(3)]
+        for chat in self.chats[:2]:
+            chat.members.add(self.user)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = TokenPrincipal(self.user.id, self.user.username)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_one_socket_carries_all_chats(self):
+        communicator = await self.connect()
+        for chat in self.chats[:2]:
+            await communicator.send_json_to({"type": "message", "chat_id": chat.id, "text": f"to {chat.id}"})
+        frames = [await communicator.receive_json_from() for _ in range(2)]
+
+        await communicator.send_json_to({"type": "message", "chat_id": self.chats[2].id, "text": "nope"})
+        error = await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(
+            sorted((frame["type"], frame["chat_id"], frame["text"]) for frame in frames),
+            [("message", chat.id, f"to {chat.id}") for chat in self.chats[:2]],
+        )
+        self.assertEqual(error, {"type": "error", "chat_id": self.chats[2].id, "error": "Chat not found"})
+
+    async def test_malformed_frames_get_an_error_and_keep_the_socket(self):
+        communicator = await self.connect()
+        for frame in ("[]", "1", '"x"', "{not json", '{"chat_id": 1}'):
+            await communicator.send_to(text_data=frame)
+            self.assertEqual(await communicator.receive_json_from(), {"type": "error", "chat_id": None, "error": "Invalid frame"})
+        await communicator.send_to(bytes_data=b"[1, 2]")
+        self.assertEqual((await communicator.receive_json_from())["error"], "Invalid frame")
+
+        await communicator.send_json_to({"type": "message", "chat_id": self.chats[0].id, "text": "still here"})
+        self.assertEqual((await communicator.receive_json_from())["text"], "still here")
+        await communicator.disconnect()
+
+    async def test_joined_chats_are_subscribed_without_reconnecting(self):
+        communicator = await self.connect()
+        chat = self.chats[2]
+        await database_sync_to_async(chat.members.add)(self.user)
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "membership", "chat_id": chat.id, "is_member": True},
+        )
+
+        await communicator.send_json_to({"type": "message", "chat_id": chat.id, "text": "joined"})
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+        self.assertEqual((frame["chat_id"], frame["text"]), (chat.id, "joined"))
+
+
+
+class ClientMsgIdTests(TransactionTestCase):
+    def setUp(self):
+        idempotency.recent_messages.clear()
+        self.user = create_user("retrier")
+        self.chat = create_group(self.user)
+        self.client = api_client(self.user)
+
+    def post(self, **data):
+        return self.client.post(f"/api/chats/{self.chat.id}/messages/", {"text": "hello", **data}, format="json")
+
+    def test_rest_retry_returns_the_first_message(self):
+        first = self.post(client_msg_id="rest-1")
+        retry = self.post(client_msg_id="rest-1")
+        # Past the recent-key cache the stored message is still found.
+        idempotency.recent_messages.clear()
+        late = self.post(client_msg_id="rest-1")
+
+        self.assertEqual((first.status_code, retry.status_code, late.status_code), (201, 200, 200))
+        self.assertEqual({first.json()["id"], retry.json()["id"], late.json()["id"]}, {first.json()["id"]})
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 1)
+        self.assertEqual(self.post(client_msg_id="rest-2").status_code, 201)
+        self.assertEqual(self.post(client_msg_id="x" * (CLIENT_MSG_ID_MAX_LENGTH + 1)).status_code, 400)
+
+    async def test_websocket_retry_returns_the_first_message(self):
+        await get_store().delete(idempotency.client_key(self.chat.id, self.user.id, "ws-1"))
+        communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/")
+        communicator.scope["user"] = TokenPrincipal(self.user.id, self.user.username)
+        await communicator.connect()
+        frames = []
+        for _ in range(2):
+            await communicator.send_json_to({"type": "message", "chat_id": self.chat.id, "text": "hi", "client_msg_id": "ws-1"})
+            frames.append(await communicator.receive_json_from())
+        await communicator.disconnect()
+
+        self.assertEqual(frames[0]["message_id"], frames[1]["message_id"])
+        self.assertEqual({frame["client_msg_id"] for frame in frames}, {"ws-1"})
+        self.assertEqual(await database_sync_to_async(Message.objects.filter(chat=self.chat).count)(), 1)
+
+
+
+@override_settings(CHANNEL_SLIM_EVENTS=True)
+class HydrationTests(TransactionTestCase):
+    def setUp(self):
+        hydration.message_events.clear()
+        hydration.encoded_frames.clear()
+        membership.memberships.clear()
+        self.user, self.other = create_users("member", "leaver")
+        self.chat = create_group(self.user, self.other)
+        self.message = send_message(self.chat.id, self.user, "hello")
+
+    def envelope(self):
+        # What publish() sends for a new message.
+        return hydration.slim({"type": "chat_message", "seq": self.message.seq, **message_fields(self.message)})
+
+    async def test_cached_event_is_hydrated_without_a_query(self):
+        envelope = self.envelope()
+        with mock.patch.object(hydration, "load_message_event", side_effect=AssertionError("queried")):
+            event = await hydration.hydrate(envelope)
+        self.assertEqual((event["message_id"], event["chat_id"], event["seq"]), (self.message.id, self.chat.id, self.message.seq))
+
+    async def test_concurrent_misses_share_one_load(self):
+        envelope = self.envelope()
+        hydration.message_events.clear()
+        with mock.patch.object(hydration, "load_message_event", wraps=hydration.load_message_event) as load:
+            events = await asyncio.gather(*(hydration.hydrate(envelope) for _ in range(5)))
+            await hydration.hydrate(envelope)
+
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual({event["text"] for event in events}, {"hello"})
+
+    async def test_deleted_message_is_not_hydrated(self):
+        envelope = self.envelope()
+        hydration.message_events.clear()
+        await database_sync_to_async(Message.objects.filter(id=self.message.id).delete)()
+        self.assertIsNone(await hydration.hydrate(envelope))
+
+    async def test_envelope_is_not_hydrated_for_a_socket_that_left_the_chat(self):
+        sockets = []
+        for user in (self.user, self.other):
+            communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/")
+            communicator.scope["user"] = TokenPrincipal(user.id, user.username)
+            await communicator.connect()
+            sockets.append(communicator)
+        # Removed without the signal, as if the revocation had not arrived yet.
+        await database_sync_to_async(
+            Chat.members.through.objects.filter(chat=self.chat, user=self.other).delete
+        )()
+        membership.memberships.clear()
+
+        await get_channel_layer().group_send(chat_group(self.chat.id), self.envelope())
+        frame = await sockets[0].receive_json_from()
+        self.assertTrue(await sockets[1].receive_nothing(0.2))
+        for communicator in sockets:
+            await communicator.disconnect()
+
+        self.assertEqual((frame["type"], frame["text"]), ("message", "hello"))
+
+
+class MembershipRevocationTests(TransactionTestCase):
+    def setUp(self):
+        membership.memberships.clear()
+        self.user = create_user("member")
+        self.chat = create_group(self.user)
+        self.other = create_group(name="other")
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.chat.id}/")
+        communicator.scope["user"] = TokenPrincipal(self.user.id, self.user.username)
+        communicator.scope["url_route"] = {"kwargs": {"chat_id": self.chat.id}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # presence snapshot
+        return communicator
+
+    async def test_socket_is_closed_when_the_member_is_removed(self):
+        communicator = await self.connect()
+        await database_sync_to_async(self.chat.members.remove)(self.user)
+
+        output = await communicator.receive_output(1)
+        self.assertEqual(output, {"type": "websocket.close", "code": CLOSE_NOT_MEMBER})
+
+    async def test_forward_to_a_chat_of_other_members_is_ignored(self):
+        message = await database_sync_to_async(send_message)(self.chat.id, self.user, "secret plans")
+        communicator = await self.connect()
+        await communicator.send_json_to({"type": "forward", "message_id": message.id, "target_chat_id": self.other.id})
+        self.assertTrue(await communicator.receive_nothing(0.2))
+        await communicator.disconnect()
+
+        self.assertFalse(await database_sync_to_async(Message.objects.filter(chat=self.other).exists)())
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.user = create_user("archivist")
+        self.chat = create_group(self.user)
+        self.client = api_client(self.user)
+
+    def archive(self, messages):
+        with transaction.atomic():
+            archive_range(messages[0].id, messages[-1].id + 1)
+            Message.objects.filter(id__in=[message.id for message in messages]).delete()
+
+    def test_inbox_keeps_the_preview_of_an_archived_last_message(self):
+        messages = [send_message(self.chat.id, self.user, f"old {i}") for i in range(2)]
+        self.archive(messages)
+
+        chat = self.client.get("/api/chats/").json()[0]
+        self.assertEqual(chat["last_message"]["id"], messages[-1].id)
+        self.assertEqual(chat["last_message"]["text"], "old 1")
+
+        summaries.rebuild([self.chat.id])
+        self.assertEqual(self.client.get("/api/chats/").json()[0]["last_message"]["text"], "old 1")
+
+    def test_pins_are_dropped_and_forwards_unlinked(self):
+        old = send_message(self.chat.id, self.user, "pinned long ago")
+        PinnedMessage.objects.create(chat=self.chat, message=old, pinned_by=self.user)
+        forward = send_message(self.chat.id, self.user, old.text, forwarded_from=old)
+        self.archive([old])
+
+        self.assertFalse(PinnedMessage.objects.exists())
+        forward.refresh_from_db()
+        self.assertIsNone(forward.forwarded_from_id)
+        self.assertEqual(forward.text, "pinned long ago")
+
+
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.user = create_user("scroller")
+        self.chat = create_group(self.user)
+        self.ids = [send_message(self.chat.id, self.user, f"message {i}").id for i in range(10)]
+        self.client = api_client(self.user)
+
+    def page(self, **params):
+        response = self.client.get(f"/api/chats/{self.chat.id}/messages/", params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(set(body), {"results", "prev_cursor", "next_cursor"})
+        return [message["id"] for message in body["results"]], body["prev_cursor"], body["next_cursor"]
+
+    def test_latest_page(self):
+        self.assertEqual(self.page(limit=4), (self.ids[6:], self.ids[6], None))
+        self.assertEqual(self.page(), (self.ids, None, None))
+
+    def test_before_id(self):
+        self.assertEqual(self.page(limit=4, before_id=self.ids[6]), (self.ids[2:6], self.ids[2], self.ids[5]))
+        self.assertEqual(self.page(limit=4, before_id=self.ids[2]), (self.ids[:2], None, self.ids[1]))
+
+    def test_before_id_without_newer_messages(self):
+        Message.objects.filter(id__gte=self.ids[8]).update(is_deleted=True)
+        self.assertEqual(self.page(limit=4, before_id=self.ids[8]), (self.ids[4:8], self.ids[4], None))
+
+    def test_after_id(self):
+        self.assertEqual(self.page(limit=4, after_id=self.ids[1]), (self.ids[2:6], self.ids[2], self.ids[5]))
+        self.assertEqual(self.page(limit=4, after_id=self.ids[5]), (self.ids[6:], self.ids[6], None))
+
+    def test_around(self):
+        self.assertEqual(self.page(limit=4, around=self.ids[5]), (self.ids[3:7], self.ids[3], self.ids[6]))
+        self.assertEqual(self.page(limit=4, around=self.ids[0]), (self.ids[:4], None, self.ids[3]))
+
+    def test_rejects_bad_cursors(self):
+        response = self.client.get(f"/api/chats/{self.chat.id}/messages/", {"before_id": "abc"})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(MESSAGE_ARCHIVE_BLOCK_SIZE=3)
+class ArchivedHistoryTests(TestCase):
+    def setUp(self):
+        self.user = create_user("historian")
+        self.chat = create_group(self.user)
+        self.ids = [send_message(self.chat.id, self.user, f"message {i}").id for i in range(10)]
+        # Another chat's messages in the same range stay out of this history.
+        other = create_group(name="other")
+        send_message(other.id, self.user, "elsewhere")
+
+        with transaction.atomic():
+            self.archived = archive_range(self.ids[0], self.ids[6])
+            Message.objects.filter(id__lt=self.ids[6]).delete()
+        self.chat.refresh_from_db()
+
+    def page(self, **params):
+        live = Message.objects.filter(chat=self.chat, is_deleted=False).select_related('sender')
+        page = paginate_history(live, params, ArchivedHistory(self.chat))
+        return [message.id for message in page["results"]], page["prev_cursor"], page["next_cursor"]
+
+    def test_archive_range_writes_blocks_per_chat(self):
+        self.assertEqual(self.archived, 6)
+        self.assertEqual(self.chat.archived_message_id, self.ids[5])
+        blocks = MessageArchive.objects.filter(chat=self.chat).order_by('first_message_id')
+        self.assertEqual([(block.first_message_id, block.message_count) for block in blocks], [(self.ids[0], 3), (self.ids[3], 3)])
+
+    def test_archived_history_reads_both_directions(self):
+        history = ArchivedHistory(self.chat)
+        self.assertEqual([item.id for item in history.older(self.ids[5], 4)], self.ids[4::-1][:4])
+        self.assertEqual([item.id for item in history.newer(self.ids[1], 3)], self.ids[2:5])
+        self.assertEqual(history.newer(self.ids[5], 3), [])
+        self.assertEqual(history.older(None, 1)[0].to_dict()["text"], "message 5")
+
+    def test_pages_backwards_across_the_archive_boundary(self):
+        ids, prev_cursor, next_cursor = self.page(limit=4)
+        self.assertEqual(ids, self.ids[6:])
+        self.assertEqual(prev_cursor, self.ids[6])
+        self.assertIsNone(next_cursor)
+
+        ids, prev_cursor, next_cursor = self.page(limit=4, before_id=prev_cursor)
+        self.assertEqual(ids, self.ids[2:6])
+        self.assertEqual(next_cursor, self.ids[5])
+
+        ids, prev_cursor, _ = self.page(limit=4, before_id=prev_cursor)
+        self.assertEqual(ids, self.ids[:2])
+        self.assertIsNone(prev_cursor)
+
+    def test_pages_forwards_and_around_the_archive_boundary(self):
+        ids, prev_cursor, next_cursor = self.page(limit=4, after_id=self.ids[2])
+        self.assertEqual(ids, self.ids[3:7])
+        self.assertEqual((prev_cursor, next_cursor), (self.ids[3], self.ids[6]))
+
+        ids, _, next_cursor = self.page(limit=4, after_id=next_cursor)
+        self.assertEqual(ids, self.ids[7:])
+        self.assertIsNone(next_cursor)
+
+        ids, _, _ = self.page(limit=4, around=self.ids[6])
+        self.assertEqual(ids, self.ids[4:8])
+
+
+class LastIdBeforeTests(TestCase):
+    def setUp(self):
+        self.user = create_user("clock")
+        self.chat = create_group(self.user)
+        self.now = timezone.now()
+        self.ids = []
+        for days in (50, 40, 30, 20, 10):
+            message = send_message(self.chat.id, self.user, "tick")
+            Message.objects.filter(id=message.id).update(created_at=self.now - timedelta(days=days))
+            self.ids.append(message.id)
+
+    def test_bisects_to_the_last_message_before_the_moment(self):
+        self.assertEqual(last_id_before(self.now - timedelta(days=25)), self.ids[2])
+        self.assertEqual(last_id_before(self.now - timedelta(days=30)), self.ids[1])
+
+    def test_bounds(self):
+        self.assertEqual(last_id_before(self.now - timedelta(days=60)), 0)
+        self.assertEqual(last_id_before(self.now), self.ids[-1])
+        Message.objects.filter(id__in=self.ids[1:4]).delete()
+        self.assertEqual(last_id_before(self.now - timedelta(days=15)), self.ids[0])
+
+
+@skipUnless(connection.vendor == "postgresql", "messages are only partitioned on PostgreSQL")
+@override_settings(MESSAGE_PARTITION_SIZE=5, MESSAGE_PARTITIONS_AHEAD=2)
+class PartitionTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user("partitioner")
+        self.chat = create_group(self.user)
+
+    def set_last_id(self, last_id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", [partitions.MESSAGE_TABLE, last_id]
+            )
+
+    def test_create_partitions_keeps_partitions_ahead_of_the_last_id(self):
+        end = partitions.list_partitions(partitions.MESSAGE_TABLE)[-1][2]
+        self.set_last_id(end - 3)
+
+        self.assertEqual(partitions.create_partitions(), [(end, end + 5), (end + 5, end + 10)])
+        self.assertEqual(partitions.create_partitions(), [])
+
+        sent = [send_message(self.chat.id, self.user, "across").id for _ in range(6)]
+        self.assertEqual(sent, list(range(end - 2, end + 4)))
+        self.assertEqual(partitions.create_partitions(), [(end + 10, end + 15)])
+        self.assertEqual(
+            partitions.list_partitions(partitions.STATUS_TABLE),
+            [(name.replace(partitions.MESSAGE_TABLE, partitions.STATUS_TABLE), start, stop)
+             for name, start, stop in partitions.list_partitions(partitions.MESSAGE_TABLE)],
+        )
+
+    def test_sends_past_the_last_partition_fail_until_the_command_runs(self):
+        end = partitions.list_partitions(partitions.MESSAGE_TABLE)[-1][2]
+        self.set_last_id(end - 2)
+        self.assertEqual(partitions.headroom(), 1)
+        self.assertEqual(send_message(self.chat.id, self.user, "last fitting").id, end - 1)
+        self.assertEqual(partitions.headroom(), 0)
+        with self.assertRaises(DatabaseError):
+            send_message(self.chat.id, self.user, "past the end")
+
+        with self.assertRaisesMessage(CommandError, "Only -1 message ids were left"):
+            call_command("create_message_partitions", stdout=StringIO())
+        self.assertEqual(send_message(self.chat.id, self.user, "rolled over").id, end + 1)
+        self.assertEqual(partitions.headroom(), 13)
+        call_command("create_message_partitions", stdout=StringIO())
+
+
+@override_settings(MESSAGE_PARTITION_SIZE=5)
+@mock.patch("chat_messages.management.commands.create_message_partitions.is_partitioned", return_value=True)
+class CreatePartitionsCommandTests(SimpleTestCase):
+    command = "chat_messages.management.commands.create_message_partitions"
+
+    def test_fails_when_less_than_a_partition_was_left(self, is_partitioned):
+        with mock.patch(f"{self.command}.headroom", return_value=4), \
+                mock.patch(f"{self.command}.create_partitions", return_value=[(10, 15)]) as create:
+            with self.assertRaisesMessage(CommandError, "Only 4 message ids were left"):
+                call_command("create_message_partitions", stdout=StringIO())
+        create.assert_called_once_with(None)
+
+    def test_every_keeps_running_past_failures(self, is_partitioned):
+        with mock.patch(f"{self.command}.headroom", return_value=5), \
+                mock.patch(f"{self.command}.create_partitions", side_effect=[DatabaseError, [], KeyboardInterrupt]), \
+                mock.patch(f"{self.command}.time.sleep") as sleep, \
+                self.assertLogs(f"{self.command}", "ERROR"):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command("create_message_partitions", every=60, stdout=StringIO())
+        self.assertEqual(sleep.call_args_list, [mock.call(60)] * 2)
+
+
+@override_settings(MESSAGE_WRITE_FLUSH_INTERVAL=0.05)
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user("writer")
+        self.chat = create_group(self.user)
+        self.writer = MessageWriter()
+        self.published = []
+
+    async def record(self, layer, chat_id, event, buffered=True):
+        self.published.append((event["type"], event["provisional_id"]))
+
+    async def submit(self, chat_id, text, provisional_id):
+        await self.writer.submit(chat_id, self.user.id, text, provisional_id=provisional_id)
+
+    async def wait_for(self, count):
+        for _ in range(100):
+            if len(self.published) >= count:
+                break
+            await asyncio.sleep(0.02)
+        self.writer._task.cancel()
+        await asyncio.gather(self.writer._task, return_exceptions=True)
+
+    async def test_only_the_message_that_cannot_be_written_fails(self):
+        with mock.patch.object(writer, "publish", self.record), self.assertLogs(writer.logger) as logs:
+            await self.submit(self.chat.id, "first", "tmp-1")
+            await self.submit(self.chat.id + 1000, "to a deleted chat", "tmp-2")
+            await self.submit(self.chat.id, "second", "tmp-3")
+            await self.wait_for(3)
+
+        self.assertEqual(sorted(self.published), [
+            ("message_commit", "tmp-1"), ("message_commit", "tmp-3"), ("message_failed", "tmp-2"),
+        ])
+        self.assertIn("retrying one by one", logs.output[0])
+        texts = await database_sync_to_async(lambda: sorted(Message.objects.values_list("text", flat=True)))()
+        self.assertEqual(texts, ["first", "second"])
+
+    async def test_writer_survives_a_failed_publish(self):
+        async def flaky(layer, chat_id, event, buffered=True):
+            if event["provisional_id"] == "tmp-1":
+                raise ConnectionError("channel layer went away")
+            await self.record(layer, chat_id, event, buffered)
+
+        with mock.patch.object(writer, "publish", flaky), self.assertLogs(writer.logger):
+            await self.submit(self.chat.id, "lost notice", "tmp-1")
+            await self.submit(self.chat.id, "after", "tmp-2")
+            await self.wait_for(1)
+
+        self.assertEqual(self.published, [("message_commit", "tmp-2")])
+
+
+@override_settings(WS_PRECOMPUTED_CODECS=["json"])
+class FrameTests(SimpleTestCase):
+    event = {
+        "type": "chat_message", "chat_id": 3, "seq": 7, "message_id": 11, "text": "x" * 100,
+        "sender": "alice", "sender_id": 2, "created_at": "2024-01-01T12:00:00+00:00",
+    }
+
+    async def test_only_frames_and_routing_fields_cross_the_layer(self):
+        routed = attach_frames(dict(self.event))
+        self.assertEqual(set(routed), {"type", "chat_id", "frames"})
+
+        sent = []
+        consumer = BaseChatConsumer()
+        consumer.codec = CODECS["msgpack"]
+        consumer.send_encoded = mock.AsyncMock(side_effect=sent.append)
+        await consumer.send_event(routed)
+
+        self.assertEqual(CODECS["msgpack"].decode(sent[0]), build_frame(self.event))
@@ -0,0 +1,111 @@
+"""
+Server-side coalescing of typing indicators.
+
+Typing frames only update a per-chat "who is typing" hash in the shared
+store; at most one frame per TYPING_MIN_INTERVAL is accepted per (chat,
+user) and entries expire after TYPING_TTL seconds unless refreshed. Every
+TYPING_BROADCAST_INTERVAL seconds each worker that saw typing in a chat
+compares the hash with the last published set (also in the store) and, if
+it changed, publishes one aggregated typing_update instead of one event per
+keystroke. Publishing takes a per-chat flush claim that lasts one window, so
+with several workers only one of them broadcasts per chat and window; the
+others keep the chat and look again on the next tick.
+"""
+import asyncio
+import json
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from common.store import get_store
+from .events import publish
+
+
+def typing_key(chat_id):
+    return f"typing:{chat_id}"
+
+
+def sent_key(chat_id):
+    return f"typing_sent:{chat_id}"
+
+
+def flush_key(chat_id):
+    return f"typing_flush:{chat_id}"
+
+
+class TypingCoalescer:
+    def __init__(self):
+        self._accepted = {}
+        self._active = set()
+        self._task = None
+
+    async def update(self, chat_id, user_id, username, is_typing):
+        key = (chat_id, user_id)
+        store = get_store()
+
+        if is_typing:
+            now = time.monotonic()
+            last = self._accepted.get(key)
+            if last is not None and now - last < settings.TYPING_MIN_INTERVAL:
+                return False
+            self._accepted[key] = now
+            expires_at = time.time() + settings.TYPING_TTL
+            await store.hset(typing_key(chat_id), user_id, json.dumps([username, expires_at]))
+            await store.expire(typing_key(chat_id), settings.TYPING_TTL)
+        else:
+            if self._accepted.pop(key, None) is None and chat_id not in self._active:
+                return False
+            await store.hdel(typing_key(chat_id), user_id)
+
+        self._active.add(chat_id)
+        self._ensure_task()
+        return True
+
+    async def typers(self, chat_id):
+        store = get_store()
+        entries = await store.hgetall(typing_key(chat_id))
+        now = time.time()
+        users, expired = [], []
+        for user_id, value in entries.items():
+            username, expires_at = json.loads(value)
+            if expires_at <= now:
+                expired.append(user_id)
+            else:
+                users.append({"user_id": int(user_id), "username": username})
+        await store.hdel(typing_key(chat_id), *expired)
+        return sorted(users, key=lambda user: user["user_id"])
+
+    async def flush(self):
+        layer = get_channel_layer()
+        store = get_store()
+        for chat_id in list(self._active):
+            users = await self.typers(chat_id)
+            sent = await store.get(sent_key(chat_id))
+            if users != (json.loads(sent) if sent else []):
+                if not await store.set_if_absent(flush_key(chat_id), "1", ttl=settings.TYPING_BROADCAST_INTERVAL):
+                    # Another worker publishes this window; it reads the
+                    # same hash, so check again on the next tick.
+                    continue
+                await publish(layer, chat_id, {"type": "typing_update", "users": users})
+                if users:
+                    await store.set(sent_key(chat_id), json.dumps(users), ttl=settings.TYPING_TTL)
+                else:
+                    await store.delete(sent_key(chat_id))
+            elif users:
+                await store.expire(sent_key(chat_id), settings.TYPING_TTL)
+            if not users:
+                self._active.discard(chat_id)
+                for key in [key for key in self._accepted if key[0] == chat_id]:
+                    del self._accepted[key]
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._active:
+            await asyncio.sleep(settings.TYPING_BROADCAST_INTERVAL)
+            await self.flush()
+
+
+typing_coalescer = TypingCoalescer()
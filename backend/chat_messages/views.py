@@ -2,14 +2,21 @@ from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied, NotFound
-from django.db.models import Q
-from django.utils import timezone
+from common.db_routing import ReplicaReadsMixin
+from chats.membership import is_member_sync
 from chats.models import Chat
-from .models import Message, MessageStatus, PinnedMessage
+from .archive import ArchivedHistory
+from .events import publish_on_commit
+from .models import CLIENT_MSG_ID_MAX_LENGTH, Message, PinnedMessage
+from .pagination import get_limit, int_param, paginate_history
+from .search import search_messages
+from .idempotency import lookup_sync, remember_sync
+from .services import send_message_once, edit_message, delete_message
 from .serializers import MessageSerializer, PinnedMessageSerializer
+from .sync import message_fields
 
 
-class ChatMessageViewSet(viewsets.ViewSet):
+class ChatMessageViewSet(ReplicaReadsMixin, viewsets.ViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def list(self, request, chat_id=None):
@@ -20,9 +27,11 @@ class ChatMessageViewSet(viewsets.ViewSet):
         messages = Message.objects.filter(
             chat=chat,
             is_deleted=False
-        ).select_related('sender').order_by('created_at')
+        ).select_related('sender')
 
-        return Response([m.to_dict() for m in messages])
+        page = paginate_history(messages, request.query_params, ArchivedHistory(chat))
+        page["results"] = [m.to_dict() for m in page["results"]]
+        return Response(page)
 
     def create(self, request, chat_id=None):
         chat = Chat.objects.filter(id=chat_id, members=request.user).first()
@@ -36,25 +45,33 @@ class ChatMessageViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        message = Message.objects.create(
-            chat=chat,
-            sender=request.user,
-            text=text
+        client_msg_id = request.data.get("client_msg_id") or None
+        if client_msg_id is not None:
+            if not isinstance(client_msg_id, str) or len(client_msg_id) > CLIENT_MSG_ID_MAX_LENGTH:
+                return Response(
+                    {"error": f"client_msg_id must be a string of at most {CLIENT_MSG_ID_MAX_LENGTH} characters"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            sent_id = lookup_sync(chat.id, request.user.id, client_msg_id)
+            if sent_id and not sent_id.startswith("tmp-"):
+                message = Message.objects.select_related('sender').filter(id=sent_id).first()
+                if message:
+                    return Response(message.to_dict(), status=status.HTTP_200_OK)
+
+        message, created = send_message_once(chat.id, request.user, text, client_msg_id)
+        if client_msg_id is not None:
+            remember_sync(chat.id, request.user.id, client_msg_id, message.id)
+        if created:
+            publish_on_commit(chat.id, {"type": "chat_message", "seq": message.seq, **message_fields(message)})
+
+        return Response(
+            message.to_dict(),
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
         )
 
-        members = chat.members.exclude(id=request.user.id)
-        for user in members:
-            MessageStatus.objects.create(
-                message=message,
-                user=user,
-                delivered=True,
-                delivered_at=timezone.now()
-            )
-
-        return Response(message.to_dict(), status=status.HTTP_201_CREATED)
 
-
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -76,10 +93,13 @@ class MessageViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        instance.text = text
-        instance.is_edited = True
-        instance.edited_at = timezone.now()
-        instance.save()
+        edit_message(instance, text)
+        publish_on_commit(instance.chat_id, {
+            "type": "message_edit",
+            "seq": instance.event_seq,
+            "message_id": instance.id,
+            "text": instance.text,
+        })
 
         return Response(instance.to_dict())
 
@@ -89,38 +109,48 @@ class MessageViewSet(viewsets.ModelViewSet):
         if instance.sender != request.user:
             raise PermissionDenied("You can only delete your own messages")
 
-        instance.is_deleted = True
-        instance.text = "Message deleted"
-        instance.save(update_fields=['is_deleted', 'text'])
+        delete_message(instance)
+        publish_on_commit(instance.chat_id, {
+            "type": "message_delete",
+            "seq": instance.event_seq,
+            "message_id": instance.id,
+        })
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, methods=['get'], url_path='search')
     def search(self, request):
-        query = request.query_params.get('q', '')
-        user = request.user
-
-        qs = Message.objects.filter(
-            chat__members=user,
-            text__icontains=query,
-            is_deleted=False
-        ).select_related('sender', 'chat')[:50]
-
-        return Response([m.to_dict() for m in qs])
+        params = request.query_params
+        page = search_messages(
+            request.user,
+            params.get('q', ''),
+            chat_id=int_param(params, 'chat'),
+            sender_id=int_param(params, 'sender'),
+            cursor=params.get('cursor') or None,
+            limit=get_limit(params),
+        )
+        page["results"] = [m.to_dict() for m in page["results"]]
+        return Response(page)
 
 
-class PinnedMessageViewSet(viewsets.ModelViewSet):
+class PinnedMessageViewSet(ReplicaReadsMixin, viewsets.ModelViewSet):
     serializer_class = PinnedMessageSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
+        pins = PinnedMessage.objects.filter(
+            chat__members=self.request.user
+        ).select_related(
+            'pinned_by', 'message__sender', 'message__chat', 'message__forwarded_from__sender'
+        ).prefetch_related('message__statuses__user')
+
         chat_id = self.request.query_params.get('chat')
         if chat_id:
-            return PinnedMessage.objects.filter(
-                chat_id=chat_id,
-                chat__members=self.request.user
-            )
-        return PinnedMessage.objects.filter(chat__members=self.request.user)
+            return pins.filter(chat_id=chat_id)
+        return pins
 
     def perform_create(self, serializer):
+        chat = serializer.validated_data["chat"]
+        if not is_member_sync(self.request.user.id, chat.id):
+            raise PermissionDenied("You are not a member of this chat")
         serializer.save(pinned_by=self.request.user)
@@ -0,0 +1,185 @@
+"""
+Write-behind persistence for websocket messages.
+
+With MESSAGE_WRITE_BEHIND enabled the consumer broadcasts a message with a
+provisional id and hands it to the writer instead of waiting for the
+insert. The writer batches queued messages into one bulk_create (up to
+MESSAGE_WRITE_BATCH_SIZE messages or MESSAGE_WRITE_FLUSH_INTERVAL
+seconds), then acks the sender with the final id and publishes
+message_commit to the room. A batch that fails to write is retried one
+message at a time, so only the messages that cannot be written (a deleted
+chat, say) get message_failed.
+
+The queue holds at most MESSAGE_WRITE_QUEUE_SIZE messages; when it is full
+submit() waits, which slows down the sending sockets instead of growing
+memory. Whatever is still queued when the writer is cancelled or the
+process exits is written synchronously before shutdown.
+"""
+import asyncio
+import atexit
+import logging
+import uuid
+from channels.layers import get_channel_layer
+from django.conf import settings
+from common.db import database_write_to_async
+from . import idempotency
+from .events import publish
+from .sync import record_event
+
+logger = logging.getLogger(__name__)
+
+
+def provisional_id():
+    return f"tmp-{uuid.uuid4().hex}"
+
+
+class MessageWriter:
+    def __init__(self):
+        self._queue = None
+        self._task = None
+        self._inflight = []
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            queue = asyncio.Queue(maxsize=settings.MESSAGE_WRITE_QUEUE_SIZE)
+            while self._queue is not None and not self._queue.empty():
+                queue.put_nowait(self._queue.get_nowait())
+            self._queue = queue
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, chat_id, sender_id, text, sender_name=None, reply_channel=None,
+                     provisional_id=None, client_msg_id=None):
+        self._ensure_task()
+        await self._queue.put({
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "text": text,
+            "sender_name": sender_name,
+            "reply_channel": reply_channel,
+            "provisional_id": provisional_id,
+            "client_msg_id": client_msg_id,
+        })
+
+    async def _next_batch(self):
+        # Dequeued items stay in _inflight until they are handed to the
+        # database, so a cancellation in between still drains them.
+        batch = self._inflight
+        batch.append(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.MESSAGE_WRITE_FLUSH_INTERVAL
+        while len(batch) < settings.MESSAGE_WRITE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        try:
+            while True:
+                batch = await self._next_batch()
+                self._inflight = []
+                try:
+                    await self._write(batch)
+                except Exception:
+                    # Never let one batch stop the writer with messages queued.
+                    logger.exception("Failed to handle %s queued messages", len(batch))
+        except asyncio.CancelledError:
+            await database_write_to_async(self.drain)()
+            raise
+
+    async def _persist(self, batch):
+        """Write a batch, falling back to one message at a time when it fails. None marks a failure."""
+        if len(batch) > 1:
+            try:
+                return await database_write_to_async(write_batch)(batch)
+            except Exception:
+                logger.warning("Failed to persist %s queued messages, retrying one by one", len(batch), exc_info=True)
+
+        messages = []
+        for item in batch:
+            try:
+                messages += await database_write_to_async(write_batch)([item])
+            except Exception:
+                logger.exception("Failed to persist queued message %s", item["provisional_id"])
+                messages.append(None)
+        return messages
+
+    async def _write(self, batch):
+        layer = get_channel_layer()
+        messages = await self._persist(batch)
+        for item, message in zip(batch, messages):
+            try:
+                if message is None:
+                    await self._failed(layer, item)
+                else:
+                    await self._committed(layer, item, message)
+            except Exception:
+                logger.exception("Failed to announce queued message %s", item["provisional_id"])
+
+    async def _failed(self, layer, item):
+        if item["client_msg_id"] is not None:
+            await idempotency.release(item["chat_id"], item["sender_id"], item["client_msg_id"])
+        await publish(layer, item["chat_id"], {
+            "type": "message_failed",
+            "provisional_id": item["provisional_id"],
+        })
+
+    async def _committed(self, layer, item, message):
+        if item["client_msg_id"] is not None:
+            await idempotency.remember(item["chat_id"], item["sender_id"], item["client_msg_id"], message.id)
+        ack = {
+            "seq": message.seq,
+            "provisional_id": item["provisional_id"],
+            "client_msg_id": item["client_msg_id"],
+            "message_id": message.id,
+            "created_at": message.created_at.isoformat(),
+        }
+        if item["reply_channel"]:
+            await layer.send(item["reply_channel"], {
+                "type": "message_ack",
+                "chat_id": item["chat_id"],
+                **ack,
+            })
+        # Clients resuming with a sync frame get the committed message,
+        # not the commit notice.
+        await record_event(item["chat_id"], {
+            "type": "chat_message",
+            "chat_id": item["chat_id"],
+            "text": message.text,
+            "sender": item["sender_name"],
+            "sender_id": message.sender_id,
+            **ack,
+        })
+        await publish(layer, item["chat_id"], {"type": "message_commit", **ack}, buffered=False)
+
+    def drain(self):
+        """Synchronously persist everything that has not been written yet."""
+        pending, self._inflight = self._inflight, []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        if pending:
+            write_batch(pending)
+        return len(pending)
+
+
+def write_batch(batch):
+    from .models import Message
+    from .services import send_messages_bulk
+    return send_messages_bulk([
+        Message(
+            chat_id=item["chat_id"],
+            sender_id=item["sender_id"],
+            text=item["text"],
+            client_msg_id=item.get("client_msg_id"),
+        )
+        for item in batch
+    ])
+
+
+message_writer = MessageWriter()
+atexit.register(message_writer.drain)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Chat, ChatReadState
+from .models import Chat, ChatReadState, ChatSummary, ChatMemberSummary
 
 @admin.register(Chat)
 class ChatAdmin(admin.ModelAdmin):
@@ -8,5 +8,13 @@ class ChatAdmin(admin.ModelAdmin):
 
 @admin.register(ChatReadState)
 class ChatReadStateAdmin(admin.ModelAdmin):
-    list_display = ['chat', 'user', 'last_read_message_id']
+    list_display = ['chat', 'user', 'last_read_message_id', 'delivered_message_id']
+    list_select_related = ['chat', 'user']
 
+@admin.register(ChatSummary)
+class ChatSummaryAdmin(admin.ModelAdmin):
+    list_display = ['chat', 'last_message', 'last_message_at']
+
+@admin.register(ChatMemberSummary)
+class ChatMemberSummaryAdmin(admin.ModelAdmin):
+    list_display = ['chat', 'user', 'unread_count']
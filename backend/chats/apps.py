@@ -4,3 +4,6 @@ class ChatsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chats'
 
+    def ready(self):
+        import chats.signals
+
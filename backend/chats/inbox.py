@@ -0,0 +1,28 @@
+from django.db.models import F, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Coalesce
+from users.models import User
+from .models import Chat, ChatMemberSummary
+
+
+def inbox_for(user):
+    """
+    Chats of `user` annotated with everything Chat.to_dict(user=...) needs.
+
+    Unread counters and the last message preview are read from the
+    denormalized ChatSummary/ChatMemberSummary rows and members are
+    prefetched, so the inbox costs two queries no matter how many chats
+    the user is in.
+    """
+    unread = ChatMemberSummary.objects.filter(
+        chat=OuterRef('pk'),
+        user=user
+    ).values('unread_count')[:1]
+
+    return Chat.objects.filter(members=user).annotate(
+        inbox_unread_count=Coalesce(Subquery(unread), Value(0)),
+        inbox_last_message_id=F('summary__last_message_id'),
+        inbox_last_message_text=F('summary__last_message_text'),
+        inbox_last_message_created_at=F('summary__last_message_at'),
+    ).prefetch_related(
+        Prefetch('members', queryset=User.objects.only('id', 'username'))
+    )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from chats.summaries import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild ChatSummary and ChatMemberSummary rows from messages and read states"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chat",
+            type=int,
+            action="append",
+            dest="chat_ids",
+            help="Only rebuild the given chat id (can be repeated)",
+        )
+
+    def handle(self, *args, **options):
+        rebuilt = rebuild(options["chat_ids"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt summaries for {rebuilt} chats"))
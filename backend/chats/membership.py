@@ -0,0 +1,118 @@
+"""
+Process-local cache of (user_id, chat_id) memberships.
+
+Entries are invalidated by m2m_changed on Chat.members. The change is also
+published on the channel layer so other workers refresh their copy and
+sockets of removed members get disconnected.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from common.db import database_sync_to_async
+from common.db_routing import primary_reads
+from common.cache import TTLCache
+from common.listeners import GroupListener
+
+INVALIDATION_GROUP = "chat_memberships"
+
+memberships = TTLCache(
+    maxsize=settings.MEMBERSHIP_CACHE_SIZE,
+    ttl=settings.MEMBERSHIP_CACHE_TTL,
+)
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
+
+
+def is_member_sync(user_id, chat_id):
+    key = (int(user_id), int(chat_id))
+    cached = memberships.get(key)
+    if cached is None:
+        from .models import Chat
+        # Cached for long, so never from a replica that may not have the join yet.
+        with primary_reads():
+            cached = Chat.objects.filter(id=chat_id, members=user_id).exists()
+        memberships.set(key, cached)
+    return cached
+
+
+async def is_member(user_id, chat_id):
+    try:
+        key = (int(user_id), int(chat_id))
+    except (TypeError, ValueError):
+        return False
+    cached = memberships.get(key)
+    if cached is not None:
+        return cached
+    await ensure_listener()
+    return await database_sync_to_async(is_member_sync)(*key)
+
+
+def members_of_any_sync(chat_ids, candidate_ids):
+    """
+    Return the set of candidate user ids that are members of one of chat_ids.
+
+    Pairs found in the cache are trusted; the others are read in one query
+    and the memberships found are cached.
+    """
+    chat_ids = [int(chat_id) for chat_id in chat_ids]
+    found, unknown = set(), []
+    for candidate_id in set(candidate_ids):
+        cached = [memberships.get((candidate_id, chat_id)) for chat_id in chat_ids]
+        if True in cached:
+            found.add(candidate_id)
+        elif None in cached:
+            unknown.append(candidate_id)
+
+    if unknown and chat_ids:
+        from .models import Chat
+        with primary_reads():
+            pairs = list(
+                Chat.members.through.objects.filter(chat_id__in=chat_ids, user_id__in=unknown)
+                .values_list("user_id", "chat_id")
+            )
+        for candidate_id, chat_id in pairs:
+            memberships.set((candidate_id, chat_id), True)
+            found.add(candidate_id)
+    return found
+
+
+async def members_of_any(chat_ids, candidate_ids):
+    await ensure_listener()
+    return await database_sync_to_async(members_of_any_sync)(chat_ids, candidate_ids)
+
+
+def _apply(event):
+    memberships.set((event["user_id"], event["chat_id"]), event["is_member"])
+
+
+_listener = GroupListener(INVALIDATION_GROUP, "membership.changed", _apply)
+
+
+async def ensure_listener():
+    """Subscribe this worker to membership invalidations on the channel layer."""
+    await _listener.ensure()
+
+
+def _publish(chat_id, user_ids, is_member):
+    for user_id in user_ids:
+        memberships.set((user_id, chat_id), is_member)
+
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    for user_id in user_ids:
+        event = {"chat_id": chat_id, "user_id": user_id, "is_member": is_member}
+        async_to_sync(layer.group_send)(
+            INVALIDATION_GROUP, {"type": "membership.changed", **event}
+        )
+        async_to_sync(layer.group_send)(
+            user_group(user_id), {"type": "membership_changed", **event}
+        )
+
+
+def membership_changed(chat_id, user_ids, is_member):
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: _publish(chat_id, user_ids, is_member), robust=True)
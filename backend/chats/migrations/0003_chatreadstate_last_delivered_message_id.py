@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='last_delivered_message_id',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2 on 2026-10-18 16:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_messages', '0004_message_chat_id_idx'),
+        ('chats', '0003_chatreadstate_last_delivered_message_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_text', models.TextField(blank=True, default='')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('chat', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='chats.chat')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat_messages.message')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChatMemberSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='member_summaries', to='chats.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('chat', 'user')},
+            },
+        ),
+    ]
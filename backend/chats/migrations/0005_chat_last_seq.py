@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_chat_summaries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
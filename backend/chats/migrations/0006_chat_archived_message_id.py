@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_chat_last_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='archived_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_chat_statuses_compacted_message_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='delivered_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations
+
+
+def backfill_summaries(apps, schema_editor):
+    # Same as chats.summaries.rebuild(), on the historical models.
+    Chat = apps.get_model('chats', 'Chat')
+    ChatReadState = apps.get_model('chats', 'ChatReadState')
+    ChatSummary = apps.get_model('chats', 'ChatSummary')
+    ChatMemberSummary = apps.get_model('chats', 'ChatMemberSummary')
+    Message = apps.get_model('chat_messages', 'Message')
+
+    for chat in Chat.objects.order_by('id').iterator():
+        last = Message.objects.filter(chat=chat).order_by('-id').first()
+        ChatSummary.objects.update_or_create(
+            chat=chat,
+            defaults={
+                "last_message": last,
+                "last_message_text": last.text if last else "",
+                "last_message_at": last.created_at if last else None,
+            }
+        )
+
+        read_states = dict(
+            ChatReadState.objects.filter(chat=chat)
+            .values_list('user_id', 'last_read_message_id')
+        )
+        ChatMemberSummary.objects.bulk_create(
+            [
+                ChatMemberSummary(
+                    chat=chat,
+                    user_id=user_id,
+                    unread_count=Message.objects.filter(
+                        chat=chat,
+                        id__gt=read_states.get(user_id, 0)
+                    ).exclude(sender_id=user_id).count(),
+                )
+                for user_id in chat.members.values_list('id', flat=True)
+            ],
+            update_conflicts=True,
+            unique_fields=['chat', 'user'],
+            update_fields=['unread_count'],
+        )
+
+
+class Migration(migrations.Migration):
+    # One pass over every chat; takes a while on big databases.
+
+    dependencies = [
+        ('chat_messages', '0009_message_partitions'),
+        ('chats', '0008_chat_delivered_message_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
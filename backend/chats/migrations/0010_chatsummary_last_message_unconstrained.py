@@ -0,0 +1,20 @@
+# Generated by Django 5.2 on 2026-10-18 17:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_messages', '0009_message_partitions'),
+        ('chats', '0009_backfill_chat_summaries'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatsummary',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='chat_messages.message'),
+        ),
+    ]
@@ -18,6 +18,16 @@ class Chat(models.Model):
     name = models.CharField(max_length=255, null=True, blank=True)
     members = models.ManyToManyField(User, related_name="chats")
     created_at = models.DateTimeField(auto_now_add=True)
+    # Last sequence number handed out to an event of this chat.
+    last_seq = models.BigIntegerField(default=0)
+    # Messages up to this id have been moved to MessageArchive.
+    archived_message_id = models.BigIntegerField(default=0)
+    # Read MessageStatus rows up to this message id may have been compacted
+    # into the ChatReadState watermarks (chat_messages.compaction).
+    statuses_compacted_message_id = models.BigIntegerField(default=0)
+    # Chats above MESSAGE_STATUS_WATERMARK_THRESHOLD members: messages up to
+    # this id have been delivered to every member.
+    delivered_message_id = models.BigIntegerField(default=0)
 
     def is_private(self):
         return self.type == self.PRIVATE
@@ -39,22 +49,32 @@ class Chat(models.Model):
         }
         
         if user:
-            state = self.read_states.filter(user=user).first()
-            last_read = state.last_read_message_id if state else 0
-            
-            unread_count = Message.objects.filter(
-                chat=self,
-                id__gt=last_read
-            ).exclude(sender=user).count()
-            
-            last_msg = self.messages.order_by('-id').first()
-            last_message = None
-            if last_msg:
-                last_message = {
-                    "id": last_msg.id,
-                    "text": last_msg.text,
-                    "created_at": last_msg.created_at.isoformat(),
-                }
+            if hasattr(self, "inbox_unread_count"):
+                unread_count = self.inbox_unread_count
+                last_message = None
+                if self.inbox_last_message_id:
+                    last_message = {
+                        "id": self.inbox_last_message_id,
+                        "text": self.inbox_last_message_text,
+                        "created_at": self.inbox_last_message_created_at.isoformat(),
+                    }
+            else:
+                state = self.read_states.filter(user=user).first()
+                last_read = state.last_read_message_id if state else 0
+
+                unread_count = Message.objects.filter(
+                    chat=self,
+                    id__gt=last_read
+                ).exclude(sender=user).count()
+
+                last_msg = self.messages.order_by('-id').first()
+                last_message = None
+                if last_msg:
+                    last_message = {
+                        "id": last_msg.id,
+                        "text": last_msg.text,
+                        "created_at": last_msg.created_at.isoformat(),
+                    }
             
             data["unread_count"] = unread_count
             data["last_message"] = last_message
@@ -65,6 +85,7 @@ class ChatReadState(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="read_states")
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     last_read_message_id = models.PositiveIntegerField(default=0)
+    last_delivered_message_id = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ("chat", "user")
@@ -72,3 +93,33 @@ class ChatReadState(models.Model):
     def __str__(self):
         return f"{self.user.username} - Chat {self.chat.id}"
 
+    def delivered_message_id(self):
+        # Large chats move a single watermark on Chat instead of one per member.
+        return max(self.last_delivered_message_id, self.chat.delivered_message_id)
+
+
+
+class ChatSummary(models.Model):
+    chat = models.OneToOneField(Chat, on_delete=models.CASCADE, related_name="summary")
+    # The preview is copied here, so the message may since have been moved
+    # to MessageArchive; no constraint ties it to the live table.
+    last_message = models.ForeignKey(
+        "chat_messages.Message", null=True, blank=True, on_delete=models.DO_NOTHING,
+        db_constraint=False, related_name="+"
+    )
+    last_message_text = models.TextField(blank=True, default="")
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Summary for chat {self.chat_id}"
+
+class ChatMemberSummary(models.Model):
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="member_summaries")
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("chat", "user")
+
+    def __str__(self):
+        return f"{self.user.username} - Chat {self.chat_id}: {self.unread_count} unread"
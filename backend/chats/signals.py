@@ -0,0 +1,28 @@
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from .models import Chat
+from . import membership, summaries
+
+
+@receiver(m2m_changed, sender=Chat.members.through)
+def sync_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        related = instance.chats if reverse else instance.members
+        pk_set = set(related.values_list('id', flat=True))
+        added = False
+    elif action in ("post_add", "post_remove"):
+        added = action == "post_add"
+    else:
+        return
+
+    if reverse:
+        changes = [(chat_id, [instance.pk]) for chat_id in pk_set]
+    else:
+        changes = [(instance.pk, list(pk_set))]
+
+    for chat_id, user_ids in changes:
+        if added:
+            summaries.add_members(chat_id, user_ids)
+        else:
+            summaries.remove_members(chat_id, user_ids)
+        membership.membership_changed(chat_id, user_ids, added)
@@ -0,0 +1,154 @@
+from collections import Counter, defaultdict
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils.dateparse import parse_datetime
+from users.models import User
+from .models import Chat, ChatReadState, ChatSummary, ChatMemberSummary
+
+
+def _count_unread(chat_id, user_id, last_read_id):
+    from chat_messages.models import Message
+    return Message.objects.filter(
+        chat_id=chat_id,
+        id__gt=last_read_id
+    ).exclude(sender_id=user_id).count()
+
+
+def _unread_counts(chat_id, user_ids):
+    """{user_id: unread count} of the given members of a chat, in one query."""
+    from chat_messages.models import Message
+    last_read = ChatReadState.objects.filter(
+        chat_id=chat_id,
+        user_id=OuterRef('pk')
+    ).values('last_read_message_id')[:1]
+    unread = Message.objects.filter(
+        chat_id=chat_id,
+        id__gt=OuterRef('last_read')
+    ).exclude(
+        sender_id=OuterRef('pk')
+    ).order_by().values('chat_id').annotate(count=Count('id')).values('count')
+
+    return dict(
+        User.objects.filter(id__in=user_ids)
+        .annotate(last_read=Coalesce(Subquery(last_read), Value(0)))
+        .annotate(unread=Coalesce(Subquery(unread), Value(0)))
+        .values_list('id', 'unread')
+    )
+
+
+def record_messages(messages, member_ids):
+    """Move the summaries of the chats in `messages`; member_ids maps chat id to its members."""
+    by_chat = defaultdict(list)
+    for message in messages:
+        by_chat[message.chat_id].append(message)
+
+    for chat_id, chat_messages in by_chat.items():
+        last = max(chat_messages, key=lambda message: message.id)
+        updated = ChatSummary.objects.filter(chat_id=chat_id).update(
+            last_message=last,
+            last_message_text=last.text,
+            last_message_at=last.created_at,
+        )
+        if not updated:
+            ChatSummary.objects.get_or_create(
+                chat_id=chat_id,
+                defaults={
+                    "last_message": last,
+                    "last_message_text": last.text,
+                    "last_message_at": last.created_at,
+                }
+            )
+
+        # Every member gets +1 per message in the batch except their own.
+        sent_by = Counter(message.sender_id for message in chat_messages)
+        own = Case(
+            *[When(user_id=user_id, then=Value(count)) for user_id, count in sent_by.items()],
+            default=Value(0),
+        )
+        updated = ChatMemberSummary.objects.filter(chat_id=chat_id).update(
+            unread_count=F('unread_count') + len(chat_messages) - own
+        )
+        if updated < len(member_ids[chat_id]):
+            # Members without a row yet get one counted from their read state.
+            present = ChatMemberSummary.objects.filter(chat_id=chat_id).values_list('user_id', flat=True)
+            add_members(chat_id, list(set(member_ids[chat_id]) - set(present)))
+
+
+def record_edit(message):
+    ChatSummary.objects.filter(last_message_id=message.id).update(
+        last_message_text=message.text
+    )
+
+
+def record_read(chat_id, user_id, last_read_id):
+    ChatMemberSummary.objects.update_or_create(
+        chat_id=chat_id,
+        user_id=user_id,
+        defaults={"unread_count": _count_unread(chat_id, user_id, last_read_id)}
+    )
+
+
+def add_members(chat_id, user_ids):
+    unread = _unread_counts(chat_id, user_ids)
+    ChatSummary.objects.get_or_create(chat_id=chat_id)
+    ChatMemberSummary.objects.bulk_create(
+        [
+            ChatMemberSummary(chat_id=chat_id, user_id=user_id, unread_count=unread.get(user_id, 0))
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def remove_members(chat_id, user_ids):
+    ChatMemberSummary.objects.filter(chat_id=chat_id, user_id__in=user_ids).delete()
+
+
+def _archived_preview(chat):
+    """Preview of a chat whose messages all went to MessageArchive, if any."""
+    from chat_messages.archive import ArchivedHistory
+    archived = ArchivedHistory(chat).older(None, 1)
+    if not archived:
+        return {"last_message": None, "last_message_text": "", "last_message_at": None}
+    data = archived[0].data
+    return {
+        "last_message_id": data["id"],
+        "last_message_text": data["text"],
+        "last_message_at": parse_datetime(data["created_at"]),
+    }
+
+
+def rebuild(chat_ids=None):
+    from chat_messages.models import Message
+
+    chats = Chat.objects.order_by('id')
+    if chat_ids:
+        chats = chats.filter(id__in=chat_ids)
+
+    rebuilt = 0
+    for chat in chats.iterator():
+        with transaction.atomic():
+            last = Message.objects.filter(chat=chat).order_by('-id').first()
+            if last is not None:
+                preview = {"last_message": last, "last_message_text": last.text, "last_message_at": last.created_at}
+            else:
+                preview = _archived_preview(chat)
+            ChatSummary.objects.update_or_create(chat=chat, defaults=preview)
+
+            member_ids = list(chat.members.values_list('id', flat=True))
+            ChatMemberSummary.objects.filter(chat=chat).exclude(user_id__in=member_ids).delete()
+
+            unread = _unread_counts(chat.id, member_ids)
+            ChatMemberSummary.objects.bulk_create(
+                [
+                    ChatMemberSummary(chat=chat, user_id=user_id, unread_count=unread.get(user_id, 0))
+                    for user_id in member_ids
+                ],
+                update_conflicts=True,
+                unique_fields=['chat', 'user'],
+                update_fields=['unread_count'],
+            )
+        rebuilt += 1
+
+    return rebuilt
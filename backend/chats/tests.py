@@ -0,0 +1,164 @@
+import asyncio
+from channels.layers import get_channel_layer
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from chat_messages import receipts
+from chat_messages.models import MessageStatus
+from chat_messages.services import send_message
+from common.testing import api_client, create_group, create_user, create_users
+from users.models import User
+from . import membership, summaries
+from .models import ChatMemberSummary, ChatReadState
+
+
+class InboxQueryCountTests(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.client = api_client(self.user)
+
+    def add_chats(self, count):
+        for _ in range(count):
+            other = create_user(f"member{User.objects.count()}")
+            chat = create_group(self.user, other)
+            send_message(chat.id, other, "hello")
+
+    def inbox_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/chats/")
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_query_count_does_not_grow_with_chats(self):
+        self.add_chats(2)
+        small, chats = self.inbox_queries()
+        self.assertEqual(len(chats), 2)
+
+        self.add_chats(8)
+        with self.assertNumQueries(small):
+            response = self.client.get("/api/chats/")
+        self.assertEqual(len(response.json()), 10)
+
+    def test_inbox_reads_unread_and_last_message_from_summaries(self):
+        self.add_chats(3)
+        _, chats = self.inbox_queries()
+        for chat in chats:
+            self.assertEqual(chat["unread_count"], 1)
+            self.assertEqual(chat["last_message"]["text"], "hello")
+
+
+class ReadStateTests(TestCase):
+    def setUp(self):
+        self.user, self.sender = create_users("reader", "sender")
+        self.chat = create_group(self.user, self.sender)
+        self.messages = [send_message(self.chat.id, self.sender, f"message {i}") for i in range(3)]
+        self.client = api_client(self.user)
+
+    def read(self, last_id):
+        return self.client.post(f"/api/chats/{self.chat.id}/read/", {"last_read_message_id": last_id}, format="json")
+
+    def watermark(self):
+        state = ChatReadState.objects.filter(chat=self.chat, user=self.user).first()
+        return state.last_read_message_id if state else 0
+
+    def test_read_goes_through_the_receipt_pipeline(self):
+        with mock.patch.object(receipts, "publish_on_commit") as published:
+            response = self.read(self.messages[1].id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.watermark(), self.messages[1].id)
+        self.assertEqual(
+            list(MessageStatus.objects.filter(user=self.user, read=True).values_list("message_id", flat=True).order_by("message_id")),
+            [self.messages[0].id, self.messages[1].id],
+        )
+        event = published.call_args.args[1]
+        self.assertEqual(event["type"], "read_update")
+        self.assertEqual(event["reads"], [{"user_id": self.user.id, "last_read_message_id": self.messages[1].id}])
+
+    def test_watermark_does_not_move_backwards(self):
+        self.read(self.messages[2].id)
+        with mock.patch.object(receipts, "publish_on_commit") as published:
+            response = self.read(self.messages[0].id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.watermark(), self.messages[2].id)
+        published.assert_not_called()
+
+    def test_invalid_and_foreign_ids_are_rejected(self):
+        other = create_group(self.sender, name="other")
+        foreign = send_message(other.id, self.sender, "elsewhere")
+
+        self.assertEqual(self.read("abc").status_code, 400)
+        self.assertEqual(self.read(0).status_code, 400)
+        self.assertEqual(self.read(foreign.id).status_code, 404)
+        self.assertEqual(self.watermark(), 0)
+
+
+class SummaryUnreadTests(TestCase):
+    def make_chat(self, size):
+        users = [create_user(f"member{User.objects.count()}") for _ in range(size)]
+        chat = create_group(*users)
+        messages = [send_message(chat.id, users[i % 2], "hello") for i in range(4)]
+        ChatReadState.objects.create(chat=chat, user=users[1], last_read_message_id=messages[1].id)
+        return chat, users
+
+    def unread(self, chat):
+        return dict(ChatMemberSummary.objects.filter(chat=chat).values_list('user_id', 'unread_count'))
+
+    def test_rebuild_counts_unread_per_member(self):
+        chat, users = self.make_chat(3)
+        ChatMemberSummary.objects.filter(chat=chat).update(unread_count=0)
+
+        summaries.rebuild([chat.id])
+
+        self.assertEqual(self.unread(chat), {users[0].id: 2, users[1].id: 1, users[2].id: 4})
+
+    def test_query_count_does_not_grow_with_members(self):
+        small, _ = self.make_chat(2)
+        large, users = self.make_chat(12)
+        with CaptureQueriesContext(connection) as queries:
+            summaries.rebuild([small.id])
+        with self.assertNumQueries(len(queries)):
+            summaries.rebuild([large.id])
+
+        newcomers = [create_user(f"late{i}") for i in range(10)]
+        with self.assertNumQueries(3):
+            summaries.add_members(large.id, [user.id for user in newcomers])
+        self.assertEqual(self.unread(large)[newcomers[0].id], 4)
+
+
+class MembershipCacheTests(TransactionTestCase):
+    def setUp(self):
+        membership.memberships.clear()
+        self.user = create_user("member")
+        self.chat = create_group(self.user)
+
+    def test_member_removal_invalidates_the_cache(self):
+        self.assertTrue(membership.is_member_sync(self.user.id, self.chat.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member_sync(self.user.id, self.chat.id))
+
+        self.chat.members.remove(self.user)
+        with self.assertNumQueries(0):
+            self.assertFalse(membership.is_member_sync(self.user.id, self.chat.id))
+
+        self.chat.members.add(self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member_sync(self.user.id, self.chat.id))
+
+    async def test_changes_from_other_workers_are_applied(self):
+        membership.memberships.set((self.user.id, self.chat.id), True)
+        await membership.ensure_listener()
+        await get_channel_layer().group_send(membership.INVALIDATION_GROUP, {
+            "type": "membership.changed",
+            "chat_id": self.chat.id,
+            "user_id": self.user.id,
+            "is_member": False,
+        })
+        for _ in range(50):
+            if membership.memberships.get((self.user.id, self.chat.id)) is False:
+                break
+            await asyncio.sleep(0.01)
+
+        self.assertFalse(await membership.is_member(self.user.id, self.chat.id))
@@ -3,17 +3,19 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied, NotFound
 from django.contrib.auth import get_user_model
+from common.db_routing import ReplicaReadsMixin
+from .inbox import inbox_for
 from .models import Chat, ChatReadState
 from .serializers import ChatCreateSerializer
 
 User = get_user_model()
 
 
-class ChatViewSet(viewsets.ViewSet):
+class ChatViewSet(ReplicaReadsMixin, viewsets.ViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def list(self, request):
-        chats = Chat.objects.filter(members=request.user).distinct()
+        chats = inbox_for(request.user)
         return Response([chat.to_dict(user=request.user) for chat in chats])
 
     def create(self, request):
@@ -68,18 +70,23 @@ class ChatViewSet(viewsets.ViewSet):
         if not chat:
             raise NotFound("Chat not found")
 
-        last_read_message_id = request.data.get("last_read_message_id")
-        if last_read_message_id is None:
+        try:
+            last_read_message_id = int(request.data.get("last_read_message_id"))
+        except (TypeError, ValueError):
+            last_read_message_id = 0
+        if last_read_message_id <= 0:
             return Response(
-                {"error": "last_read_message_id is required"},
+                {"error": "last_read_message_id must be a positive integer"},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        read_state, created = ChatReadState.objects.get_or_create(
-            chat=chat,
-            user=request.user
-        )
-        read_state.last_read_message_id = last_read_message_id
-        read_state.save()
+        from chat_messages.models import Message
+        from chat_messages.receipts import read_now
+        # Ids are allocated in order, so any id up to the chat's newest
+        # message is a valid watermark, archived or deleted ones included.
+        if not Message.objects.filter(chat_id=chat.id, id__gte=last_read_message_id).exists():
+            raise NotFound("Message not found")
+
+        read_now(chat.id, request.user.id, last_read_message_id)
 
         return Response({"status": "ok"})
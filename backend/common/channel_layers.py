@@ -0,0 +1,292 @@
+"""
+Channel layer that spreads groups over several underlying layers (shards).
+
+Groups are placed on shards with a consistent hash ring, so each chat's
+chat_<id> group and its fan-out live on a single shard, and adding a shard
+only moves a share of the groups. Configuration:
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "common.channel_layers.ShardedChannelLayer",
+            "CONFIG": {
+                "shards": [
+                    {"BACKEND": "channels_redis.core.RedisChannelLayer",
+                     "CONFIG": {"hosts": [("redis-1", 6379)]}},
+                    {"BACKEND": "channels_redis.core.RedisChannelLayer",
+                     "CONFIG": {"hosts": [("redis-2", 6379)]}},
+                ],
+            },
+        },
+    }
+
+A channel created by new_channel() lives on a home shard, and its name
+carries that shard (shard-<n>.<name on the shard>), so any process can
+send() to it directly. When the channel joins a group on another shard,
+it gets a companion channel on that shard. A reader task forwards the
+companion's messages into the channel's local queue. group_add() must
+therefore be called by the process that created the channel, as
+consumers always do.
+
+Shards are health-checked every health_check_interval seconds, and only
+this check changes the ring. A failed send or receive is logged and
+raised (or retried) but does not move any group, so processes do not
+fall out of agreement on where a group lives over one error. A shard that
+fails the check leaves the ring. Groups this process is subscribed to are
+re-created on the shards they now hash to, and they move back once the
+shard recovers.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import random
+from collections import defaultdict
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "shard-"
+HEALTH_GROUP = "shard-health"
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes, virtual_nodes=100):
+        self._points = sorted(
+            (hash_key(f"{node}:{replica}"), node)
+            for node in nodes
+            for replica in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in self._points]
+
+    def get(self, key):
+        if not self._points:
+            raise RuntimeError("No healthy channel layer shards")
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._points)
+        return self._points[index][1]
+
+
+def build_layer(config):
+    return import_string(config["BACKEND"])(**config.get("CONFIG", {}))
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(self, shards, virtual_nodes=100, health_check_interval=5, health_check_timeout=2,
+                 release_delay=30, **kwargs):
+        super().__init__(**kwargs)
+        self.shards = [build_layer(config) for config in shards]
+        self.virtual_nodes = virtual_nodes
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.release_delay = release_delay
+
+        self.healthy = set(range(len(self.shards)))
+        self._ring = HashRing(sorted(self.healthy), virtual_nodes)
+        # Local state: logical channel -> {shard: channel on that shard}, the
+        # groups each local channel is in, and the per-channel receive queues.
+        self._incarnations = {}
+        self._groups = defaultdict(set)
+        self._refs = defaultdict(int)
+        self._queues = {}
+        self._readers = {}
+        self._releases = {}
+        self._health_task = None
+
+    # Placement
+
+    def shard_index(self, key):
+        return self._ring.get(key)
+
+    def shard_for(self, key):
+        return self.shards[self.shard_index(key)]
+
+    def _parse(self, channel):
+        if channel.startswith(CHANNEL_PREFIX) and "!" in channel:
+            index, _, name = channel[len(CHANNEL_PREFIX):].partition(".")
+            return int(index), name
+        return self.shard_index(channel), channel
+
+    # Channels
+
+    async def new_channel(self, prefix="specific."):
+        self._ensure_health_task()
+        home = random.choice(sorted(self.healthy))
+        name = await self.shards[home].new_channel(prefix)
+        channel = f"{CHANNEL_PREFIX}{home}.{name}"
+        self._incarnations[channel] = {home: name}
+        return channel
+
+    async def send(self, channel, message):
+        self.require_valid_channel_name(channel)
+        index, name = self._parse(channel)
+        await self.shards[index].send(name, message)
+
+    async def receive(self, channel):
+        self._ensure_health_task()
+        if channel not in self._incarnations:
+            index, name = self._parse(channel)
+            return await self.shards[index].receive(name)
+
+        release = self._releases.pop(channel, None)
+        if release:
+            release.cancel()
+        queue = self._queues.setdefault(channel, asyncio.Queue())
+        for index in list(self._incarnations[channel]):
+            self._ensure_reader(channel, index)
+
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # The consumer went away; stop reading for it unless it comes back.
+            self._releases[channel] = asyncio.get_running_loop().call_later(
+                self.release_delay, self._release, channel
+            )
+            raise
+
+    def _ensure_reader(self, channel, index):
+        reader = self._readers.get((channel, index))
+        if reader is None or reader.done():
+            self._readers[(channel, index)] = asyncio.ensure_future(self._read(channel, index))
+
+    async def _read(self, channel, index):
+        while index in self._incarnations.get(channel, {}):
+            try:
+                message = await self.shards[index].receive(self._incarnations[channel][index])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Receive from channel layer shard %s failed", index, exc_info=True)
+                await asyncio.sleep(self.health_check_interval)
+                continue
+            self._queues[channel].put_nowait(message)
+
+    def _release(self, channel):
+        self._releases.pop(channel, None)
+        for key in [key for key in self._readers if key[0] == channel]:
+            self._readers.pop(key).cancel()
+        self._queues.pop(channel, None)
+        if not any(channel in members for members in self._groups.values()):
+            self._incarnations.pop(channel, None)
+
+    async def _incarnation(self, channel, index):
+        incarnations = self._incarnations.get(channel)
+        if incarnations is None:
+            # Not created by this process: only its home shard is reachable.
+            return self._parse(channel)[1]
+        if index not in incarnations:
+            incarnations[index] = await self.shards[index].new_channel()
+            if channel in self._queues:
+                self._ensure_reader(channel, index)
+        return incarnations[index]
+
+    def _drop_incarnation(self, channel, index):
+        if self._refs.get((channel, index), 0) > 0:
+            return
+        self._refs.pop((channel, index), None)
+        # The home incarnation is the channel itself and stays until released.
+        if index != self._parse(channel)[0]:
+            self._incarnations.get(channel, {}).pop(index, None)
+            reader = self._readers.pop((channel, index), None)
+            if reader:
+                reader.cancel()
+
+    # Groups
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._ensure_health_task()
+        index = self.shard_index(group)
+        if channel not in self._groups[group]:
+            self._groups[group].add(channel)
+            self._refs[(channel, index)] += 1
+        await self.shards[index].group_add(group, await self._incarnation(channel, index))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        index = self.shard_index(group)
+        name = self._incarnations.get(channel, {}).get(index) or self._parse(channel)[1]
+        if channel in self._groups.get(group, ()):
+            self._groups[group].discard(channel)
+            if not self._groups[group]:
+                del self._groups[group]
+            self._refs[(channel, index)] -= 1
+        await self.shards[index].group_discard(group, name)
+        self._drop_incarnation(channel, index)
+
+    async def group_send(self, group, message):
+        self.require_valid_group_name(group)
+        await self.shards[self.shard_index(group)].group_send(group, message)
+
+    async def flush(self):
+        for shard in self.shards:
+            if hasattr(shard, "flush"):
+                await shard.flush()
+        for reader in self._readers.values():
+            reader.cancel()
+        self._incarnations.clear()
+        self._groups.clear()
+        self._refs.clear()
+        self._queues.clear()
+        self._readers.clear()
+
+    # Health checks and failover
+
+    def _ensure_health_task(self):
+        loop = asyncio.get_running_loop()
+        if self._health_task is None or self._health_task.done() or self._health_task.get_loop() is not loop:
+            self._health_task = loop.create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
+
+    async def ping(self, index):
+        try:
+            await asyncio.wait_for(
+                self.shards[index].group_send(HEALTH_GROUP, {"type": "health.check"}),
+                self.health_check_timeout,
+            )
+        except Exception:
+            return False
+        return True
+
+    async def check_health(self):
+        healthy = {index for index in range(len(self.shards)) if await self.ping(index)}
+        if healthy != self.healthy:
+            await self._rebalance(healthy)
+
+    async def _rebalance(self, healthy):
+        if not healthy:
+            logger.error("All channel layer shards are down")
+            return
+        logger.warning("Channel layer shards changed: %s -> %s", sorted(self.healthy), sorted(healthy))
+        old_ring = self._ring
+        self.healthy = set(healthy)
+        self._ring = HashRing(sorted(healthy), self.virtual_nodes)
+
+        for group, channels in list(self._groups.items()):
+            old, new = old_ring.get(group), self._ring.get(group)
+            if old == new:
+                continue
+            for channel in list(channels):
+                self._refs[(channel, old)] -= 1
+                self._refs[(channel, new)] += 1
+                try:
+                    await self.shards[new].group_add(group, await self._incarnation(channel, new))
+                except Exception:
+                    logger.warning("Could not move group %s to shard %s", group, new, exc_info=True)
+                if old in self.healthy:
+                    try:
+                        await self.shards[old].group_discard(group, self._incarnations[channel][old])
+                    except Exception:
+                        pass
+                self._drop_incarnation(channel, old)
@@ -0,0 +1,54 @@
+"""
+Websocket frame codecs.
+
+A connection picks its codec with ?codec=json|msgpack. JSON frames are
+sent as text, encoded with orjson when it is installed; msgpack frames
+are sent as binary (msgpack is always available, channels_redis uses it).
+"""
+import json
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    name = "json"
+    binary = False
+    library = "json" if orjson is None else "orjson"
+
+    if orjson is not None:
+        def encode(self, data):
+            return orjson.dumps(data).decode("utf8")
+
+        def decode(self, frame):
+            return orjson.loads(frame)
+    else:
+        def encode(self, data):
+            return json.dumps(data)
+
+        def decode(self, frame):
+            return json.loads(frame)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+    library = "msgpack"
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, frame):
+        return msgpack.unpackb(frame, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec())}
+DEFAULT_CODEC = CODECS["json"]
+
+
+def get_codec(name):
+    return CODECS.get(name, DEFAULT_CODEC)
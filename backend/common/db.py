@@ -0,0 +1,105 @@
+"""
+Database access from async code on separate read and write thread pools.
+
+channels' database_sync_to_async, like Django's async ORM methods (aexists,
+acreate, ... wrap sync_to_async(thread_sensitive=True)), runs every call of
+the process on one shared thread. A slow status fan-out then holds up the
+membership checks and connects queued behind it. Here reads and writes get
+their own pools, DB_READ_THREADS and DB_WRITE_THREADS threads big:
+
+    database_sync_to_async    short reads: users, chat members, history
+    database_write_to_async   anything that writes
+    database_primary_to_async reads on the read pool that must see the
+                              latest commit, never sent to a replica
+
+Each thread keeps its own connection, closed when stale as channels does.
+Queued and running calls and the wait for a thread are reported per pool
+to the instrumentation. database_sync_to_async calls may be routed to a
+read replica (common.db_routing).
+"""
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from .db_routing import primary_reads, replica_reads
+from .metrics import get_instrumentation
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(pool):
+    with _executors_lock:
+        executor = _executors.get(pool)
+        if executor is None:
+            size = settings.DB_WRITE_THREADS if pool == "write" else settings.DB_READ_THREADS
+            executor = _executors[pool] = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"db-{pool}")
+        return executor
+
+
+class Submission:
+    def __init__(self, pool):
+        self.pool = pool
+        self.submitted = time.perf_counter()
+        self._queued = True
+        self._lock = threading.Lock()
+
+    def dequeue(self):
+        """True for whoever takes the call off the queue first: its thread or its cancellation."""
+        with self._lock:
+            queued, self._queued = self._queued, False
+        return queued
+
+
+_submission = contextvars.ContextVar("db_submission", default=None)
+
+
+class PooledDatabaseSyncToAsync(DatabaseSyncToAsync):
+    pool = "read"
+    use_replicas = True
+
+    def __init__(self, func):
+        # Accounted inside the function: it runs in the context copied from
+        # the caller, the thread handler around it does not.
+        @functools.wraps(func)
+        def accounted(*args, **kwargs):
+            submission = _submission.get()
+            started = submission is not None and submission.dequeue()
+            if started:
+                get_instrumentation().db_started(self.pool, time.perf_counter() - submission.submitted)
+            try:
+                with replica_reads() if self.use_replicas else primary_reads():
+                    return func(*args, **kwargs)
+            finally:
+                if started:
+                    get_instrumentation().db_finished(self.pool)
+
+        super().__init__(accounted, thread_sensitive=False, executor=get_executor(self.pool))
+
+    async def __call__(self, *args, **kwargs):
+        submission = Submission(self.pool)
+        token = _submission.set(submission)
+        get_instrumentation().db_submitted(self.pool)
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            _submission.reset(token)
+            if submission.dequeue():
+                get_instrumentation().db_dropped(self.pool)
+
+
+class PrimaryDatabaseSyncToAsync(PooledDatabaseSyncToAsync):
+    use_replicas = False
+
+
+class WriteDatabaseSyncToAsync(PooledDatabaseSyncToAsync):
+    pool = "write"
+    use_replicas = False
+
+
+database_sync_to_async = PooledDatabaseSyncToAsync
+database_primary_to_async = PrimaryDatabaseSyncToAsync
+database_write_to_async = WriteDatabaseSyncToAsync
@@ -0,0 +1,218 @@
+"""
+Read replica routing with read-your-writes stickiness.
+
+With DB_REPLICA_HOSTS set, settings add a "replica_<n>" database per host
+and install ReplicaRouter. Writes and migrations always go to "default".
+Reads go there too unless they run under replica_reads(): the safe
+actions of viewsets using ReplicaReadsMixin and the consumers' calls on
+the read thread pool (common.db). Even then a replica is only used when:
+
+- the reading user has not written in the last DB_STICKY_SECONDS, so
+  people always read their own messages back. mark_written() is called
+  by the message services and by unsafe requests to those viewsets; the
+  mark is shared with other workers over the channel layer;
+- the replica's replay lag, measured at most every
+  DB_REPLICA_LAG_CHECK_INTERVAL seconds, is below DB_REPLICA_MAX_LAG.
+  Unreachable or lagging replicas are skipped until the next check.
+
+Reads inside a transaction on "default" stay on it.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connections, transaction
+from .cache import TTLCache
+from .listeners import GroupListener
+from .metrics import get_instrumentation
+
+logger = logging.getLogger(__name__)
+
+STICKY_GROUP = "db_sticky"
+
+_replica_reads = contextvars.ContextVar("replica_reads", default=False)
+_reader = contextvars.ContextVar("replica_reader", default=None)
+
+sticky_users = TTLCache(maxsize=settings.DB_STICKY_CACHE_SIZE, ttl=settings.DB_STICKY_SECONDS)
+
+_lags = {}
+_lags_lock = threading.Lock()
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith("replica_")]
+
+
+@contextmanager
+def replica_reads(user_id=None):
+    """Let reads go to a replica, unless user_id wrote recently."""
+    token = _replica_reads.set(True)
+    user_token = _reader.set(user_id) if user_id is not None else None
+    try:
+        yield
+    finally:
+        if user_token is not None:
+            _reader.reset(user_token)
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def reading_as(user_id):
+    """Name the user whose stickiness applies to replica reads below."""
+    token = _reader.set(user_id)
+    try:
+        yield
+    finally:
+        _reader.reset(token)
+
+
+# Stickiness
+
+def is_sticky(user_id):
+    until = sticky_users.get(int(user_id))
+    return until is not None and until > time.monotonic()
+
+
+def _stick(user_id, seconds):
+    sticky_users.set(int(user_id), time.monotonic() + seconds)
+
+
+def mark_written(*user_ids):
+    """Pin users to the primary for DB_STICKY_SECONDS after they wrote."""
+    if not replica_aliases():
+        return
+    window = settings.DB_STICKY_SECONDS
+    now = time.monotonic()
+    shared = []
+    for user_id in user_ids:
+        until = sticky_users.get(int(user_id))
+        _stick(user_id, window)
+        # Re-announce only once half of the shared window has passed.
+        if until is None or until - now < window / 2:
+            shared.append(int(user_id))
+    if shared:
+        transaction.on_commit(lambda: _share(shared), robust=True)
+
+
+def _share(user_ids):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    async_to_sync(layer.group_send)(STICKY_GROUP, {
+        "type": "db.sticky",
+        "user_ids": user_ids,
+        "seconds": settings.DB_STICKY_SECONDS,
+    })
+
+
+def _apply_sticky(event):
+    for user_id in event["user_ids"]:
+        _stick(user_id, event["seconds"])
+
+
+_listener = GroupListener(STICKY_GROUP, "db.sticky", _apply_sticky)
+
+
+async def ensure_listener():
+    """Subscribe this worker to other workers' stickiness marks."""
+    if replica_aliases():
+        await _listener.ensure()
+
+
+# Replica lag
+
+def measure_lag(alias):
+    connection = connections[alias]
+    if connection.vendor != "postgresql":
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+def replica_lag(alias):
+    now = time.monotonic()
+    with _lags_lock:
+        checked_at, lag = _lags.get(alias, (None, None))
+        if checked_at is not None and now - checked_at < settings.DB_REPLICA_LAG_CHECK_INTERVAL:
+            return lag
+        # Other threads keep using the previous value while this one measures.
+        _lags[alias] = (now, lag if lag is not None else float("inf"))
+
+    try:
+        lag = measure_lag(alias)
+    except Exception:
+        logger.warning("Could not measure lag of database %s", alias, exc_info=True)
+        lag = float("inf")
+    with _lags_lock:
+        _lags[alias] = (time.monotonic(), lag)
+    get_instrumentation().replica_lag(alias, lag)
+    return lag
+
+
+def healthy_replicas():
+    return [alias for alias in replica_aliases() if replica_lag(alias) <= settings.DB_REPLICA_MAX_LAG]
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _replica_reads.get() or connections["default"].in_atomic_block:
+            return "default"
+        reader = _reader.get()
+        if reader is not None and is_sticky(reader):
+            get_instrumentation().read_routed("sticky")
+            return "default"
+        replicas = healthy_replicas()
+        if not replicas:
+            get_instrumentation().read_routed("lagging")
+            return "default"
+        get_instrumentation().read_routed("replica")
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+class ReplicaReadsMixin:
+    """
+    Viewset mixin: safe requests read from replicas, unsafe ones make the
+    user sticky to the primary.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in ("GET", "HEAD", "OPTIONS"):
+            self._replica_token = _replica_reads.set(True)
+            self._reader_token = _reader.set(request.user.id)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, "_replica_token", None)
+        if token is not None:
+            _reader.reset(self._reader_token)
+            _replica_reads.reset(token)
+            self._replica_token = None
+        elif request.method not in ("GET", "HEAD", "OPTIONS") and request.user.is_authenticated:
+            mark_written(request.user.id)
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,61 @@
+"""
+Worker-wide subscriptions to invalidation groups on the channel layer.
+
+Caches kept per process (memberships, user changes, write stickiness)
+learn about changes made on other workers from events sent to a group.
+Channel layers drop group members after `group_expiry` (a day by default),
+so a listener that joined once would silently stop hearing them; the group
+is joined again every half expiry while the listener runs.
+"""
+import asyncio
+import logging
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GROUP_EXPIRY = 86400
+
+
+def group_expiry(layer):
+    shards = getattr(layer, "shards", None) or [layer]
+    return min(getattr(shard, "group_expiry", DEFAULT_GROUP_EXPIRY) for shard in shards)
+
+
+class GroupListener:
+    """Call `handler(event)` for every event of `event_type` sent to `group`."""
+
+    def __init__(self, group, event_type, handler):
+        self.group = group
+        self.event_type = event_type
+        self.handler = handler
+        self._task = None
+
+    async def ensure(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+
+        layer = get_channel_layer()
+        if layer is None:
+            return
+        channel = await layer.new_channel()
+        await layer.group_add(self.group, channel)
+        self._task = loop.create_task(self._listen(layer, channel))
+
+    async def _listen(self, layer, channel):
+        rejoin = asyncio.ensure_future(self._rejoin(layer, channel))
+        try:
+            while True:
+                event = await layer.receive(channel)
+                if event.get("type") == self.event_type:
+                    self.handler(event)
+        finally:
+            rejoin.cancel()
+
+    async def _rejoin(self, layer, channel):
+        while True:
+            await asyncio.sleep(group_expiry(layer) / 2)
+            try:
+                await layer.group_add(self.group, channel)
+            except Exception:
+                logger.warning("Could not rejoin group %s", self.group, exc_info=True)
@@ -0,0 +1,414 @@
+"""
+In-process metrics with a Prometheus text exposition.
+
+Counters, gauges and histograms live in a process-wide registry and are
+served in the Prometheus text format by the /metrics/ view. Every worker
+process exposes its own numbers. Histograms also keep their last
+METRICS_HISTOGRAM_SAMPLES observations per label set, so tests and
+benchmarks can read percentiles without scraping:
+
+    metrics.registry.get("ws_event_seconds").percentile(95, consumer="chat", event="message")
+
+The websocket layer reports through an instrumentation object
+(get_instrumentation()). Its class is set by WS_INSTRUMENTATION, so it
+can be replaced, e.g. by NullInstrumentation to turn recording off or by
+a subclass that also forwards to statsd.
+
+Queries run while a websocket event is handled are timed by an execute
+wrapper on every connection. The current event travels in a contextvar,
+which common.db copies into its worker threads.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.utils.module_loading import import_string
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        # For counts kept elsewhere, e.g. by the connection pool.
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class HistogramValue:
+    def __init__(self, buckets, samples):
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.samples = deque(maxlen=samples)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = HistogramValue(self.buckets, settings.METRICS_HISTOGRAM_SAMPLES)
+            entry.counts[bisect.bisect_left(self.buckets, value)] += 1
+            entry.count += 1
+            entry.sum += value
+            entry.samples.append(value)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return entry.count if entry else 0
+
+    def sum(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return entry.sum if entry else 0
+
+    def percentile(self, pct, **labels):
+        """pct-th percentile of the recent samples, None without any."""
+        entry = self._values.get(self._key(labels))
+        if not entry or not entry.samples:
+            return None
+        ordered = sorted(entry.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def _render_value(self, key, entry):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, entry.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(entry.sum)}")
+        lines.append(f"{self.name}_count{labels} {entry.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def collector(self, func):
+        """Register func to refresh metrics kept elsewhere before each render."""
+        self._collectors.append(func)
+        return func
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def reset(self):
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def render(self):
+        for collect in self._collectors:
+            collect()
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+WS_CONNECTIONS = registry.gauge(
+    "ws_connections", "Open websocket connections", ["consumer"])
+WS_EVENT_SECONDS = registry.histogram(
+    "ws_event_seconds", "Time spent handling an inbound websocket frame", ["consumer", "event"])
+WS_EVENT_DB_SECONDS = registry.histogram(
+    "ws_event_db_seconds", "Database time spent handling an inbound websocket frame", ["consumer", "event"])
+WS_EVENT_QUERIES = registry.histogram(
+    "ws_event_queries", "Queries run while handling an inbound websocket frame", ["consumer", "event"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+WS_EVENT_BYTES = registry.histogram(
+    "ws_event_bytes", "Size of inbound websocket frames", ["consumer", "event"], buckets=SIZE_BUCKETS)
+WS_SENT_BYTES = registry.histogram(
+    "ws_sent_bytes", "Size of outbound websocket frames", ["consumer", "event"], buckets=SIZE_BUCKETS)
+WS_AUTH_SECONDS = registry.histogram(
+    "ws_auth_seconds", "Time spent authenticating a websocket handshake", ["outcome"])
+DB_WAIT_SECONDS = registry.histogram(
+    "db_sync_wait_seconds", "Time a database call from async code waited for a worker thread", ["pool"])
+DB_QUEUED = registry.gauge(
+    "db_executor_queued", "Database calls from async code waiting for a worker thread", ["pool"])
+DB_ACTIVE = registry.gauge(
+    "db_executor_active", "Database calls from async code running on a worker thread", ["pool"])
+DB_POOL_STATS = {
+    "pool_size": registry.gauge(
+        "db_pool_connections", "Connections held by the pool", ["alias"]),
+    "pool_available": registry.gauge(
+        "db_pool_idle_connections", "Idle connections in the pool", ["alias"]),
+    "requests_waiting": registry.gauge(
+        "db_pool_waiting_requests", "Requests waiting for a pooled connection", ["alias"]),
+    "requests_num": registry.counter(
+        "db_pool_requests_total", "Connections requested from the pool", ["alias"]),
+    "requests_wait_ms": registry.counter(
+        "db_pool_request_wait_ms_total", "Milliseconds spent waiting for a pooled connection", ["alias"]),
+    "requests_errors": registry.counter(
+        "db_pool_request_errors_total", "Requests that timed out waiting for a connection", ["alias"]),
+    "connections_num": registry.counter(
+        "db_pool_connects_total", "Connections opened by the pool", ["alias"]),
+    "connections_errors": registry.counter(
+        "db_pool_connect_errors_total", "Failed connection attempts of the pool", ["alias"]),
+    "connections_lost": registry.counter(
+        "db_pool_lost_connections_total", "Pooled connections that failed their health check", ["alias"]),
+}
+FANOUT_RECIPIENTS = registry.histogram(
+    "chat_fanout_recipients", "Recipients of a published chat event", ["event"], buckets=FANOUT_BUCKETS)
+PUBLISH_SECONDS = registry.histogram(
+    "chat_publish_seconds", "Time spent publishing a chat event to the channel layer", ["event"])
+DB_REPLICA_LAG = registry.gauge(
+    "db_replica_lag_seconds", "Last measured replay lag of a read replica", ["alias"])
+DB_READ_ROUTES = registry.counter(
+    "db_read_routes_total", "Replica-eligible reads by where they were sent", ["target"])
+
+
+@registry.collector
+def collect_pool_stats():
+    from django.db import connections
+
+    for alias in connections:
+        connection = connections[alias]
+        if connection.vendor != "postgresql" or not connection.settings_dict["OPTIONS"].get("pool"):
+            continue
+        stats = connection.pool.get_stats()
+        for stat, metric in DB_POOL_STATS.items():
+            metric.set(stats.get(stat, 0), alias=alias)
+
+
+class EventTiming:
+    def __init__(self, consumer, size):
+        self.consumer = consumer
+        self.size = size
+        self.event = "unknown"
+        self.db_seconds = 0
+        self.queries = 0
+        self.started = time.perf_counter()
+
+
+current_event = contextvars.ContextVar("current_event", default=None)
+
+
+class NullInstrumentation:
+    """Hook interface of the websocket layer; records nothing."""
+
+    def event_started(self, consumer, size):
+        timing = EventTiming(consumer, size)
+        return timing, current_event.set(timing)
+
+    def event_finished(self, timing, token):
+        current_event.reset(token)
+
+    def event_type(self, event_type):
+        timing = current_event.get()
+        if timing is not None and isinstance(event_type, str):
+            timing.event = event_type
+
+    def query(self, seconds):
+        timing = current_event.get()
+        if timing is not None:
+            timing.db_seconds += seconds
+            timing.queries += 1
+
+    def connection_opened(self, consumer):
+        pass
+
+    def connection_closed(self, consumer):
+        pass
+
+    def frame_sent(self, consumer, event_type, size):
+        pass
+
+    def authenticated(self, outcome, seconds):
+        pass
+
+    def db_submitted(self, pool):
+        pass
+
+    def db_started(self, pool, wait):
+        pass
+
+    def db_finished(self, pool):
+        pass
+
+    def db_dropped(self, pool):
+        pass
+
+    def fan_out(self, event_type, recipients):
+        pass
+
+    def published(self, event_type, seconds):
+        pass
+
+    def replica_lag(self, alias, seconds):
+        pass
+
+    def read_routed(self, target):
+        pass
+
+
+class Instrumentation(NullInstrumentation):
+    """Records the websocket hooks into the metrics registry."""
+
+    def event_finished(self, timing, token):
+        super().event_finished(timing, token)
+        labels = {"consumer": timing.consumer, "event": timing.event}
+        WS_EVENT_SECONDS.observe(time.perf_counter() - timing.started, **labels)
+        WS_EVENT_DB_SECONDS.observe(timing.db_seconds, **labels)
+        WS_EVENT_QUERIES.observe(timing.queries, **labels)
+        WS_EVENT_BYTES.observe(timing.size, **labels)
+
+    def connection_opened(self, consumer):
+        WS_CONNECTIONS.inc(consumer=consumer)
+
+    def connection_closed(self, consumer):
+        WS_CONNECTIONS.dec(consumer=consumer)
+
+    def frame_sent(self, consumer, event_type, size):
+        WS_SENT_BYTES.observe(size, consumer=consumer, event=event_type)
+
+    def authenticated(self, outcome, seconds):
+        WS_AUTH_SECONDS.observe(seconds, outcome=outcome)
+
+    def db_submitted(self, pool):
+        DB_QUEUED.inc(pool=pool)
+
+    def db_started(self, pool, wait):
+        DB_QUEUED.dec(pool=pool)
+        DB_ACTIVE.inc(pool=pool)
+        DB_WAIT_SECONDS.observe(wait, pool=pool)
+
+    def db_finished(self, pool):
+        DB_ACTIVE.dec(pool=pool)
+
+    def db_dropped(self, pool):
+        DB_QUEUED.dec(pool=pool)
+
+    def fan_out(self, event_type, recipients):
+        FANOUT_RECIPIENTS.observe(recipients, event=event_type)
+
+    def published(self, event_type, seconds):
+        PUBLISH_SECONDS.observe(seconds, event=event_type)
+
+    def replica_lag(self, alias, seconds):
+        DB_REPLICA_LAG.set(seconds, alias=alias)
+
+    def read_routed(self, target):
+        DB_READ_ROUTES.inc(target=target)
+
+
+_instrumentation = None
+
+
+def get_instrumentation():
+    global _instrumentation
+    if _instrumentation is None:
+        _instrumentation = import_string(settings.WS_INSTRUMENTATION)()
+    return _instrumentation
+
+
+def time_query(execute, sql, params, many, context):
+    if current_event.get() is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        get_instrumentation().query(time.perf_counter() - started)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(install_query_timer)
@@ -0,0 +1,166 @@
+"""
+Small async key/value store shared by all workers.
+
+It lives in the Redis instance(s) behind the channel layer, keys being
+placed with the layer's own consistent hash (with ShardedChannelLayer,
+first on the shard the key hashes to). With any other channel layer
+(InMemoryChannelLayer in tests and local runs) a process-local stand-in
+with the same interface is used.
+"""
+import time
+from channels.layers import get_channel_layer
+
+KEY_PREFIX = "chatstore:"
+
+
+def _decode(value):
+    return value.decode("utf8") if isinstance(value, bytes) else value
+
+
+def _ms(ttl):
+    # TTLs are seconds and may be fractional (typing windows are 0.5s).
+    return None if ttl is None else max(int(ttl * 1000), 1)
+
+
+class RedisStore:
+    def __init__(self, layer):
+        self.layer = layer
+
+    def _conn(self, key):
+        layer = self.layer.shard_for(key) if hasattr(self.layer, "shard_for") else self.layer
+        return layer.connection(layer.consistent_hash(key))
+
+    async def get(self, key):
+        return _decode(await self._conn(key).get(KEY_PREFIX + key))
+
+    async def set(self, key, value, ttl=None):
+        await self._conn(key).set(KEY_PREFIX + key, value, px=_ms(ttl))
+
+    async def set_if_absent(self, key, value, ttl=None):
+        return bool(await self._conn(key).set(KEY_PREFIX + key, value, px=_ms(ttl), nx=True))
+
+    async def delete(self, key):
+        await self._conn(key).delete(KEY_PREFIX + key)
+
+    async def hset(self, key, field, value):
+        await self._conn(key).hset(KEY_PREFIX + key, field, value)
+
+    async def hset_if_absent(self, key, field, value):
+        return bool(await self._conn(key).hsetnx(KEY_PREFIX + key, field, value))
+
+    async def hdel(self, key, *fields):
+        """Remove fields of a hash. Returns how many existed."""
+        if not fields:
+            return 0
+        return await self._conn(key).hdel(KEY_PREFIX + key, *fields)
+
+    async def hgetall(self, key):
+        data = await self._conn(key).hgetall(KEY_PREFIX + key)
+        return {_decode(k): _decode(v) for k, v in data.items()}
+
+    async def hmget(self, key, fields):
+        if not fields:
+            return []
+        return [_decode(v) for v in await self._conn(key).hmget(KEY_PREFIX + key, fields)]
+
+    async def expire(self, key, ttl):
+        await self._conn(key).pexpire(KEY_PREFIX + key, _ms(ttl))
+
+    async def zadd(self, key, score, member):
+        await self._conn(key).zadd(KEY_PREFIX + key, {member: score})
+
+    async def zrangebyscore(self, key, min_score):
+        return [_decode(v) for v in await self._conn(key).zrangebyscore(KEY_PREFIX + key, min_score, "+inf")]
+
+    async def ztrim(self, key, size):
+        """Keep only the `size` highest scored members."""
+        await self._conn(key).zremrangebyrank(KEY_PREFIX + key, 0, -size - 1)
+
+
+class MemoryStore:
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+
+    def _alive(self, key):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at < time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _hash(self, key):
+        if not self._alive(key):
+            self._data[key] = {}
+        return self._data[key]
+
+    async def get(self, key):
+        return self._data[key] if self._alive(key) else None
+
+    async def set(self, key, value, ttl=None):
+        self._data[key] = str(value)
+        if ttl:
+            self._expires[key] = time.monotonic() + ttl
+        else:
+            self._expires.pop(key, None)
+
+    async def set_if_absent(self, key, value, ttl=None):
+        if self._alive(key):
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+        self._expires.pop(key, None)
+
+    async def hset(self, key, field, value):
+        self._hash(key)[str(field)] = str(value)
+
+    async def hset_if_absent(self, key, field, value):
+        data = self._hash(key)
+        if str(field) in data:
+            return False
+        data[str(field)] = str(value)
+        return True
+
+    async def hdel(self, key, *fields):
+        if not self._alive(key):
+            return 0
+        data = self._data[key]
+        return len([field for field in fields if data.pop(str(field), None) is not None])
+
+    async def hgetall(self, key):
+        return dict(self._data[key]) if self._alive(key) else {}
+
+    async def hmget(self, key, fields):
+        data = self._data[key] if self._alive(key) else {}
+        return [data.get(str(field)) for field in fields]
+
+    async def expire(self, key, ttl):
+        if self._alive(key):
+            self._expires[key] = time.monotonic() + ttl
+
+    async def zadd(self, key, score, member):
+        self._hash(key)[member] = float(score)
+
+    async def zrangebyscore(self, key, min_score):
+        data = self._data[key] if self._alive(key) else {}
+        return [member for member, score in sorted(data.items(), key=lambda item: item[1]) if score >= min_score]
+
+    async def ztrim(self, key, size):
+        if self._alive(key):
+            data = self._data[key]
+            for member, _ in sorted(data.items(), key=lambda item: item[1])[:max(len(data) - size, 0)]:
+                del data[member]
+
+
+_memory_store = MemoryStore()
+
+
+def get_store():
+    layer = get_channel_layer()
+    backend = layer.shards[0] if hasattr(layer, "shard_for") else layer
+    if hasattr(backend, "connection") and hasattr(backend, "consistent_hash"):
+        return RedisStore(layer)
+    return _memory_store
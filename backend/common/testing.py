@@ -0,0 +1,27 @@
+"""
+Fixtures shared by the apps' tests.
+"""
+from rest_framework.test import APIClient
+from chats.models import Chat
+from users.models import User
+
+
+def create_user(username):
+    return User.objects.create_user(username=username, password="secret")
+
+
+def create_users(*usernames):
+    return [create_user(username) for username in usernames]
+
+
+def create_group(*members, name="group"):
+    chat = Chat.objects.create(type=Chat.GROUP, name=name)
+    chat.members.add(*members)
+    return chat
+
+
+def api_client(user):
+    """An APIClient authenticated as `user`."""
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
@@ -0,0 +1,277 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from unittest import mock
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from chat_messages.events import publish
+from users.models import User
+from . import channel_layers, db_routing, listeners, metrics
+from .channel_layers import HashRing, ShardedChannelLayer
+from .db import database_primary_to_async, database_sync_to_async, database_write_to_async
+from .testing import api_client, create_group, create_user
+
+
+class FlakyChannelLayer(InMemoryChannelLayer):
+    down = False
+
+    async def group_send(self, group, message):
+        if self.down:
+            raise ConnectionError("shard is down")
+        await super().group_send(group, message)
+
+
+def sharded_layer(shards=3):
+    return ShardedChannelLayer(
+        shards=[{"BACKEND": "common.tests.FlakyChannelLayer"} for _ in range(shards)],
+        health_check_interval=3600,
+    )
+
+
+class HashRingTests(SimpleTestCase):
+    keys = [f"chat_{chat_id}" for chat_id in range(3000)]
+
+    def test_keys_spread_over_all_nodes(self):
+        placement = Counter(HashRing([0, 1, 2]).get(key) for key in self.keys)
+        self.assertEqual(set(placement), {0, 1, 2})
+        for count in placement.values():
+            self.assertLess(abs(count - 1000), 250)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        before, after = HashRing([0, 1, 2]), HashRing([0, 2])
+        moved = [key for key in self.keys if before.get(key) != after.get(key)]
+        self.assertTrue(moved)
+        self.assertTrue(all(before.get(key) == 1 for key in moved))
+
+
+class ShardedChannelLayerTests(SimpleTestCase):
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 1)
+
+    async def test_group_moves_when_the_health_check_drops_its_shard(self):
+        layer = sharded_layer()
+        channel = await layer.new_channel()
+        await layer.group_add("chat_1", channel)
+        index = layer.shard_index("chat_1")
+
+        layer.shards[index].down = True
+        with self.assertRaises(ConnectionError):
+            await layer.group_send("chat_1", {"type": "chat.message"})
+        # One failed operation does not change the ring, only the check does.
+        self.assertEqual(layer.shard_index("chat_1"), index)
+
+        with self.assertLogs(channel_layers.logger):
+            await layer.check_health()
+        self.assertNotIn(index, layer.healthy)
+        await layer.group_send("chat_1", {"type": "chat.message", "text": "moved"})
+        self.assertEqual((await self.receive(layer, channel))["text"], "moved")
+
+        layer.shards[index].down = False
+        with self.assertLogs(channel_layers.logger):
+            await layer.check_health()
+        self.assertEqual(layer.shard_index("chat_1"), index)
+        await layer.group_send("chat_1", {"type": "chat.message", "text": "back"})
+        self.assertEqual((await self.receive(layer, channel))["text"], "back")
+
+    async def test_refs_are_released_with_the_groups(self):
+        layer = sharded_layer()
+        channel = await layer.new_channel()
+        home = layer._parse(channel)[0]
+        groups = [f"chat_{chat_id}" for chat_id in range(20)]
+        for group in groups:
+            await layer.group_add(group, channel)
+        self.assertEqual(set(layer._incarnations[channel]), {layer.shard_index(group) for group in groups} | {home})
+
+        await layer.check_health()
+        for group in groups:
+            await layer.group_discard(group, channel)
+
+        self.assertEqual(dict(layer._refs), {})
+        self.assertEqual(dict(layer._groups), {})
+        self.assertEqual(set(layer._incarnations[channel]), {home})
+
+
+class GroupListenerTests(SimpleTestCase):
+    async def test_group_is_rejoined_before_it_expires(self):
+        layer = InMemoryChannelLayer(group_expiry=1)
+        received = []
+        listener = listeners.GroupListener("invalidations", "cache.changed", received.append)
+        with mock.patch.object(listeners, "get_channel_layer", return_value=layer):
+            await listener.ensure()
+            await listener.ensure()
+        # Past the expiry of the first join; the layer drops stale members on send.
+        await asyncio.sleep(2.2)
+        await layer.group_send("invalidations", {"type": "cache.changed", "key": 1})
+        await layer.group_send("invalidations", {"type": "other"})
+        await asyncio.sleep(0.05)
+        listener._task.cancel()
+
+        self.assertEqual(received, [{"type": "cache.changed", "key": 1}])
+        self.assertEqual(len(layer.groups["invalidations"]), 1)
+
+
+@mock.patch.object(db_routing, "replica_lag", return_value=0)
+@mock.patch.object(db_routing, "replica_aliases", return_value=["replica_0"])
+class ReplicaRouterTests(TransactionTestCase):
+    def setUp(self):
+        db_routing.sticky_users.clear()
+        self.router = db_routing.ReplicaRouter()
+
+    def read_db(self, user_id=None):
+        with db_routing.replica_reads(user_id):
+            return self.router.db_for_read(User)
+
+    def test_reads_go_to_a_replica_only_when_allowed(self, aliases, lag):
+        self.assertEqual(self.router.db_for_read(User), "default")
+        self.assertEqual(self.read_db(), "replica_0")
+        with db_routing.replica_reads(), db_routing.primary_reads():
+            self.assertEqual(self.router.db_for_read(User), "default")
+        with transaction.atomic():
+            self.assertEqual(self.read_db(), "default")
+        self.assertEqual(self.router.db_for_write(User), "default")
+
+        lag.return_value = 10
+        self.assertEqual(self.read_db(), "default")
+
+    @override_settings(DB_STICKY_SECONDS=0.2)
+    def test_reads_after_a_write_stay_on_the_primary_for_the_sticky_window(self, aliases, lag):
+        user = create_user("writer")
+        chat = create_group(user)
+        client = api_client(user)
+
+        self.assertEqual(self.read_db(user.id), "replica_0")
+        response = client.post(f"/api/chats/{chat.id}/messages/", {"text": "hello"}, format="json")
+        self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(self.read_db(user.id), "default")
+        self.assertEqual(self.read_db(user.id + 1), "replica_0")
+        time.sleep(0.25)
+        self.assertEqual(self.read_db(user.id), "replica_0")
+
+    async def test_stickiness_from_other_workers_is_applied(self, aliases, lag):
+        await db_routing.ensure_listener()
+        await get_channel_layer().group_send(db_routing.STICKY_GROUP, {
+            "type": "db.sticky",
+            "user_ids": [42],
+            "seconds": 5,
+        })
+        for _ in range(50):
+            if db_routing.is_sticky(42):
+                break
+            await asyncio.sleep(0.01)
+
+        self.assertTrue(db_routing.is_sticky(42))
+        self.assertEqual(self.read_db(42), "default")
+
+
+class DatabaseExecutorTests(SimpleTestCase):
+    @staticmethod
+    def where():
+        return (
+            threading.current_thread().name.split("_")[0],
+            db_routing._replica_reads.get(),
+            db_routing._reader.get(),
+        )
+
+    async def test_reads_and_writes_run_on_separate_pools(self):
+        with db_routing.reading_as(7):
+            read = await database_sync_to_async(self.where)()
+            primary = await database_primary_to_async(self.where)()
+            write = await database_write_to_async(self.where)()
+
+        self.assertEqual(read, ("db-read", True, 7))
+        self.assertEqual(primary, ("db-read", False, 7))
+        self.assertEqual(write, ("db-write", False, 7))
+
+
+@override_settings(METRICS_HISTOGRAM_SAMPLES=3)
+class MetricsRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counters_and_gauges(self):
+        sent = self.registry.counter("sent_total", "Sent", ["kind"])
+        self.assertIs(self.registry.counter("sent_total", "Sent", ["kind"]), sent)
+        sent.inc(kind="a")
+        sent.inc(2, kind="a")
+        open_ = self.registry.gauge("open", "Open")
+        open_.inc()
+        open_.dec()
+        open_.inc(3)
+
+        self.assertEqual(sent.value(kind="a"), 3)
+        self.assertEqual(sent.value(kind="b"), 0)
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP open Open",
+            "# TYPE open gauge",
+            "open 3",
+            "# HELP sent_total Sent",
+            "# TYPE sent_total counter",
+            'sent_total{kind="a"} 3',
+        ]) + "\n")
+
+    def test_histogram_buckets_and_percentiles(self):
+        latency = self.registry.histogram("latency", "Latency", ["event"], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            latency.observe(value, event='say "hi"')
+
+        labels = {"event": 'say "hi"'}
+        self.assertEqual((latency.count(**labels), latency.sum(**labels)), (4, 2.65))
+        # Only the last METRICS_HISTOGRAM_SAMPLES observations are kept.
+        self.assertEqual(latency.percentile(0, **labels), 0.1)
+        self.assertEqual(latency.percentile(99, **labels), 2)
+        self.assertIsNone(latency.percentile(50, event="other"))
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'latency_bucket{event="say \\"hi\\"",le="0.1"} 2',
+            'latency_bucket{event="say \\"hi\\"",le="1"} 3',
+            'latency_bucket{event="say \\"hi\\"",le="+Inf"} 4',
+            'latency_sum{event="say \\"hi\\""} 2.65',
+            'latency_count{event="say \\"hi\\""} 4',
+        ])
+
+        self.registry.reset()
+        self.assertEqual(latency.count(**labels), 0)
+
+    def test_collectors_run_before_each_render(self):
+        pooled = self.registry.gauge("pooled", "Pooled")
+        self.registry.collector(lambda: pooled.inc())
+        self.registry.render()
+        self.assertIn("pooled 2", self.registry.render())
+
+    async def test_publish_is_timed_per_event_type(self):
+        metrics.PUBLISH_SECONDS.reset()
+        layer = InMemoryChannelLayer()
+        with mock.patch.object(metrics, "_instrumentation", metrics.Instrumentation()):
+            await publish(layer, 1, {"type": "typing_update", "users": [{"id": 2, "username": "bob"}]})
+            await publish(layer, 1, {"type": "message_delete", "message_id": 5})
+
+        self.assertEqual(metrics.PUBLISH_SECONDS.count(event="typing_update"), 1)
+        self.assertEqual(metrics.PUBLISH_SECONDS.count(event="message_delete"), 1)
+
+
+class MetricsViewTests(SimpleTestCase):
+    def scrape(self, **headers):
+        return self.client.get("/metrics/", headers=headers)
+
+    @override_settings(METRICS_TOKEN="s3cret", DEBUG=False)
+    def test_token_is_required(self):
+        self.assertEqual(self.scrape().status_code, 401)
+        self.assertEqual(self.scrape(Authorization="Bearer wrong").status_code, 401)
+        self.assertEqual(self.scrape(Authorization="Bearer s3crét").status_code, 401)
+
+        response = self.scrape(Authorization="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        self.assertIn("# TYPE ws_event_seconds histogram", response.content.decode())
+
+    @override_settings(METRICS_TOKEN="пароль", DEBUG=False)
+    def test_non_ascii_token(self):
+        self.assertEqual(self.scrape(Authorization="Bearer wrong").status_code, 401)
+
+    @override_settings(METRICS_TOKEN="", DEBUG=False)
+    def test_hidden_without_a_token_outside_debug(self):
+        self.assertEqual(self.scrape().status_code, 404)
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.scrape().status_code, 200)
@@ -0,0 +1,16 @@
+import hmac
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from .metrics import registry
+
+
+def metrics(request):
+    """Prometheus scrape endpoint for this process, only served with a token or in DEBUG."""
+    if settings.METRICS_TOKEN:
+        # compare_digest() only takes ASCII str; headers and tokens may not be.
+        expected = f"Bearer {settings.METRICS_TOKEN}".encode()
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), expected):
+            return HttpResponse(status=401)
+    elif not settings.DEBUG:
+        raise Http404
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,68 @@
+"""
+Process-local caches behind websocket authentication.
+
+`resolved_users` holds users looked up for tokens without a username claim.
+`changed_users` remembers, for one access token lifetime, the current
+username of users that were renamed, deactivated (None) or deleted (None),
+so tokens issued before the change are rejected without a query.
+
+Both are filled by user_changed(), which the User signals call on commit:
+it applies the change locally and publishes it on the channel layer so
+every other worker does the same. A worker only knows about changes made
+after it subscribed, i.e. after its first websocket handshake.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from rest_framework_simplejwt.settings import api_settings
+from common.cache import TTLCache
+from common.listeners import GroupListener
+
+INVALIDATION_GROUP = "user_changes"
+
+# user id -> TokenPrincipal for tokens issued without a username claim.
+resolved_users = TTLCache(
+    maxsize=settings.JWT_USER_CACHE_SIZE,
+    ttl=settings.JWT_USER_CACHE_TTL,
+)
+
+# user id -> current username, or None if the user can no longer log in.
+changed_users = TTLCache(
+    maxsize=settings.JWT_USER_CHANGES_SIZE,
+    ttl=api_settings.ACCESS_TOKEN_LIFETIME.total_seconds(),
+)
+
+
+def _apply(user_id, username):
+    resolved_users.delete(user_id)
+    changed_users.set(user_id, username)
+
+
+def _apply_event(event):
+    _apply(event["user_id"], event["username"])
+
+
+_listener = GroupListener(INVALIDATION_GROUP, "user.changed", _apply_event)
+
+
+async def ensure_listener():
+    """Subscribe this worker to user changes made by other workers."""
+    await _listener.ensure()
+
+
+def _publish(user_id, username):
+    _apply(user_id, username)
+
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    async_to_sync(layer.group_send)(INVALIDATION_GROUP, {
+        "type": "user.changed",
+        "user_id": user_id,
+        "username": username,
+    })
+
+
+def user_changed(user_id, username):
+    transaction.on_commit(lambda: _publish(user_id, username), robust=True)
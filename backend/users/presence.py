@@ -0,0 +1,239 @@
+"""
+Presence tracking for websocket connections.
+
+Each open socket registers itself in the shared store under its channel
+name with an expiry that the consumer's heartbeat keeps pushing forward,
+so a user stays online while at least one live socket exists, no matter
+how many tabs or workers are involved. Going offline is debounced by
+PRESENCE_OFFLINE_GRACE seconds to absorb reloads and reconnects, and
+UserStatus rows are written lazily in batches.
+
+The grace timer lives in the worker that saw the last socket close. Users
+whose worker died without closing its sockets are found by a sweep, run by
+one worker every PRESENCE_SWEEP_INTERVAL seconds: online users with no
+unexpired connection left and no grace timer pending go offline.
+
+A batch of status rows that fails to write is retried one user at a time,
+so one bad row (a deleted user, say) does not hold back the others; a
+user's change that keeps failing is dropped after
+PRESENCE_FLUSH_MAX_ATTEMPTS flushes.
+
+Presence changes go to the presence_<user_id> group only, which sockets
+join for the users they are interested in.
+"""
+import asyncio
+import atexit
+import logging
+import math
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+from common.db import database_write_to_async
+from common.store import get_store
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = "presence:state"
+SWEEP_KEY = "presence:sweep"
+
+
+def connections_key(user_id):
+    return f"presence:{user_id}"
+
+
+def leaving_key(user_id):
+    return f"presence:leaving:{user_id}"
+
+
+def presence_group(user_id):
+    return f"presence_{user_id}"
+
+
+class PresenceService:
+    def __init__(self):
+        self._pending_offline = {}
+        self._dirty = {}
+        self._attempts = {}
+        self._flusher = None
+
+    async def _live_connections(self, user_id):
+        store = get_store()
+        connections = await store.hgetall(connections_key(user_id))
+        now = time.time()
+        expired = [name for name, expires_at in connections.items() if float(expires_at) <= now]
+        await store.hdel(connections_key(user_id), *expired)
+        return len(connections) - len(expired)
+
+    async def _register(self, user_id, channel_name):
+        store = get_store()
+        key = connections_key(user_id)
+        await store.hset(key, channel_name, time.time() + settings.PRESENCE_CONNECTION_TTL)
+        await store.expire(key, settings.PRESENCE_CONNECTION_TTL)
+
+    async def connect(self, user_id, channel_name):
+        self._ensure_flusher()
+        await self._register(user_id, channel_name)
+
+        pending = self._pending_offline.pop(user_id, None)
+        if pending:
+            pending.cancel()
+
+        # Set-if-absent: of concurrent connects, only one announces the user.
+        if await get_store().hset_if_absent(STATE_KEY, user_id, "1"):
+            self._dirty[user_id] = (True, None)
+            await self._broadcast(user_id, True)
+
+    async def heartbeat(self, user_id, channel_name):
+        await self._register(user_id, channel_name)
+
+    async def disconnect(self, user_id, channel_name):
+        await get_store().hdel(connections_key(user_id), channel_name)
+        if await self._live_connections(user_id):
+            return
+
+        pending = self._pending_offline.pop(user_id, None)
+        if pending:
+            pending.cancel()
+        # Keeps the sweep off the user while this worker's grace timer runs.
+        await get_store().set(leaving_key(user_id), "1", ttl=math.ceil(settings.PRESENCE_OFFLINE_GRACE) + 1)
+        self._pending_offline[user_id] = asyncio.ensure_future(self._go_offline(user_id))
+
+    async def _go_offline(self, user_id):
+        await asyncio.sleep(settings.PRESENCE_OFFLINE_GRACE)
+        self._pending_offline.pop(user_id, None)
+        if await self._live_connections(user_id):
+            return
+        await self._mark_offline(user_id)
+
+    async def _mark_offline(self, user_id):
+        store = get_store()
+        if not await store.hdel(STATE_KEY, user_id):
+            return False
+        # A socket that registered before the delete found the user still
+        # online and announced nothing, so it is put back quietly.
+        if await self._live_connections(user_id):
+            await store.hset_if_absent(STATE_KEY, user_id, "1")
+            return False
+        self._dirty[user_id] = (False, timezone.now())
+        await self._broadcast(user_id, False)
+        return True
+
+    async def sweep(self):
+        """Take offline the users whose sockets all expired. Returns their ids."""
+        store = get_store()
+        offline = []
+        for user_id in await store.hgetall(STATE_KEY):
+            user_id = int(user_id)
+            if user_id in self._pending_offline or await store.get(leaving_key(user_id)):
+                continue
+            if not await self._live_connections(user_id) and await self._mark_offline(user_id):
+                offline.append(user_id)
+        return offline
+
+    async def snapshot(self, user_ids):
+        states = await get_store().hmget(STATE_KEY, user_ids)
+        return [
+            {"user_id": user_id, "is_online": state == "1"}
+            for user_id, state in zip(user_ids, states)
+        ]
+
+    async def _broadcast(self, user_id, is_online):
+        from chat_messages.frames import attach_frames
+        await get_channel_layer().group_send(
+            presence_group(user_id),
+            attach_frames({
+                "type": "user_status",
+                "user_id": user_id,
+                "is_online": is_online,
+            })
+        )
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(settings.PRESENCE_FLUSH_INTERVAL)
+                try:
+                    if await get_store().set_if_absent(SWEEP_KEY, "1", ttl=settings.PRESENCE_SWEEP_INTERVAL):
+                        await self.sweep()
+                except Exception:
+                    logger.exception("Presence sweep failed")
+                await self.flush()
+        except asyncio.CancelledError:
+            await database_write_to_async(self.drain)()
+            raise
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            await self._write(dirty)
+        except asyncio.CancelledError:
+            # Left for drain(), newer changes win.
+            self._dirty = {**dirty, **self._dirty}
+            raise
+
+    async def _write(self, dirty):
+        """Write a batch, falling back to one user at a time when it fails."""
+        if len(dirty) > 1:
+            try:
+                await database_write_to_async(persist_statuses)(dirty)
+            except Exception:
+                logger.warning("Failed to write %s presence changes, retrying one by one", len(dirty), exc_info=True)
+            else:
+                for user_id in dirty:
+                    self._attempts.pop(user_id, None)
+                return
+
+        for user_id, change in dirty.items():
+            try:
+                await database_write_to_async(persist_statuses)({user_id: change})
+            except Exception:
+                self._failed(user_id, change)
+                continue
+            self._attempts.pop(user_id, None)
+
+    def _failed(self, user_id, change):
+        attempts = self._attempts.pop(user_id, 0) + 1
+        if attempts >= settings.PRESENCE_FLUSH_MAX_ATTEMPTS:
+            logger.exception("Dropping presence change of user %s after %s attempts", user_id, attempts)
+            return
+        logger.exception("Failed to write presence change of user %s, retrying", user_id)
+        self._attempts[user_id] = attempts
+        # A newer change for the user supersedes this one.
+        self._dirty.setdefault(user_id, change)
+
+    def drain(self):
+        """Synchronously write the status changes not flushed yet."""
+        dirty, self._dirty = self._dirty, {}
+        if dirty:
+            persist_statuses(dirty)
+        return len(dirty)
+
+
+def persist_statuses(dirty):
+    from .models import UserStatus
+
+    online = [UserStatus(user_id=user_id, is_online=True) for user_id, (is_online, _) in dirty.items() if is_online]
+    offline = [
+        UserStatus(user_id=user_id, is_online=False, last_seen=last_seen)
+        for user_id, (is_online, last_seen) in dirty.items() if not is_online
+    ]
+    if online:
+        UserStatus.objects.bulk_create(
+            online, update_conflicts=True, unique_fields=['user'], update_fields=['is_online']
+        )
+    if offline:
+        UserStatus.objects.bulk_create(
+            offline, update_conflicts=True, unique_fields=['user'], update_fields=['is_online', 'last_seen']
+        )
+
+
+presence = PresenceService()
+atexit.register(presence.drain)
@@ -1,6 +1,10 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
 from .models import User, UserStatus
+from .tokens import ChatRefreshToken
 
 User = get_user_model()
 
@@ -52,3 +56,26 @@ class RegisterResponseSerializer(serializers.Serializer):
     access = serializers.CharField()
     refresh = serializers.CharField()
 
+
+class ChatTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = ChatRefreshToken
+
+
+class ChatTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Refresh that rewrites the username claim from the current user row.
+
+    Access tokens copy their claims from the refresh token, which would
+    otherwise keep the username of login time for its whole lifetime.
+    """
+    token_class = ChatRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        user = User.objects.filter(
+            id=refresh.payload.get(api_settings.USER_ID_CLAIM), is_active=True
+        ).only('id', 'username').first()
+        if user is None:
+            raise AuthenticationFailed(self.error_messages["no_active_account"], "no_active_account")
+        refresh["username"] = user.username
+        return super().validate({**attrs, "refresh": str(refresh)})
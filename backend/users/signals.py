@@ -1,5 +1,6 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from .cache import user_changed
 from .models import User, UserStatus
 
 @receiver(post_save, sender=User)
@@ -7,3 +8,11 @@ def create_status(sender, instance, created, **kwargs):
     if created:
         UserStatus.objects.create(user=instance)
 
+@receiver(post_save, sender=User)
+def invalidate_saved_user(sender, instance, created, **kwargs):
+    if not created:
+        user_changed(instance.pk, instance.username if instance.is_active else None)
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    user_changed(instance.pk, None)
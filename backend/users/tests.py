@@ -0,0 +1,158 @@
+import asyncio
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.test import TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from backend.jwt_middleware import get_user
+from common.db import database_sync_to_async
+from common.store import get_store
+from common.testing import create_user
+from . import cache, presence
+from .models import UserStatus
+from .tokens import ChatRefreshToken, TokenPrincipal
+
+
+class JwtAuthTests(TransactionTestCase):
+    def setUp(self):
+        cache.resolved_users.clear()
+        cache.changed_users.clear()
+        self.user = create_user("alice")
+
+    def token(self):
+        return str(ChatRefreshToken.for_user(self.user).access_token)
+
+    def authenticate(self, token):
+        return async_to_sync(get_user)(token)
+
+    def test_username_claim_needs_no_query(self):
+        token = self.token()
+        with self.assertNumQueries(0):
+            user = self.authenticate(token)
+        self.assertIsInstance(user, TokenPrincipal)
+        self.assertEqual((user.id, user.username), (self.user.id, "alice"))
+
+    def test_token_with_stale_username_is_rejected(self):
+        stale = self.token()
+        self.user.username = "alice2"
+        self.user.save()
+
+        self.assertIsNone(self.authenticate(stale))
+        self.assertEqual(self.authenticate(self.token()).username, "alice2")
+
+    def test_refresh_after_rename_carries_the_new_username(self):
+        refresh = str(ChatRefreshToken.for_user(self.user))
+        self.user.username = "alice2"
+        self.user.save()
+
+        response = APIClient().post("/api/auth/refresh/", {"refresh": refresh}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AccessToken(response.json()["access"])["username"], "alice2")
+        # Accepted even once the rename is no longer remembered.
+        cache.changed_users.clear()
+        self.assertEqual(self.authenticate(response.json()["access"]).username, "alice2")
+
+        self.user.is_active = False
+        self.user.save()
+        response = APIClient().post("/api/auth/refresh/", {"refresh": refresh}, format="json")
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_of_deactivated_user_is_rejected(self):
+        token = self.token()
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.authenticate(token))
+
+    def test_user_without_claim_is_cached_until_changed(self):
+        token = str(AccessToken.for_user(self.user))
+        self.assertEqual(self.authenticate(token).username, "alice")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(token).username, "alice")
+
+        self.user.delete()
+        self.assertIsNone(self.authenticate(token))
+
+    async def test_changes_from_other_workers_are_applied(self):
+        await cache.ensure_listener()
+        cache.resolved_users.set(self.user.id, TokenPrincipal(self.user.id, "alice"))
+        await get_channel_layer().group_send(cache.INVALIDATION_GROUP, {
+            "type": "user.changed",
+            "user_id": self.user.id,
+            "username": "renamed",
+        })
+        for _ in range(50):
+            if self.user.id in cache.changed_users:
+                break
+            await asyncio.sleep(0.01)
+
+        self.assertEqual(cache.changed_users.get(self.user.id), "renamed")
+        self.assertNotIn(self.user.id, cache.resolved_users)
+
+
+@override_settings(PRESENCE_OFFLINE_GRACE=0.05)
+class PresenceTests(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user("online")
+        self.service = presence.PresenceService()
+        self.broadcasts = []
+        patcher = mock.patch.object(self.service, "_broadcast", self.record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        store = get_store()
+        async_to_sync(store.hdel)(presence.STATE_KEY, self.user.id)
+        async_to_sync(store.delete)(presence.connections_key(self.user.id))
+
+    async def record(self, user_id, is_online):
+        self.broadcasts.append((user_id, is_online))
+
+    async def stop(self):
+        self.service._flusher.cancel()
+        try:
+            await self.service._flusher
+        except asyncio.CancelledError:
+            pass
+
+    async def test_user_stays_online_while_any_socket_is_open(self):
+        await self.service.connect(self.user.id, "socket-a")
+        await self.service.connect(self.user.id, "socket-b")
+        await self.service.disconnect(self.user.id, "socket-a")
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.broadcasts, [(self.user.id, True)])
+
+        await self.service.disconnect(self.user.id, "socket-b")
+        await asyncio.sleep(0.1)
+        await self.stop()
+
+        self.assertEqual(self.broadcasts, [(self.user.id, True), (self.user.id, False)])
+        self.assertEqual(await self.service.snapshot([self.user.id]), [{"user_id": self.user.id, "is_online": False}])
+        status = await database_sync_to_async(UserStatus.objects.get)(user=self.user)
+        self.assertFalse(status.is_online)
+        self.assertIsNotNone(status.last_seen)
+
+    async def test_reconnect_within_the_grace_period_is_not_announced(self):
+        await self.service.connect(self.user.id, "socket-a")
+        await self.service.disconnect(self.user.id, "socket-a")
+        await self.service.connect(self.user.id, "socket-b")
+        await asyncio.sleep(0.1)
+        await self.stop()
+
+        self.assertEqual(self.broadcasts, [(self.user.id, True)])
+        self.assertEqual(await self.service.snapshot([self.user.id]), [{"user_id": self.user.id, "is_online": True}])
+
+    @override_settings(PRESENCE_FLUSH_MAX_ATTEMPTS=2)
+    async def test_a_failing_row_does_not_hold_back_the_others(self):
+        missing_id = self.user.id + 1000
+        self.service._dirty = {self.user.id: (True, None), missing_id: (True, None)}
+
+        with self.assertLogs(presence.logger, "ERROR"):
+            await self.service.flush()
+        status = await database_sync_to_async(UserStatus.objects.get)(user=self.user)
+        self.assertTrue(status.is_online)
+        self.assertEqual(list(self.service._dirty), [missing_id])
+
+        with self.assertLogs(presence.logger, "ERROR") as logs:
+            await self.service.flush()
+        self.assertIn("Dropping presence change", logs.output[-1])
+        self.assertEqual(self.service._dirty, {})
+        self.assertEqual(self.service._attempts, {})
@@ -0,0 +1,32 @@
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+class ChatRefreshToken(RefreshToken):
+    """Refresh token that also carries the username, copied into access tokens."""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token["username"] = user.username
+        return token
+
+
+class TokenPrincipal:
+    """Lightweight stand-in for User built from token claims, no DB row needed."""
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, username):
+        self.id = self.pk = int(user_id)
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+    def __eq__(self, other):
+        return getattr(other, "pk", None) == self.pk
+
+    def __hash__(self):
+        return hash(self.pk)
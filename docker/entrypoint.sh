@@ -10,6 +10,9 @@ echo "Waiting for Redis to be ready..."
 echo "Running migrations..."
 python manage.py migrate --noinput
 
+echo "Creating message partitions..."
+python manage.py create_message_partitions
+
 echo "Starting server..."
 export DJANGO_SETTINGS_MODULE=backend.settings
 exec "$@"